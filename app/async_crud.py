@@ -0,0 +1,82 @@
+# crud模块的异步版本：把同步CRUD调用放到database中的专用线程池里执行，不阻塞事件循环。
+# 写操作串行进入写入线程，代理热路径的读取进入reader线程池，
+# 管理后台的统计和分页查询进入独立的只读analytics线程池，慢查询不会占用热路径的线程。
+from typing import List, Dict, Any, Optional, Tuple
+
+from app import crud
+from app.database import run_write, run_read, run_analytics
+
+# --- API Key ---
+
+async def add_api_key(key_name: str, api_key: str, daily_limit: int) -> None:
+    await run_write(crud.add_api_key, key_name, api_key, daily_limit)
+
+async def delete_api_key(key_id: int) -> None:
+    await run_write(crud.delete_api_key, key_id)
+
+async def update_api_key(key_id: int, key_name: str, daily_limit: int, is_active: bool) -> None:
+    await run_write(crud.update_api_key, key_id, key_name, daily_limit, is_active)
+
+async def get_api_key_stats() -> List[Dict[str, Any]]:
+    return await run_analytics(crud.get_api_key_stats)
+
+async def load_active_api_keys() -> List[Dict[str, Any]]:
+    return await run_read(crud.load_active_api_keys)
+
+# --- Usage Log ---
+
+async def write_usage_batch(rows: List[tuple], key_updates: List[tuple]) -> None:
+    await run_write(crud.write_usage_batch, rows, key_updates)
+
+async def get_usage_logs(page: int, page_size: int, cursor_token: Optional[str] = None, **filters) -> Dict[str, Any]:
+    return await run_analytics(crud.get_usage_logs, page, page_size, cursor_token, **filters)
+
+async def count_usage_logs(**filters) -> int:
+    return await run_analytics(crud.count_usage_logs, **filters)
+
+# --- Response Cache ---
+
+async def get_cached_response(cache_key: str, now: float) -> Optional[Tuple[bytes, Optional[str], float]]:
+    return await run_read(crud.get_cached_response, cache_key, now)
+
+async def put_cached_response(cache_key: str, body: bytes, usage: Optional[str], created_at: float, expires_at: float, max_bytes: int) -> None:
+    await run_write(crud.put_cached_response, cache_key, body, usage, created_at, expires_at, max_bytes)
+
+async def clear_response_cache() -> None:
+    await run_write(crud.clear_response_cache)
+
+# --- Retention ---
+
+async def get_oldest_usage_log_day() -> Optional[str]:
+    return await run_read(crud.get_oldest_usage_log_day)
+
+async def delete_usage_logs_batch(day: str, max_id: int, limit: int) -> int:
+    return await run_write(crud.delete_usage_logs_batch, day, max_id, limit)
+
+async def get_vacuum_status() -> Dict[str, Any]:
+    return await run_analytics(crud.get_vacuum_status)
+
+async def incremental_vacuum(pages: int) -> int:
+    return await run_write(crud.incremental_vacuum, pages)
+
+# --- Free Models ---
+
+async def update_free_models(models: List[Dict[str, Any]]) -> Dict[str, int]:
+    return await run_write(crud.update_free_models, models)
+
+async def get_all_free_models_with_status() -> List[Dict[str, Any]]:
+    return await run_read(crud.get_all_free_models_with_status)
+
+# --- Stats ---
+
+async def get_today_stats() -> Dict[str, Any]:
+    return await run_analytics(crud.get_today_stats)
+
+async def get_model_stats() -> List[Dict[str, Any]]:
+    return await run_analytics(crud.get_model_stats)
+
+async def get_hourly_stats(hours: int) -> List[Dict[str, Any]]:
+    return await run_analytics(crud.get_hourly_stats, hours)
+
+async def get_filter_options() -> Dict[str, List]:
+    return await run_analytics(crud.get_filter_options)
@@ -1,9 +1,13 @@
 import sqlite3
 import logging
-from datetime import datetime, timedelta
-from typing import List, Dict, Any, Optional
+import json
+import base64
+import time
+from datetime import datetime, timedelta, date
+from typing import List, Dict, Any, Optional, Tuple
 
 from .database import get_db_connection
+from .migrations import backfill_rollups
 
 logger = logging.getLogger(__name__)
 
@@ -45,241 +49,377 @@ def get_api_key_stats() -> List[Dict[str, Any]]:
         )
         return [dict(row) for row in cursor.fetchall()]
 
-def get_active_api_keys() -> List[Dict[str, Any]]:
-    """获取所有有效的API Key，并重置每日使用量。"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 获取所有可能有效的Key
-        cursor.execute('SELECT * FROM api_keys WHERE is_active = TRUE')
-        keys = [dict(row) for row in cursor.fetchall()]
-        
-        valid_keys = []
-        current_utc_date = datetime.utcnow().date()
-
-        for key in keys:
-            # 检查是否需要重置每日使用量
-            last_reset_time_str = key.get('last_reset_time')
-            last_reset_date = None
-            if last_reset_time_str:
-                try:
-                    if '.' in last_reset_time_str:
-                        dt_obj = datetime.fromisoformat(last_reset_time_str.split('.')[0])
-                    else:
-                        dt_obj = datetime.fromisoformat(last_reset_time_str)
-                    last_reset_date = dt_obj.date()
-                except (ValueError, TypeError):
-                    try:
-                        last_reset_date = datetime.strptime(last_reset_time_str, '%Y-%m-%d %H:%M:%S').date()
-                    except (ValueError, TypeError):
-                        last_reset_date = None
-
-            if last_reset_date != current_utc_date:
-                cursor.execute(
-                    "UPDATE api_keys SET daily_usage = 0, last_reset_time = ? WHERE id = ?",
-                    (datetime.utcnow(), key['id'])
-                )
-                key['daily_usage'] = 0
-            
-            # 检查Key是否在每日限额内
-            if key['daily_limit'] == -1 or key['daily_usage'] < key['daily_limit']:
-                valid_keys.append(key)
-        
-        conn.commit()
-        
-        # 按总使用次数排序
-        valid_keys.sort(key=lambda x: x.get('usage_count', 0))
-        return valid_keys
+def utc_now_str() -> str:
+    """返回与SQLite CURRENT_TIMESTAMP格式一致的当前UTC时间字符串。"""
+    return datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+
+def parse_reset_date(last_reset_time: Optional[str]) -> Optional[date]:
+    """解析数据库中的last_reset_time，兼容多种历史格式。"""
+    if not last_reset_time:
+        return None
+    try:
+        if '.' in last_reset_time:
+            dt_obj = datetime.fromisoformat(last_reset_time.split('.')[0])
+        else:
+            dt_obj = datetime.fromisoformat(last_reset_time)
+        return dt_obj.date()
+    except (ValueError, TypeError):
+        try:
+            return datetime.strptime(last_reset_time, '%Y-%m-%d %H:%M:%S').date()
+        except (ValueError, TypeError):
+            return None
 
-def update_key_usage(key_id: int) -> None:
-    """更新API Key的使用次数和每日使用量。"""
+def load_active_api_keys() -> List[Dict[str, Any]]:
+    """加载所有激活的API Key，供内存中的Key调度器使用。"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
-            "UPDATE api_keys SET usage_count = usage_count + 1, daily_usage = daily_usage + 1, last_used = CURRENT_TIMESTAMP WHERE id = ?",
-            (key_id,)
+            "SELECT id, key_name, api_key, daily_limit, daily_usage, usage_count, last_used, last_reset_time FROM api_keys WHERE is_active = TRUE"
         )
-        conn.commit()
+        return [dict(row) for row in cursor.fetchall()]
 
 # --- Usage Log CRUD ---
 
-def log_usage(api_key_id: int, model: str, prompt_tokens: int, completion_tokens: int, total_tokens: int, cost: float, status: int) -> None:
-    """记录一次API调用。"""
+def _day_range(day: str) -> Optional[Tuple[str, str]]:
+    """把 YYYY-MM-DD 转换为 [当天0点, 次日0点) 的时间字符串范围，格式错误时返回None。"""
+    try:
+        start = date.fromisoformat(day)
+    except (ValueError, TypeError):
+        return None
+    end = start + timedelta(days=1)
+    return (f"{start.isoformat()} 00:00:00", f"{end.isoformat()} 00:00:00")
+
+def write_usage_batch(rows: List[tuple], key_updates: List[tuple]) -> None:
+    """
+    在一个事务中批量写入使用记录和Key计数。
+    rows的每一项为 (api_key_id, model, prompt_tokens, completion_tokens, total_tokens, cost, response_status, request_time, estimated_prompt_tokens)；
+    key_updates的每一项为 (usage_count增量, daily_usage, last_used, last_reset_time, key_id)，
+    后三项为None时保留数据库中的原值。
+    """
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO usage_logs (api_key_id, model, prompt_tokens, completion_tokens, total_tokens, cost, response_status) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (api_key_id, model, prompt_tokens, completion_tokens, total_tokens, cost, status)
+        if rows:
+            cursor.executemany(
+                "INSERT INTO usage_logs (api_key_id, model, prompt_tokens, completion_tokens, total_tokens, cost, response_status, request_time, estimated_prompt_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        if rows:
+            _update_rollups(cursor, rows)
+        if key_updates:
+            cursor.executemany(
+                """
+                UPDATE api_keys SET
+                    usage_count = usage_count + ?,
+                    daily_usage = COALESCE(?, daily_usage),
+                    last_used = COALESCE(?, last_used),
+                    last_reset_time = COALESCE(?, last_reset_time)
+                WHERE id = ?
+                """,
+                key_updates
+            )
+        conn.commit()
+
+def _update_rollups(cursor: sqlite3.Cursor, rows: List[tuple]) -> None:
+    """把一批使用记录先在内存中聚合，再增量累加到小时/天汇总表。"""
+    hourly: Dict[tuple, List[int]] = {}
+    daily: Dict[tuple, List[int]] = {}
+    for api_key_id, model, prompt_tokens, completion_tokens, total_tokens, _, status, request_time, _ in rows:
+        key = (api_key_id or 0, model or '', (status or 0) // 100)
+        for buckets, bucket in ((hourly, f"{request_time[:13]}:00:00"), (daily, request_time[:10])):
+            sums = buckets.get((bucket,) + key)
+            if sums is None:
+                sums = buckets[(bucket,) + key] = [0, 0, 0, 0]
+            sums[0] += 1
+            sums[1] += prompt_tokens or 0
+            sums[2] += completion_tokens or 0
+            sums[3] += total_tokens or 0
+
+    for table, buckets in (("usage_rollup_hourly", hourly), ("usage_rollup_daily", daily)):
+        cursor.executemany(
+            f"""
+            INSERT INTO {table} (bucket, api_key_id, model, status_class, request_count, prompt_tokens, completion_tokens, total_tokens)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (bucket, api_key_id, model, status_class) DO UPDATE SET
+                request_count = request_count + excluded.request_count,
+                prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = completion_tokens + excluded.completion_tokens,
+                total_tokens = total_tokens + excluded.total_tokens
+            """,
+            [key + tuple(sums) for key, sums in buckets.items()]
         )
+
+def rebuild_usage_rollups() -> None:
+    """
+    从usage_logs重新计算所有汇总表。
+    已归档的记录已经从usage_logs删除，重新计算后汇总表中这部分历史会丢失，统计只覆盖仍保留的记录。
+    """
+    with get_db_connection() as conn:
+        conn.execute("BEGIN")
+        backfill_rollups(conn.cursor())
         conn.commit()
 
-def get_usage_logs(page: int, page_size: int, **filters) -> Dict[str, Any]:
-    """获取带筛选和分页的调用记录。"""
+def encode_log_cursor(request_time: str, log_id: int) -> str:
+    """把分页位置 (request_time, id) 编码为不透明的游标字符串。"""
+    raw = json.dumps([request_time, log_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_log_cursor(token: str) -> Tuple[str, int]:
+    """解析游标字符串，格式错误时抛出ValueError。"""
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        request_time, log_id = json.loads(raw)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"无效的分页游标: {token}") from e
+    if not isinstance(request_time, str) or not isinstance(log_id, int):
+        raise ValueError(f"无效的分页游标: {token}")
+    return request_time, log_id
+
+def _usage_log_where(filters: Dict[str, Any]) -> Tuple[str, List[Any]]:
+    """根据筛选条件生成usage_logs（别名ul）的WHERE子句和参数。"""
+    where_conditions = []
+    params = []
+
+    if filters.get("key_filter"):
+        where_conditions.append("ul.api_key_id = ?")
+        params.append(filters["key_filter"])
+    if filters.get("model_filter"):
+        where_conditions.append("ul.model = ?")
+        params.append(filters["model_filter"])
+    if filters.get("status_filter") == "200":
+        # 成功的请求包括响应缓存命中（203）
+        where_conditions.append("ul.response_status >= 200 AND ul.response_status < 300")
+    elif filters.get("status_filter") == "400":
+        where_conditions.append("ul.response_status >= 400")
+    if filters.get("date_filter"):
+        day_range = _day_range(filters["date_filter"])
+        if day_range is None:
+            where_conditions.append("1=0")
+        else:
+            # 使用范围条件而不是DATE(request_time)，以便命中request_time索引
+            where_conditions.append("ul.request_time >= ? AND ul.request_time < ?")
+            params.extend(day_range)
+
+    where_clause = " AND ".join(where_conditions) if where_conditions else "1=1"
+    return where_clause, params
+
+def count_usage_logs(**filters) -> int:
+    """统计符合筛选条件的调用记录数量。"""
+    where_clause, params = _usage_log_where(filters)
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        where_conditions = []
-        params = []
-        
-        if filters.get("key_filter"):
-            where_conditions.append("ul.api_key_id = ?")
-            params.append(filters["key_filter"])
-        if filters.get("model_filter"):
-            where_conditions.append("ul.model = ?")
-            params.append(filters["model_filter"])
-        if filters.get("status_filter") == "200":
-            where_conditions.append("ul.response_status = 200")
-        elif filters.get("status_filter") == "400":
-            where_conditions.append("ul.response_status >= 400")
-        if filters.get("date_filter"):
-            where_conditions.append("DATE(ul.request_time) = ?")
-            params.append(filters["date_filter"])
-            
-        where_clause = " AND ".join(where_conditions) if where_conditions else "1=1"
-        
-        count_query = f"SELECT COUNT(*) FROM usage_logs ul JOIN api_keys ak ON ul.api_key_id = ak.id WHERE {where_clause}"
-        cursor.execute(count_query, params)
-        total_records = cursor.fetchone()[0]
-        
-        offset = (page - 1) * page_size
-        data_query = f"""
-            SELECT ul.request_time, ak.key_name, ul.model, ul.prompt_tokens, ul.completion_tokens, ul.total_tokens, ul.cost, ul.response_status
-            FROM usage_logs ul
-            JOIN api_keys ak ON ul.api_key_id = ak.id
+        cursor.execute(f"SELECT COUNT(*) FROM usage_logs ul WHERE {where_clause}", params)
+        return cursor.fetchone()[0]
+
+def get_usage_logs(page: int, page_size: int, cursor_token: Optional[str] = None, **filters) -> Dict[str, Any]:
+    """
+    获取带筛选和分页的调用记录，按 (request_time, id) 倒序排列。
+    传入cursor_token时使用键集分页，从游标位置之后继续读取，与页码深度无关；
+    否则按page计算OFFSET，兼容旧的页码分页。
+    返回的next_cursor可用于获取下一页，没有更多记录时为None。
+    """
+    where_clause, params = _usage_log_where(filters)
+    if cursor_token:
+        request_time, log_id = decode_log_cursor(cursor_token)
+        where_clause += " AND (ul.request_time, ul.id) < (?, ?)"
+        params = params + [request_time, log_id]
+        offset = 0
+    else:
+        offset = (max(page, 1) - 1) * page_size
+
+    # 先在索引上确定这一页的记录id，再回表读取完整的行，OFFSET跳过的行不需要读取整行
+    data_query = f"""
+        SELECT ul.id, ul.request_time, ak.key_name, ul.model, ul.prompt_tokens, ul.completion_tokens, ul.total_tokens, ul.cost, ul.response_status
+        FROM usage_logs ul
+        LEFT JOIN api_keys ak ON ul.api_key_id = ak.id
+        WHERE ul.id IN (
+            SELECT ul.id FROM usage_logs ul
             WHERE {where_clause}
-            ORDER BY ul.request_time DESC
+            ORDER BY ul.request_time DESC, ul.id DESC
             LIMIT ? OFFSET ?
-        """
-        cursor.execute(data_query, params + [page_size, offset])
+        )
+        ORDER BY ul.request_time DESC, ul.id DESC
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # 多读一条用于判断是否还有下一页
+        cursor.execute(data_query, params + [page_size + 1, offset])
         logs = [dict(row) for row in cursor.fetchall()]
-        
-        return {
-            "logs": logs,
-            "total_records": total_records,
-            "total_pages": (total_records + page_size - 1) // page_size
-        }
 
-# --- Free Models CRUD ---
+    next_cursor = None
+    if len(logs) > page_size:
+        logs = logs[:page_size]
+        next_cursor = encode_log_cursor(logs[-1]["request_time"], logs[-1]["id"])
+    for log in logs:
+        del log["id"]
+    return {"logs": logs, "next_cursor": next_cursor}
+
+# --- Response Cache ---
+
+def get_cached_response(cache_key: str, now: float) -> Optional[Tuple[bytes, Optional[str], float]]:
+    """返回未过期的缓存条目 (body, usage的JSON, expires_at)，没有时返回None。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT body, usage, expires_at FROM response_cache WHERE cache_key = ? AND expires_at > ?",
+            (cache_key, now)
+        )
+        row = cursor.fetchone()
+        return (bytes(row[0]), row[1], row[2]) if row else None
+
+def put_cached_response(cache_key: str, body: bytes, usage: Optional[str], created_at: float, expires_at: float, max_bytes: int) -> None:
+    """写入一个缓存条目，同时删除过期的条目；总大小超过max_bytes时从最早写入的条目开始删除。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM response_cache WHERE expires_at <= ?", (created_at,))
+        cursor.execute(
+            "INSERT OR REPLACE INTO response_cache (cache_key, body, usage, size, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (cache_key, body, usage, len(body), created_at, expires_at)
+        )
+        cursor.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache")
+        excess = cursor.fetchone()[0] - max_bytes
+        if excess > 0:
+            cursor.execute("SELECT cache_key, size FROM response_cache ORDER BY created_at")
+            evicted = []
+            for key, size in cursor.fetchall():
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            cursor.executemany("DELETE FROM response_cache WHERE cache_key = ?", evicted)
+        conn.commit()
+
+def clear_response_cache() -> None:
+    with get_db_connection() as conn:
+        conn.execute("DELETE FROM response_cache")
+        conn.commit()
+
+# --- Retention ---
+
+def get_oldest_usage_log_day() -> Optional[str]:
+    """返回usage_logs中最早一条记录的日期（YYYY-MM-DD），表为空时返回None。"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(request_time) FROM usage_logs")
+        oldest = cursor.fetchone()[0]
+        return str(oldest)[:10] if oldest else None
+
+def fetch_usage_logs_for_archive(day: str, after_id: int, limit: int) -> List[Dict[str, Any]]:
+    """按id顺序读取某一天id大于after_id的原始记录（附带当时的Key名称），用于归档。"""
+    day_range = _day_range(day)
+    if day_range is None:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT ul.*, ak.key_name
+            FROM usage_logs ul
+            LEFT JOIN api_keys ak ON ul.api_key_id = ak.id
+            WHERE ul.request_time >= ? AND ul.request_time < ? AND ul.id > ?
+            ORDER BY ul.id
+            LIMIT ?
+        """, (*day_range, after_id, limit))
+        return [dict(row) for row in cursor.fetchall()]
 
-def get_free_models() -> List[str]:
-    """获取所有启用的免费模型ID。"""
+def delete_usage_logs_batch(day: str, max_id: int, limit: int) -> int:
+    """删除某一天id不大于max_id的最多limit条记录，返回删除的条数。汇总表中的统计保持不变。"""
+    day_range = _day_range(day)
+    if day_range is None:
+        return 0
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT model_id FROM free_models WHERE is_active = TRUE")
-        return [row[0] for row in cursor.fetchall()]
+        cursor.execute("""
+            DELETE FROM usage_logs WHERE id IN (
+                SELECT id FROM usage_logs
+                WHERE request_time >= ? AND request_time < ? AND id <= ?
+                LIMIT ?
+            )
+        """, (*day_range, max_id, limit))
+        conn.commit()
+        return cursor.rowcount
+
+def get_vacuum_status() -> Dict[str, Any]:
+    """返回数据库文件的页数、空闲页数和auto_vacuum模式。"""
+    with get_db_connection() as conn:
+        return {
+            "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(conn.execute("PRAGMA auto_vacuum").fetchone()[0], "unknown"),
+            "page_size": conn.execute("PRAGMA page_size").fetchone()[0],
+            "page_count": conn.execute("PRAGMA page_count").fetchone()[0],
+            "freelist_count": conn.execute("PRAGMA freelist_count").fetchone()[0],
+        }
+
+def incremental_vacuum(pages: int) -> int:
+    """把最多pages个空闲页归还给文件系统（需要auto_vacuum=INCREMENTAL），返回释放的页数。"""
+    with get_db_connection() as conn:
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # sqlite3的execute只会执行一步（释放一页），executescript会执行到结束
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return before - after
 
-def update_free_models(models: List[Dict[str, Any]]) -> None:
-    """用新的模型列表更新数据库。"""
+# --- Free Models CRUD ---
+
+def update_free_models(models: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    按差异把新的模型列表写入数据库：新增的模型默认启用，已有模型只更新名称、上下文长度和参数量，
+    保留管理员设置的is_active和首次记录的created；上游已经下线的模型被删除。
+    models为 model_metadata.enrich 整理后的模型信息。所有变更在同一个事务中完成，返回新增/更新/删除的数量。
+    """
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("DELETE FROM free_models")
-            
-            # 准备插入数据，包含新的字段
-            insert_data = []
+            cursor.execute("SELECT model_id, model_name, context_length, parameters, parameter_count, created FROM free_models")
+            existing = {row["model_id"]: row for row in cursor.fetchall()}
+
+            now = int(time.time())
+            inserts, updates, seen = [], [], set()
             for m in models:
-                model_id = m.get('id', '')
-                model_name = m.get('name', model_id)
-                context_length = m.get('context_length')
+                model_id = m['id']
+                if not model_id or model_id in seen:
+                    continue
+                seen.add(model_id)
+                values = (m['name'], m['context_length'], m['parameters'], m['parameter_count'])
                 
-                # 从描述中提取参数量信息
-                parameters = _extract_parameters_from_description(m.get('description', ''))
-                
-                insert_data.append((model_id, model_name, True, context_length, parameters))
-            
+                row = existing.get(model_id)
+                if row is None:
+                    inserts.append((model_id, *values, True, m['created'] or now))
+                elif (row["model_name"], row["context_length"], row["parameters"], row["parameter_count"]) != values or row["created"] is None:
+                    updates.append((*values, row["created"] or m['created'] or now, model_id))
+            removed = [(model_id,) for model_id in existing if model_id not in seen]
+
+            cursor.executemany(
+                "INSERT INTO free_models (model_id, model_name, context_length, parameters, parameter_count, is_active, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                inserts
+            )
             cursor.executemany(
-                "INSERT INTO free_models (model_id, model_name, is_active, context_length, parameters) VALUES (?, ?, ?, ?, ?)",
-                insert_data
+                "UPDATE free_models SET model_name = ?, context_length = ?, parameters = ?, parameter_count = ?, created = ? WHERE model_id = ?",
+                updates
             )
+            cursor.executemany("DELETE FROM free_models WHERE model_id = ?", removed)
             conn.commit()
-            logger.info(f"✅ 成功更新了 {len(models)} 个免费模型到数据库。")
+            logger.info(f"✅ 免费模型已同步到数据库: 新增 {len(inserts)}，更新 {len(updates)}，删除 {len(removed)}。")
+            return {"added": len(inserts), "updated": len(updates), "removed": len(removed)}
     except Exception as e:
         logger.error(f"❌ 更新免费模型失败: {e}")
         raise
 
-
-def _extract_parameters_from_description(description: str) -> Optional[str]:
-    """从模型描述中提取参数量信息。"""
-    import re
-    
-    if not description:
-        return None
-    
-    # 匹配各种参数量格式
-    patterns = [
-        # 直接的B/M格式
-        r'(\d+(?:\.\d+)?)\s*[Bb][\s-]*parameter',  # "21B parameter", "24B-parameter"
-        r'(\d+(?:\.\d+)?)\s*[Bb][\s-]*param',      # "21B param"
-        r'(\d+(?:\.\d+)?)\s*[Mm][\s-]*parameter',  # "7M parameter"
-        r'(\d+(?:\.\d+)?)\s*[Mm][\s-]*param',      # "7M param"
-        
-        # 数字+单位+parameter格式
-        r'(\d+(?:\.\d+)?)\s+billion[\s-]*parameter', # "21 billion parameter"
-        r'(\d+(?:\.\d+)?)\s+million[\s-]*parameter', # "7 million parameter"
-        r'(\d+(?:\.\d+)?)\s+[Bb][\s-]*parameter',    # "24 B parameter"
-        r'(\d+(?:\.\d+)?)\s+[Mm][\s-]*parameter',    # "7 M parameter"
-        
-        # active parameter格式
-        r'(\d+(?:\.\d+)?)\s*[Bb]\s+active\s+parameter', # "13B active parameter"
-        r'(\d+(?:\.\d+)?)\s*[Mm]\s+active\s+parameter', # "7M active parameter"
-        
-        # parameter count格式
-        r'(\d+(?:\.\d+)?)\s*[Bb][\s-]*parameter[\s-]*count', # "671 B-parameter"
-        r'(\d+(?:\.\d+)?)\s*[Mm][\s-]*parameter[\s-]*count',
-        
-        # 其他变体
-        r'(\d+(?:\.\d+)?)\s*billion\s+param',        # "21 billion param"
-        r'(\d+(?:\.\d+)?)\s*million\s+param',        # "7 million param"
-    ]
-    
-    for pattern in patterns:
-        matches = re.findall(pattern, description, re.IGNORECASE)
-        if matches:
-            # 返回找到的第一个参数量
-            param_value = matches[0]
-            # 确定单位
-            if any(x in pattern.lower() for x in ['b', 'billion']):
-                return f"{param_value}B"
-            elif any(x in pattern.lower() for x in ['m', 'million']):
-                return f"{param_value}M"
-            else:
-                return f"{param_value}B"  # 默认为B
-    
-    return None
-
 def get_all_free_models_with_status() -> List[Dict[str, Any]]:
     """获取所有免费模型及其激活状态。"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT model_id, model_name, is_active, context_length, parameters FROM free_models ORDER BY model_id")
+        cursor.execute("SELECT model_id, model_name, is_active, context_length, parameters, parameter_count, created FROM free_models ORDER BY model_id")
         return [dict(row) for row in cursor.fetchall()]
 
-def get_model_context_length(model_id: str) -> Optional[int]:
-    """获取指定模型的上下文长度。"""
-    try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT context_length FROM free_models WHERE model_id = ? AND is_active = 1",
-                (model_id,)
-            )
-            row = cursor.fetchone()
-            return row[0] if row and row[0] else None
-    except Exception as e:
-        logger.error(f"获取模型 {model_id} 的上下文长度失败: {e}")
-        return None
-
 # --- Stats ---
 
 def get_today_stats() -> Dict[str, Any]:
-    """获取今日的总体使用统计。"""
+    """获取今日的总体使用统计，从天汇总表读取。"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT COUNT(*), SUM(total_tokens), COUNT(DISTINCT model)
-            FROM usage_logs
-            WHERE DATE(request_time) = DATE('now')
-        """)
+            SELECT SUM(request_count), SUM(total_tokens), COUNT(DISTINCT model)
+            FROM usage_rollup_daily
+            WHERE bucket = ?
+        """, (datetime.utcnow().date().isoformat(),))
         stats = cursor.fetchone()
         return {
             "total_requests": stats[0] or 0,
@@ -288,26 +428,44 @@ def get_today_stats() -> Dict[str, Any]:
         }
 
 def get_model_stats() -> List[Dict[str, Any]]:
-    """获取Top 10模型的使用统计。"""
+    """获取Top 10模型的使用统计，从天汇总表读取。"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT model, COUNT(*) as usage_count, SUM(total_tokens) as total_tokens
-            FROM usage_logs
+            SELECT model, SUM(request_count) as usage_count, SUM(total_tokens) as total_tokens
+            FROM usage_rollup_daily
             GROUP BY model
             ORDER BY usage_count DESC
             LIMIT 10
         """)
         return [dict(row) for row in cursor.fetchall()]
 
+def get_hourly_stats(hours: int) -> List[Dict[str, Any]]:
+    """获取最近若干小时每小时的请求数、错误数和Token用量，从小时汇总表读取。"""
+    since = (datetime.utcnow() - timedelta(hours=hours - 1)).strftime('%Y-%m-%d %H:00:00')
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT bucket,
+                   SUM(request_count) as total_requests,
+                   SUM(CASE WHEN status_class >= 4 THEN request_count ELSE 0 END) as error_requests,
+                   SUM(total_tokens) as total_tokens
+            FROM usage_rollup_hourly
+            WHERE bucket >= ?
+            GROUP BY bucket
+            ORDER BY bucket
+        """, (since,))
+        return [dict(row) for row in cursor.fetchall()]
+
 # --- Filter Options ---
 
 def get_filter_options() -> Dict[str, List]:
-    """获取用于前端筛选的选项。"""
+    """获取用于前端筛选的选项，模型列表从天汇总表读取（包括已归档记录中的模型）。"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT id, key_name FROM api_keys ORDER BY key_name")
         keys = [dict(row) for row in cursor.fetchall()]
-        cursor.execute("SELECT DISTINCT model FROM usage_logs ORDER BY model")
+        # 汇总表中没有模型的记录model为空字符串
+        cursor.execute("SELECT DISTINCT model FROM usage_rollup_daily WHERE model != '' ORDER BY model")
         models = [row[0] for row in cursor.fetchall()]
         return {"keys": keys, "models": models}
\ No newline at end of file
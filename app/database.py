@@ -1,89 +1,194 @@
+import asyncio
+import functools
 import sqlite3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from typing import List, Dict, Callable, Any
 
-DATABASE_URL = "openrouter_proxy.db"
+from app.migrations import apply_migrations
+from config import config
+
+DATABASE_URL = config.get('database.url', "openrouter_proxy.db")
 logger = logging.getLogger(__name__)
 
+# 每个线程持有一个长期复用的连接，避免每次CRUD调用都重新打开数据库文件
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_connections_lock = threading.Lock()
+# 每次统一关闭连接后递增，线程发现代数变化时重新建立连接
+_generation = 0
+
+def _connect() -> sqlite3.Connection:
+    """创建一个新连接并应用配置中的PRAGMA。"""
+    busy_timeout_ms = int(config.get('database.busy_timeout_ms', 5000))
+    conn = sqlite3.connect(
+        DATABASE_URL,
+        timeout=busy_timeout_ms / 1000,
+        cached_statements=int(config.get('database.cached_statements', 256)),
+        # 连接只在创建它的线程中使用，关闭时可能由主线程统一关闭
+        check_same_thread=False,
+    )
+    conn.row_factory = sqlite3.Row
+
+    pragmas = [
+        f"PRAGMA journal_mode = {config.get('database.journal_mode', 'WAL')}",
+        f"PRAGMA synchronous = {config.get('database.synchronous', 'NORMAL')}",
+        f"PRAGMA busy_timeout = {busy_timeout_ms}",
+        f"PRAGMA cache_size = {-int(config.get('database.cache_size_kb', 20000))}",
+        f"PRAGMA mmap_size = {int(config.get('database.mmap_size', 268435456))}",
+        f"PRAGMA temp_store = {config.get('database.temp_store', 'MEMORY')}",
+    ]
+    if getattr(_local, "readonly", False):
+        # 分析查询线程只读，防止误写并让SQLite跳过写锁
+        pragmas.append("PRAGMA query_only = ON")
+    for pragma in pragmas:
+        conn.execute(pragma)
+
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
+
+def _get_thread_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    key = (DATABASE_URL, _generation)
+    if conn is None or getattr(_local, "key", None) != key:
+        if conn is not None:
+            _discard(conn)
+        conn = _connect()
+        _local.conn = conn
+        _local.key = key
+    return conn
+
+def _discard(conn: sqlite3.Connection) -> None:
+    with _connections_lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    try:
+        conn.close()
+    except sqlite3.Error:
+        pass
+    if getattr(_local, "conn", None) is conn:
+        _local.conn = None
+
 @contextmanager
 def get_db_connection():
-    """提供一个数据库连接的上下文管理器，确保连接在使用后关闭。"""
+    """
+    提供当前线程复用的数据库连接。
+    连接不会在使用后关闭；退出时如果还有未提交的事务会被回滚，与关闭连接时的行为一致。
+    """
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_URL)
-        conn.row_factory = sqlite3.Row
+        conn = _get_thread_connection()
         yield conn
     except sqlite3.Error as e:
         logger.error(f"数据库连接错误: {e}")
+        if conn is not None:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                # 连接已不可用，丢弃后下次重新创建
+                _discard(conn)
         raise
-    finally:
-        if conn:
+    except BaseException:
+        if conn is not None:
+            conn.rollback()
+        raise
+    else:
+        if conn.in_transaction:
+            conn.rollback()
+
+def close_all_connections() -> None:
+    """关闭所有线程的数据库连接，在服务关闭时调用。"""
+    global _generation
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in connections:
+        try:
             conn.close()
+        except sqlite3.Error:
+            pass
+    _local.conn = None
+
+# --- 异步访问：在专用线程池中执行同步的CRUD函数 ---
+
+# writer: 单线程，串行执行所有写操作，避免写锁竞争
+# reader: 代理热路径上的短查询
+# analytics: 管理后台的慢查询，使用独立的只读连接，不会占用热路径的线程
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+def _mark_readonly() -> None:
+    _local.readonly = True
+
+def _get_executor(kind: str) -> ThreadPoolExecutor:
+    executor = _executors.get(kind)
+    if executor is not None:
+        return executor
+    with _executors_lock:
+        executor = _executors.get(kind)
+        if executor is None:
+            if kind == "writer":
+                executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+            elif kind == "reader":
+                executor = ThreadPoolExecutor(
+                    max_workers=int(config.get('database.reader_threads', 4)),
+                    thread_name_prefix="db-reader",
+                )
+            else:
+                executor = ThreadPoolExecutor(
+                    max_workers=int(config.get('database.analytics_threads', 2)),
+                    thread_name_prefix="db-analytics",
+                    initializer=_mark_readonly,
+                )
+            _executors[kind] = executor
+    return executor
+
+async def _run(kind: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(kind), functools.partial(fn, *args, **kwargs))
+
+async def run_write(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """在单线程写入池中执行fn。"""
+    return await _run("writer", fn, *args, **kwargs)
+
+async def run_read(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """在热路径读取池中执行fn。"""
+    return await _run("reader", fn, *args, **kwargs)
+
+async def run_analytics(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """在只读的分析查询池中执行fn。"""
+    return await _run("analytics", fn, *args, **kwargs)
+
+def shutdown_executors() -> None:
+    """等待所有数据库线程池中的任务完成并关闭线程池。"""
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=True)
+
+def enable_incremental_vacuum(conn: sqlite3.Connection) -> None:
+    """
+    把数据库切换为auto_vacuum=INCREMENTAL，之后删除记录释放的页可以用 PRAGMA incremental_vacuum 逐步归还。
+    已有数据的数据库需要执行一次完整的VACUUM，期间会锁住整个数据库。
+    """
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
 
 def init_db():
-    """初始化数据库，创建所有必要的表。"""
+    """初始化数据库，按版本执行所有尚未执行的结构迁移。"""
     logger.info("正在初始化数据库...")
     try:
         with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # API Keys表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS api_keys (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    key_name TEXT NOT NULL,
-                    api_key TEXT NOT NULL UNIQUE,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_used TIMESTAMP,
-                    usage_count INTEGER DEFAULT 0,
-                    daily_limit INTEGER DEFAULT -1,
-                    daily_usage INTEGER DEFAULT 0,
-                    last_reset_time TIMESTAMP
-                )
-            ''')
-            
-            # 使用记录表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS usage_logs (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    api_key_id INTEGER,
-                    model TEXT,
-                    prompt_tokens INTEGER,
-                    completion_tokens INTEGER,
-                    total_tokens INTEGER,
-                    cost REAL,
-                    request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    response_status INTEGER,
-                    FOREIGN KEY (api_key_id) REFERENCES api_keys (id)
-                )
-            ''')
-            
-            # 免费模型表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS free_models (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    model_id TEXT UNIQUE NOT NULL,
-                    model_name TEXT NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    context_length INTEGER,
-                    parameters TEXT
-                )
-            ''')
-            
-            # 为现有表添加新字段（如果不存在）
-            try:
-                cursor.execute('ALTER TABLE free_models ADD COLUMN context_length INTEGER')
-            except sqlite3.OperationalError:
-                pass  # 字段已存在
-            
-            try:
-                cursor.execute('ALTER TABLE free_models ADD COLUMN parameters TEXT')
-            except sqlite3.OperationalError:
-                pass  # 字段已存在
-            
-            conn.commit()
-        logger.info("✅ 数据库初始化成功。")
+            if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0] == 0:
+                # 新建的空数据库，VACUUM没有代价
+                enable_incremental_vacuum(conn)
+            version = apply_migrations(conn)
+        logger.info(f"✅ 数据库初始化成功，当前结构版本: {version}。")
     except sqlite3.Error as e:
         logger.error(f"❌ 数据库初始化失败: {e}")
         raise
@@ -0,0 +1,185 @@
+import sqlite3
+import logging
+from typing import Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 数据库结构版本保存在 PRAGMA user_version 中，每个迁移只会执行一次。
+# 新的结构变更只需要在 MIGRATIONS 末尾追加一项，不要修改已经发布的迁移。
+
+def _columns(cursor: sqlite3.Cursor, table: str) -> List[str]:
+    cursor.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in cursor.fetchall()]
+
+def _add_column_if_missing(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> None:
+    if column not in _columns(cursor, table):
+        logger.info(f"为 {table} 添加字段 {column}")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def _001_base_schema(cursor: sqlite3.Cursor) -> None:
+    """基础表结构，兼容在引入版本号之前创建的旧数据库。"""
+    # API Keys表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key_name TEXT NOT NULL,
+            api_key TEXT NOT NULL UNIQUE,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used TIMESTAMP,
+            usage_count INTEGER DEFAULT 0,
+            daily_limit INTEGER DEFAULT -1,
+            daily_usage INTEGER DEFAULT 0,
+            last_reset_time TIMESTAMP
+        )
+    ''')
+
+    # 使用记录表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS usage_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_key_id INTEGER,
+            model TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            total_tokens INTEGER,
+            cost REAL,
+            request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            response_status INTEGER,
+            FOREIGN KEY (api_key_id) REFERENCES api_keys (id)
+        )
+    ''')
+
+    # 免费模型表
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS free_models (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            model_id TEXT UNIQUE NOT NULL,
+            model_name TEXT NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            context_length INTEGER,
+            parameters TEXT
+        )
+    ''')
+
+    # 旧版本数据库缺少的字段（原 migrate_db.py 和 init_db 中的 ALTER TABLE）
+    _add_column_if_missing(cursor, "api_keys", "daily_limit", "INTEGER DEFAULT 500")
+    _add_column_if_missing(cursor, "api_keys", "daily_usage", "INTEGER DEFAULT 0")
+    _add_column_if_missing(cursor, "api_keys", "last_reset_time", "TIMESTAMP")
+    cursor.execute("UPDATE api_keys SET daily_limit = 500 WHERE daily_limit IS NULL")
+    _add_column_if_missing(cursor, "free_models", "context_length", "INTEGER")
+    _add_column_if_missing(cursor, "free_models", "parameters", "TEXT")
+
+def _002_usage_log_indexes(cursor: sqlite3.Cursor) -> None:
+    """usage_logs的查询索引：按时间分页/统计、按Key、按模型和按状态筛选。"""
+    # 覆盖今日统计（COUNT/SUM(total_tokens)/COUNT(DISTINCT model)）的时间范围查询
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_request_time ON usage_logs (request_time, model, total_tokens)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_key_time ON usage_logs (api_key_id, request_time)")
+    # 覆盖按模型分组统计和 SELECT DISTINCT model
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_model_time ON usage_logs (model, request_time, total_tokens)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_status ON usage_logs (response_status)")
+
+ROLLUP_TABLES = {
+    # 表名: 把request_time截断到桶的strftime格式
+    "usage_rollup_hourly": "%Y-%m-%d %H:00:00",
+    "usage_rollup_daily": "%Y-%m-%d",
+}
+
+def backfill_rollups(cursor: sqlite3.Cursor) -> None:
+    """
+    根据usage_logs中的原始记录重新计算所有汇总表。
+    已经归档并从usage_logs删除的记录不在原始表中，重新计算会丢失这部分历史，启用归档后不要随意调用。
+    """
+    for table, bucket_format in ROLLUP_TABLES.items():
+        cursor.execute(f"DELETE FROM {table}")
+        cursor.execute(f'''
+            INSERT INTO {table} (bucket, api_key_id, model, status_class, request_count, prompt_tokens, completion_tokens, total_tokens)
+            SELECT strftime('{bucket_format}', request_time), COALESCE(api_key_id, 0), COALESCE(model, ''),
+                   COALESCE(response_status, 0) / 100, COUNT(*),
+                   SUM(COALESCE(prompt_tokens, 0)), SUM(COALESCE(completion_tokens, 0)), SUM(COALESCE(total_tokens, 0))
+            FROM usage_logs
+            GROUP BY 1, 2, 3, 4
+        ''')
+
+def _003_usage_rollups(cursor: sqlite3.Cursor) -> None:
+    """按（时间桶，Key，模型，状态类别）预聚合的小时/天汇总表，并从已有记录回填。"""
+    for table in ROLLUP_TABLES:
+        # 没有Key的记录api_key_id为0，状态类别为 response_status // 100
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TEXT NOT NULL,
+                api_key_id INTEGER NOT NULL,
+                model TEXT NOT NULL,
+                status_class INTEGER NOT NULL,
+                request_count INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                total_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, api_key_id, model, status_class)
+            ) WITHOUT ROWID
+        ''')
+    backfill_rollups(cursor)
+
+def _004_usage_log_keyset_indexes(cursor: sqlite3.Cursor) -> None:
+    """按 (request_time, id) 键集分页的索引，ORDER BY request_time DESC, id DESC 不需要临时排序。"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_time_id ON usage_logs (request_time, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_usage_logs_model_time_id ON usage_logs (model, request_time, id)")
+
+def _005_estimated_prompt_tokens(cursor: sqlite3.Cursor) -> None:
+    """记录请求开始时估算的输入token数，用于和上游返回的usage比较估算误差。"""
+    _add_column_if_missing(cursor, "usage_logs", "estimated_prompt_tokens", "INTEGER")
+
+def _006_free_model_created(cursor: sqlite3.Cursor) -> None:
+    """保存上游模型的创建时间，/v1/models 返回稳定的created字段。"""
+    _add_column_if_missing(cursor, "free_models", "created", "INTEGER")
+
+def _007_free_model_parameter_count(cursor: sqlite3.Cursor) -> None:
+    """保存从描述中提取的参数个数，按数值比较和排序模型。"""
+    _add_column_if_missing(cursor, "free_models", "parameter_count", "INTEGER")
+
+def _008_response_cache(cursor: sqlite3.Cursor) -> None:
+    """响应缓存的SQLite层：按缓存键保存上游的原始响应体，按写入时间淘汰。"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            body BLOB NOT NULL,
+            usage TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache (created_at)")
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Cursor], None]]] = [
+    (1, "base schema", _001_base_schema),
+    (2, "usage_logs indexes", _002_usage_log_indexes),
+    (3, "usage rollup tables", _003_usage_rollups),
+    (4, "usage_logs keyset pagination indexes", _004_usage_log_keyset_indexes),
+    (5, "usage_logs estimated_prompt_tokens", _005_estimated_prompt_tokens),
+    (6, "free_models created", _006_free_model_created),
+    (7, "free_models parameter_count", _007_free_model_parameter_count),
+    (8, "response cache", _008_response_cache),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn: sqlite3.Connection) -> int:
+    """按顺序执行所有尚未执行的迁移，返回迁移后的结构版本。"""
+    current = get_schema_version(conn)
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"🔧 执行数据库迁移 {version}: {description}")
+        try:
+            conn.execute("BEGIN")
+            migrate(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.error(f"❌ 数据库迁移 {version} 失败，已回滚。")
+            raise
+        current = version
+    return current
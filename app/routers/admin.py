@@ -1,10 +1,22 @@
+from datetime import date
+from typing import Optional
+
 from fastapi import APIRouter, Depends, HTTPException, Form, Request
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.templating import Jinja2Templates
 
-from app import crud
+from app import async_crud
+from app.services.admission import admission_controller
+from app.services.http_client import upstream_http
+from app.services.key_manager import key_manager, STRATEGIES
+from app.services.log_count_cache import usage_log_counts
+from app.services.model_refresher import model_refresher
+from app.services.model_registry import model_registry
 from app.services.openrouter_client import openrouter_client
+from app.services.response_cache import response_cache
+from app.services.retention import retention_manager
+from app.services.usage_writer import usage_writer
 from config import config
 
 router = APIRouter()
@@ -36,20 +48,32 @@ async def admin_login(password: str = Form(...)):
 @router.get("/admin/stats", dependencies=[Depends(get_admin_user)])
 async def get_stats():
     """获取仪表盘的统计数据。"""
-    key_stats = crud.get_api_key_stats()
-    today_stats = crud.get_today_stats()
-    model_stats = crud.get_model_stats()
+    # 先写入队列中的使用记录和Key计数，保证看到的是最新数据
+    await usage_writer.flush()
+    key_stats = await async_crud.get_api_key_stats()
+    for key in key_stats:
+        key["health"] = key_manager.key_health(key["id"])
+    today_stats = await async_crud.get_today_stats()
+    model_stats = await async_crud.get_model_stats()
     return {
         "key_stats": key_stats,
         "today_stats": today_stats,
         "model_stats": model_stats
     }
 
+@router.get("/admin/stats/hourly", dependencies=[Depends(get_admin_user)])
+async def get_hourly_stats(hours: int = 24):
+    """获取最近若干小时的每小时统计数据。"""
+    hours = max(1, min(hours, 24 * 31))
+    await usage_writer.flush()
+    return {"hourly_stats": await async_crud.get_hourly_stats(hours)}
+
 @router.post("/admin/keys", dependencies=[Depends(get_admin_user)])
 async def add_api_key(key_name: str = Form(...), api_key: str = Form(...), daily_limit: int = Form(-1)):
     """添加一个新的API Key。"""
     try:
-        crud.add_api_key(key_name, api_key, daily_limit)
+        await async_crud.add_api_key(key_name, api_key, daily_limit)
+        await key_manager.invalidate()
         return {"success": True, "message": "API Key添加成功"}
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"添加失败: {e}")
@@ -57,13 +81,15 @@ async def add_api_key(key_name: str = Form(...), api_key: str = Form(...), daily
 @router.delete("/admin/keys/{key_id}", dependencies=[Depends(get_admin_user)])
 async def delete_api_key(key_id: int):
     """删除一个API Key。"""
-    crud.delete_api_key(key_id)
+    await async_crud.delete_api_key(key_id)
+    await key_manager.invalidate()
     return {"success": True, "message": "API Key删除成功"}
 
 @router.put("/admin/keys/{key_id}", dependencies=[Depends(get_admin_user)])
 async def update_api_key(key_id: int, key_name: str = Form(...), daily_limit: int = Form(...), is_active: bool = Form(...)):
     """更新一个API Key。"""
-    crud.update_api_key(key_id, key_name, daily_limit, is_active)
+    await async_crud.update_api_key(key_id, key_name, daily_limit, is_active)
+    await key_manager.invalidate()
     return {"success": True, "message": "API Key更新成功"}
 
 @router.post("/admin/refresh-models", dependencies=[Depends(get_admin_user)])
@@ -71,18 +97,32 @@ async def refresh_free_models():
     """手动刷新免费模型列表。"""
     try:
         count = await openrouter_client.update_free_models_cache()
-        return {"success": True, "message": f"成功更新 {count} 个免费模型"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"更新失败: {e}")
+    if count is None:
+        raise HTTPException(status_code=502, detail="更新失败: 无法从OpenRouter获取模型列表")
+    return {"success": True, "message": f"成功更新 {count} 个免费模型"}
 
 @router.get("/admin/usage-logs", dependencies=[Depends(get_admin_user)])
-async def get_usage_logs(page: int = 1, page_size: int = 50, key_filter: str = "", model_filter: str = "", status_filter: str = "", date_filter: str = ""):
-    """获取详细的调用记录。"""
-    result = crud.get_usage_logs(page, page_size, key_filter=key_filter, model_filter=model_filter, status_filter=status_filter, date_filter=date_filter)
+async def get_usage_logs(page: int = 1, page_size: int = 50, cursor: str = "", key_filter: str = "", model_filter: str = "", status_filter: str = "", date_filter: str = ""):
+    """
+    获取详细的调用记录。
+    传入上一页返回的cursor时按游标读取下一页（不受页码深度影响），否则按page分页。
+    total_records来自定期在后台刷新的缓存计数，可能略微落后于实际记录数。
+    """
+    page_size = max(1, min(page_size, 500))
+    filters = dict(key_filter=key_filter, model_filter=model_filter, status_filter=status_filter, date_filter=date_filter)
+    try:
+        result = await async_crud.get_usage_logs(page, page_size, cursor or None, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    count = await usage_log_counts.get(**filters)
     return {
         "logs": result["logs"],
-        "total_records": result["total_records"],
-        "total_pages": result["total_pages"],
+        "next_cursor": result["next_cursor"],
+        "total_records": count["total"],
+        "total_pages": (count["total"] + page_size - 1) // page_size,
+        "count_age_seconds": count["age"],
         "current_page": page,
         "page_size": page_size
     }
@@ -90,10 +130,79 @@ async def get_usage_logs(page: int = 1, page_size: int = 50, key_filter: str = "
 @router.get("/admin/filter-options", dependencies=[Depends(get_admin_user)])
 async def get_filter_options():
     """获取筛选选项数据。"""
-    return crud.get_filter_options()
+    return await async_crud.get_filter_options()
 
 @router.get("/admin/free-models", dependencies=[Depends(get_admin_user)])
 async def get_free_models_list():
     """获取当前免费模型列表。"""
-    models = crud.get_all_free_models_with_status()
-    return {"models": models}
\ No newline at end of file
+    return {"models": model_registry.all_models(), "refresh": model_refresher.stats()}
+
+@router.get("/admin/http-pool", dependencies=[Depends(get_admin_user)])
+async def get_http_pool_stats():
+    """获取上游HTTP连接池的使用情况。"""
+    return upstream_http.pool_stats()
+
+@router.get("/admin/admission", dependencies=[Depends(get_admin_user)])
+async def get_admission_stats():
+    """获取准入控制的并发数、等待队列和拒绝次数。"""
+    return admission_controller.stats()
+
+@router.get("/admin/response-cache", dependencies=[Depends(get_admin_user)])
+async def get_response_cache_stats():
+    """获取响应缓存的条目数、占用大小和命中次数。"""
+    return response_cache.stats()
+
+@router.delete("/admin/response-cache", dependencies=[Depends(get_admin_user)])
+async def clear_response_cache():
+    """清空响应缓存。"""
+    await response_cache.clear()
+    return {"success": True, "message": "响应缓存已清空"}
+
+@router.get("/admin/load-balance", dependencies=[Depends(get_admin_user)])
+async def get_load_balance_strategy():
+    """获取当前的负载均衡策略和可选策略。"""
+    return {"strategy": key_manager.strategy_name, "available": list(STRATEGIES)}
+
+@router.put("/admin/load-balance", dependencies=[Depends(get_admin_user)])
+async def set_load_balance_strategy(strategy: str = Form(...)):
+    """在运行时切换负载均衡策略（不写回config.json）。"""
+    try:
+        key_manager.set_strategy(strategy)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "message": f"负载均衡策略已切换为 {strategy}"}
+
+@router.get("/admin/usage-writer", dependencies=[Depends(get_admin_user)])
+async def get_usage_writer_stats():
+    """获取使用记录写入队列的深度和写入延迟。"""
+    return usage_writer.stats()
+
+@router.get("/admin/retention", dependencies=[Depends(get_admin_user)])
+async def get_retention_status():
+    """获取使用记录保留策略的配置、执行进度和数据库空间使用情况。"""
+    return await retention_manager.status()
+
+@router.post("/admin/retention/run", dependencies=[Depends(get_admin_user)])
+async def run_retention(retention_days: Optional[int] = Form(None)):
+    """立即在后台执行一次归档，进度通过 GET /admin/retention 查看。"""
+    if retention_days is not None and retention_days < 1:
+        raise HTTPException(status_code=400, detail="retention_days 必须大于0")
+    if not retention_manager.trigger(retention_days):
+        raise HTTPException(status_code=409, detail="归档任务正在执行中")
+    return {"success": True, "message": "归档任务已开始"}
+
+@router.get("/admin/archive/partitions", dependencies=[Depends(get_admin_user)])
+async def get_archive_partitions():
+    """列出已归档的日期分区。"""
+    return {"partitions": await retention_manager.partitions()}
+
+@router.get("/admin/archive/usage-logs", dependencies=[Depends(get_admin_user)])
+async def get_archived_usage_logs(start_date: str, end_date: str, limit: int = 1000, key_filter: str = "", model_filter: str = "", status_filter: str = ""):
+    """只读查询已归档的调用记录，按时间顺序返回 [start_date, end_date] 内的记录。"""
+    try:
+        if date.fromisoformat(start_date) > date.fromisoformat(end_date):
+            raise ValueError("start_date 不能晚于 end_date")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"日期格式错误: {e}")
+    limit = max(1, min(limit, 10000))
+    return await retention_manager.query_archive(start_date, end_date, limit, key_filter=key_filter, model_filter=model_filter, status_filter=status_filter)
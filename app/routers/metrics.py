@@ -0,0 +1,66 @@
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import Response
+
+from app.routers.proxy import authenticate
+from app.services.admission import admission_controller
+from app.services.http_client import upstream_http
+from app.services.key_manager import key_manager
+from app.services.metrics import metrics
+from app.services.tokenizer import tokenizer
+from app.services.usage_writer import usage_writer
+from config import config
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+router = APIRouter()
+
+def collect_runtime():
+    """抓取时读取连接池、Key池、准入队列、写入队列和tokenizer缓存的当前状态。"""
+    pool = upstream_http.pool_stats()
+    yield "openrouter_proxy_upstream_connections", "上游HTTP连接池中的连接数", "gauge", [
+        ({"state": "in_use"}, pool["in_use"]),
+        ({"state": "idle"}, pool["idle"]),
+        ({"state": "waiting"}, pool["waiting"]),
+    ]
+    yield "openrouter_proxy_upstream_connections_max", "上游HTTP连接池的连接数上限", "gauge", [({}, pool["max_connections"])]
+
+    keys = key_manager.pool_stats()
+    yield "openrouter_proxy_keys", "激活的API Key数量（按熔断状态）", "gauge", [
+        ({"circuit": state}, count) for state, count in keys["circuits"].items()
+    ]
+    yield "openrouter_proxy_keys_available", "当前可以被挑选的API Key数量", "gauge", [({}, keys["available"])]
+    yield "openrouter_proxy_keys_exhausted", "今日额度已用完的API Key数量", "gauge", [({}, keys["exhausted"])]
+    yield "openrouter_proxy_key_inflight", "所有Key上进行中的上游请求数", "gauge", [({}, keys["inflight"])]
+
+    admission = admission_controller.stats()
+    yield "openrouter_proxy_admission_inflight", "已准入且尚未结束的请求数", "gauge", [({}, admission["inflight"])]
+    yield "openrouter_proxy_admission_queue_length", "等待准入的请求数", "gauge", [({}, admission["queue_length"])]
+    yield "openrouter_proxy_admission_rejected_total", "未被准入的请求数", "counter", [
+        ({"reason": "queue_full"}, admission["rejected_queue_full"]),
+        ({"reason": "timeout"}, admission["rejected_timeout"]),
+    ]
+
+    writer = usage_writer.stats()
+    yield "openrouter_proxy_usage_queue_depth", "等待写入数据库的使用记录数", "gauge", [({}, writer["queue_depth"])]
+    yield "openrouter_proxy_usage_overflow_depth", "队列已满时暂存在溢出列表中的使用记录数", "gauge", [({}, writer["overflow_depth"])]
+    yield "openrouter_proxy_usage_dropped_total", "队列和溢出列表都已满时丢弃的使用记录数", "counter", [({}, writer["dropped"])]
+
+    tokens = tokenizer.stats()
+    yield "openrouter_proxy_tokenizer_cache_lookups_total", "tokenizer计数缓存的查询次数", "counter", [
+        ({"result": "hit"}, tokens["hits"]),
+        ({"result": "miss"}, tokens["misses"]),
+    ]
+    yield "openrouter_proxy_tokenizer_offloaded_total", "在线程池中编码的长文本数", "counter", [({}, tokens["offloaded"])]
+    yield "openrouter_proxy_tokenizer_cache_entries", "tokenizer计数缓存中的条目数", "gauge", [({}, tokens["cache_entries"])]
+
+metrics.register_collector(collect_runtime)
+
+async def _authorize(request: Request):
+    """metrics.require_auth 为true时，与代理接口一样要求Bearer Token。"""
+    if config.get('metrics.require_auth', False):
+        await authenticate(request)
+
+@router.get("/metrics", dependencies=[Depends(_authorize)], include_in_schema=False)
+async def get_metrics():
+    """以Prometheus文本格式导出指标。"""
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
@@ -1,53 +1,26 @@
-import time
-import httpx
-import tiktoken
+import math
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
-from app import crud
+from app.services.admission import admission_controller, AdmissionRejected
 from app.services.key_manager import key_manager
+from app.services.model_registry import model_registry
 from app.services.openrouter_client import openrouter_client
+from app.services.response_cache import response_cache, CACHE_HIT_STATUS
+from app.services.sse import frame_transcript
+from app.services.token_accounting import token_accountant
 from config import config
 
-def estimate_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
-    """估算文本的token数量"""
-    try:
-        # 尝试获取模型对应的编码器
-        if "gpt-4" in model.lower():
-            encoding = tiktoken.encoding_for_model("gpt-4")
-        elif "gpt-3.5" in model.lower():
-            encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        else:
-            # 对于其他模型，使用cl100k_base编码器作为近似
-            encoding = tiktoken.get_encoding("cl100k_base")
-        
-        return len(encoding.encode(text))
-    except Exception:
-        # 如果编码失败，使用简单的字符数估算（通常1个token约等于4个字符）
-        return len(text) // 4
-
-def calculate_max_tokens(messages: list, model: str) -> int:
-    """根据输入消息和模型计算合理的max_tokens值"""
-    # 首先尝试从数据库获取模型的上下文长度
-    context_limit = crud.get_model_context_length(model)
+def calculate_max_tokens(total_input_tokens: int, model: str) -> int:
+    """根据输入token数和模型上下文长度计算合理的max_tokens值"""
+    # 首先尝试从内存中的模型表获取模型的上下文长度
+    context_limit = model_registry.context_length(model)
     
-    # 如果数据库中没有找到，使用默认值
+    # 如果没有找到，使用默认值
     if context_limit is None:
         context_limit = 4096
     
-    # 计算输入消息的总token数
-    total_input_tokens = 0
-    for message in messages:
-        content = message.get("content", "")
-        if isinstance(content, str):
-            total_input_tokens += estimate_tokens(content, model)
-        elif isinstance(content, list):
-            # 处理多模态内容
-            for item in content:
-                if isinstance(item, dict) and item.get("type") == "text":
-                    total_input_tokens += estimate_tokens(item.get("text", ""), model)
-    
     # 预留一些token用于系统消息和格式化
     reserved_tokens = 100
     available_tokens = context_limit - total_input_tokens - reserved_tokens
@@ -63,6 +36,29 @@ def calculate_max_tokens(messages: list, model: str) -> int:
 router = APIRouter()
 security = HTTPBearer()
 
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
+    "Access-Control-Allow-Headers": "*",
+}
+
+class ChatStreamResponse(StreamingResponse):
+    """
+    转发上游流式响应的StreamingResponse。
+    响应结束后总是关闭 ChatStream，客户端在第一个字节之前断开时同样归还准入名额和Key。
+    """
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.body_iterator.aclose()
+
+async def replay_stream(transcript: bytes):
+    """把缓存的事件记录作为一个完整的SSE响应体发送。"""
+    yield frame_transcript(transcript)
+
 def verify_access_token(token: str) -> bool:
     """验证访问令牌是否有效。"""
     return token == config.get('admin.password')
@@ -88,99 +84,122 @@ async def chat_completions(request: Request):
         model = body.get("model", "")
         
         # 验证模型是否在允许的免费模型列表中
-        if model not in crud.get_free_models():
+        if not model_registry.is_allowed(model):
             raise HTTPException(
                 status_code=400,
                 detail=config.get('messages.model_not_allowed_error', "模型 '{model}' 不被允许。只支持免费模型。").format(model=model)
             )
 
-        # 如果请求中没有指定max_tokens，则根据模型上下文长度动态计算
-        if "max_tokens" not in body or body["max_tokens"] is None:
-            messages = body.get("messages", [])
-            calculated_max_tokens = calculate_max_tokens(messages, model)
-            body["max_tokens"] = calculated_max_tokens
-
-        # 获取下一个可用的API Key
-        api_key_info = key_manager.get_next_key()
-        if not api_key_info:
-            raise HTTPException(status_code=503, detail=config.get('messages.no_available_key_error', "没有可用的API Key"))
-
-        # 准备请求头
-        headers = {
-            "Authorization": f"Bearer {api_key_info['api_key']}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": config.get('openrouter.http_referer'),
-            "X-Title": config.get('openrouter.x_title')
-        }
-        
         stream = body.get("stream", False)
-        if stream:
-            # 确保流式请求包含usage信息
-            if "stream_options" not in body:
-                body["stream_options"] = {}
-            body["stream_options"]["include_usage"] = True
-            
-            # 添加适当的响应头
-            return StreamingResponse(
-                openrouter_client.stream_chat_completions(body, headers, api_key_info, model),
-                media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "Access-Control-Allow-Origin": "*",
-                    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS",
-                    "Access-Control-Allow-Headers": "*",
-                }
+        # 确定性的请求先查响应缓存，命中时不占用准入名额和Key额度
+        cache_key = None
+        cache_status = None
+        if response_cache.enabled:
+            if response_cache.bypassed(request.headers):
+                cache_status = "BYPASS"
+            else:
+                cache_key = response_cache.cache_key(body)
+        if cache_key is not None:
+            cached = await response_cache.get(cache_key)
+            if cached is not None:
+                token_accountant.record(None, model, CACHE_HIT_STATUS, cached.usage, None)
+                if stream:
+                    return StreamingResponse(replay_stream(cached.body), media_type="text/event-stream", headers={**SSE_HEADERS, "X-Cache": "HIT"})
+                return Response(content=cached.body, media_type="application/json", headers={"X-Cache": "HIT"})
+            cache_status = "MISS"
+
+        # 准入控制：并发超过上限的请求排队等待，队列已满或等待超时时拒绝
+        try:
+            ticket = await admission_controller.admit(model)
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=e.status_code,
+                detail=config.get('messages.admission_rejected_error', "服务繁忙（{reason}），请稍后重试").format(reason=e.reason),
+                headers={"Retry-After": str(e.retry_after)},
             )
-        else:
-            async with httpx.AsyncClient(timeout=config.get('openrouter.request_timeout', 60.0)) as client:
-                response = await client.post(
-                    f"{config.get('openrouter.base_url')}/chat/completions",
-                    json=body,
-                    headers=headers
+
+        # 流式响应把名额交给响应生成器，在流结束时归还
+        handed_off = False
+        try:
+            # 每个请求只计算一次输入token数，用于max_tokens和使用记录
+            prompt = await token_accountant.count_prompt(body.get("messages", []), model)
+
+            # 如果请求中没有指定max_tokens，则根据模型上下文长度动态计算
+            if "max_tokens" not in body or body["max_tokens"] is None:
+                calculated_max_tokens = calculate_max_tokens(prompt.tokens, model)
+                body["max_tokens"] = calculated_max_tokens
+
+            # 获取下一个可用的API Key，所有Key的并发都已满时排队等待
+            api_key_info = await key_manager.acquire_key(model)
+            if not api_key_info:
+                # 所有Key都在熔断、限流中或并发已满时，告诉客户端大约多久后可以重试
+                retry_after = key_manager.retry_after(model, admission_controller.avg_request_seconds)
+                raise HTTPException(
+                    status_code=503,
+                    detail=config.get('messages.no_available_key_error', "没有可用的API Key"),
+                    headers={"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after is not None else None,
                 )
+
+            if stream:
+                # 确保流式请求包含usage信息
+                if "stream_options" not in body:
+                    body["stream_options"] = {}
+                body["stream_options"]["include_usage"] = True
             
-            key_manager.update_key_usage(api_key_info['id'])
-            
-            try:
-                response_data = response.json()
-            except Exception:
-                response_data = {"error": response.text}
-            
-            usage = response_data.get("usage", {}) if response.status_code == 200 else {}
-            crud.log_usage(
-                api_key_id=api_key_info['id'],
-                model=model,
-                prompt_tokens=usage.get("prompt_tokens", 0),
-                completion_tokens=usage.get("completion_tokens", 0),
-                total_tokens=usage.get("total_tokens", 0),
-                cost=0.0,
-                status=response.status_code
-            )
+                # 添加适当的响应头
+                handed_off = True
+                return ChatStreamResponse(
+                    openrouter_client.stream_chat_completions(body, api_key_info, model, prompt, ticket, cache_key),
+                    media_type="text/event-stream",
+                    headers={**SSE_HEADERS, "X-Cache": cache_status} if cache_status else SSE_HEADERS,
+                )
+            else:
+                # 在读取响应体之前，失败的Key会故障转移到其它Key
+                attempt = await openrouter_client.send_chat_completion(api_key_info, body, model, prompt)
+                response = attempt.response
+                try:
+                    await response.aread()
+                finally:
+                    await response.aclose()
+                    key_manager.release_key(attempt.key['id'], attempt.latency)
             
-            return JSONResponse(content=response_data, status_code=response.status_code)
+                try:
+                    response_data = response.json()
+                except Exception:
+                    response_data = {"error": response.text}
             
+                completion_text = None
+                usage = None
+                if response.status_code == 200:
+                    usage = response_data.get("usage")
+                    if not usage:
+                        # 没有usage时按返回的内容计算token数
+                        try:
+                            completion_text = response_data["choices"][0]["message"].get("content") or ""
+                        except (KeyError, IndexError, TypeError, AttributeError):
+                            completion_text = ""
+                token_accountant.record(attempt.key['id'], model, response.status_code, usage, prompt, completion_text)
+                if cache_key is not None and response.status_code == 200 and "choices" in response_data:
+                    response_cache.put(cache_key, response.content, usage)
+
+                headers = {"X-Cache": cache_status} if cache_status else None
+                return JSONResponse(content=response_data, status_code=response.status_code, headers=headers)
+        finally:
+            if not handed_off:
+                ticket.release()
+
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=config.get('messages.internal_server_error', "内部服务器错误: {e}").format(e=e))
 
 @router.get("/v1/models", dependencies=[Depends(authenticate)])
-async def get_models():
+async def get_models(request: Request):
     """
     获取可用的免费模型列表。
+    响应体在每次刷新模型表时序列化一次，客户端带上If-None-Match时可能返回304。
     """
-    free_models = crud.get_free_models()
-    models_data = {
-        "object": "list",
-        "data": [
-            {
-                "id": model_id,
-                "object": "model",
-                "created": int(time.time()),
-                "owned_by": "openrouter"
-            }
-            for model_id in free_models
-        ]
-    }
-    return models_data
\ No newline at end of file
+    body, etag = model_registry.models_response()
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
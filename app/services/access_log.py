@@ -0,0 +1,109 @@
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from config import config
+
+ACCESS_LOGGER_NAME = "access"
+
+class AccessLog:
+    """
+    结构化访问日志的输出通道。
+
+    中间件只把日志记录放入内存队列（QueueHandler），由QueueListener的后台线程写到标准错误或 access_log.file，
+    事件循环不会因为日志输出而阻塞。
+    """
+    def __init__(self):
+        self.logger = logging.getLogger(ACCESS_LOGGER_NAME)
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self._listener: Optional[QueueListener] = None
+        self._handler: Optional[QueueHandler] = None
+
+    def start(self) -> None:
+        if self._listener is not None:
+            return
+        path = config.get('access_log.file')
+        target = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler(sys.stderr)
+        target.setFormatter(logging.Formatter("%(message)s"))
+        log_queue = queue.SimpleQueue()
+        self._handler = QueueHandler(log_queue)
+        self.logger.addHandler(self._handler)
+        self._listener = QueueListener(log_queue, target)
+        self._listener.start()
+
+    def stop(self) -> None:
+        """写完队列中剩余的日志后停止后台线程。"""
+        if self._listener is None:
+            return
+        self.logger.removeHandler(self._handler)
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+        self._handler = None
+
+    @property
+    def running(self) -> bool:
+        return self._listener is not None
+
+class AccessLogMiddleware:
+    """
+    纯ASGI的访问日志中间件，在响应结束后为每个请求输出一行JSON。
+
+    不包装请求和响应对象，流式响应的每个分块直接透传，只累计字节数。
+    成功且不慢的请求按 access_log.sample_rate 采样；状态码不小于400或耗时超过 slow_request_seconds 的请求总是记录。
+    """
+    def __init__(self, app):
+        self.app = app
+        self._sample_rate = config.get('access_log.sample_rate', 1.0)
+        self._slow_seconds = config.get('access_log.slow_request_seconds', 5.0)
+        self._exclude = frozenset(config.get('access_log.exclude_paths', ["/metrics"]))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not access_log.running or scope["path"] in self._exclude:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        first_byte = None
+        size = 0
+
+        async def send_with_stats(message):
+            nonlocal status, first_byte, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if body and first_byte is None:
+                    first_byte = time.perf_counter()
+                size += len(body)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_stats)
+        finally:
+            duration = time.perf_counter() - start
+            if status >= 400 or duration >= self._slow_seconds or self._sample_rate >= 1 or random.random() < self._sample_rate:
+                client = scope.get("client")
+                access_log.logger.info(json.dumps({
+                    "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 2),
+                    "ttfb_ms": round((first_byte - start) * 1000, 2) if first_byte is not None else None,
+                    "bytes": size,
+                    "client": client[0] if client else None,
+                    "sample_rate": self._sample_rate if status < 400 and duration < self._slow_seconds else 1.0,
+                }, ensure_ascii=False, separators=(",", ":")))
+
+# 创建一个单例实例
+access_log = AccessLog()
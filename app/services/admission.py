@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Optional, Dict, Any, Deque
+
+from app.services.metrics import admission_wait_seconds
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 请求耗时的指数移动平均系数，用于估算Retry-After
+DURATION_EWMA_ALPHA = 0.2
+
+_admission_waits = admission_wait_seconds.labels("admission")
+
+class AdmissionRejected(Exception):
+    """请求没有被准入。status_code为503（全局过载）或429（单个模型的并发已满），retry_after为建议的重试秒数。"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionTicket:
+    """一个已准入请求占用的并发名额，请求结束时调用release()归还，重复调用无副作用。"""
+    __slots__ = ("_controller", "model", "admitted_at", "_released")
+
+    def __init__(self, controller: "AdmissionController", model: str):
+        self._controller = controller
+        self.model = model
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self)
+
+class _Waiter:
+    __slots__ = ("model", "future", "enqueued_at")
+
+    def __init__(self, model: str, future: asyncio.Future):
+        self.model = model
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+class AdmissionController:
+    """
+    代理请求的准入控制。
+
+    同时进行中的请求数受 proxy.admission.max_concurrent（全局）和 max_per_model（每个模型）限制，0表示不限制；
+    每个Key的并发上限 max_per_key 由 key_manager 在挑选Key时检查，所有Key都达到上限时由 key_manager.acquire_key() 排队等待。
+    超出限制的请求按到达顺序进入长度为 queue_size 的等待队列，最多等待 queue_timeout 秒；
+    队列已满或等待超时的请求被拒绝：受全局限制时返回503，只受模型限制时返回429，都带有Retry-After。
+    """
+    def __init__(self):
+        self._max_concurrent = config.get('proxy.admission.max_concurrent', 256)
+        self._max_per_model = config.get('proxy.admission.max_per_model', 0)
+        self._queue_size = config.get('proxy.admission.queue_size', 512)
+        self._queue_timeout = config.get('proxy.admission.queue_timeout', 10.0)
+
+        self._inflight = 0
+        self._inflight_by_model: Dict[str, int] = {}
+        self._waiters: Deque[_Waiter] = deque()
+        self._duration_ewma: Optional[float] = None
+        self._stats = {
+            "admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+            "wait_seconds_total": 0.0, "max_wait_seconds": 0.0,
+        }
+
+    def _fits(self, model: str) -> bool:
+        if self._max_concurrent and self._inflight >= self._max_concurrent:
+            return False
+        if self._max_per_model and self._inflight_by_model.get(model, 0) >= self._max_per_model:
+            return False
+        return True
+
+    def _grant(self, model: str) -> AdmissionTicket:
+        self._inflight += 1
+        self._inflight_by_model[model] = self._inflight_by_model.get(model, 0) + 1
+        self._stats["admitted"] += 1
+        return AdmissionTicket(self, model)
+
+    async def admit(self, model: str) -> AdmissionTicket:
+        """
+        为一个请求申请并发名额，必要时在队列中等待。
+        无法准入时引发AdmissionRejected。
+        """
+        # 队列中的请求都是当前无法准入的（每次归还名额时都会尝试唤醒），所以有空位时可以直接准入
+        if self._fits(model):
+            return self._grant(model)
+
+        if len(self._waiters) >= self._queue_size:
+            self._stats["rejected_queue_full"] += 1
+            raise self._rejection(model, "等待队列已满")
+
+        waiter = _Waiter(model, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._stats["queued"] += 1
+        try:
+            ticket = await asyncio.wait_for(asyncio.shield(waiter.future), self._queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 超时或取消的同时已经分配到了名额
+                ticket = waiter.future.result()
+                if isinstance(e, asyncio.CancelledError):
+                    ticket.release()
+                    raise
+            else:
+                waiter.future.cancel()
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._stats["rejected_timeout"] += 1
+                _admission_waits.observe(time.monotonic() - waiter.enqueued_at)
+                raise self._rejection(model, "排队超时")
+
+        waited = time.monotonic() - waiter.enqueued_at
+        _admission_waits.observe(waited)
+        self._stats["wait_seconds_total"] += waited
+        self._stats["max_wait_seconds"] = max(self._stats["max_wait_seconds"], waited)
+        return ticket
+
+    def _release(self, ticket: AdmissionTicket) -> None:
+        self._inflight -= 1
+        remaining = self._inflight_by_model.get(ticket.model, 1) - 1
+        if remaining > 0:
+            self._inflight_by_model[ticket.model] = remaining
+        else:
+            self._inflight_by_model.pop(ticket.model, None)
+
+        duration = time.monotonic() - ticket.admitted_at
+        if self._duration_ewma is None:
+            self._duration_ewma = duration
+        else:
+            self._duration_ewma += DURATION_EWMA_ALPHA * (duration - self._duration_ewma)
+        self._wake()
+
+    def _wake(self) -> None:
+        """按到达顺序把名额交给可以准入的等待者。"""
+        if not self._waiters:
+            return
+        still_waiting: Deque[_Waiter] = deque()
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if waiter.future.done():
+                continue
+            if self._fits(waiter.model):
+                waiter.future.set_result(self._grant(waiter.model))
+            else:
+                still_waiting.append(waiter)
+                if self._max_concurrent and self._inflight >= self._max_concurrent:
+                    # 全局名额已满，后面的等待者也无法准入
+                    still_waiting.extend(self._waiters)
+                    self._waiters.clear()
+        self._waiters = still_waiting
+
+    @property
+    def avg_request_seconds(self) -> Optional[float]:
+        """已结束请求的平均耗时（指数移动平均），还没有请求结束时为None。"""
+        return self._duration_ewma
+
+    def _rejection(self, model: str, reason: str) -> AdmissionRejected:
+        model_bound = (
+            self._max_per_model and self._inflight_by_model.get(model, 0) >= self._max_per_model
+            and not (self._max_concurrent and self._inflight >= self._max_concurrent)
+        )
+        status_code = 429 if model_bound else 503
+        logger.warning(f"⛔ 请求未被准入 ({reason}): model={model}, inflight={self._inflight}, queue={len(self._waiters)}")
+        # 按平均请求耗时估算名额释放的时间
+        retry_after = max(1, math.ceil(self._duration_ewma or 1.0))
+        return AdmissionRejected(status_code, reason, retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        queued = self._stats["queued"]
+        waited = queued - self._stats["rejected_timeout"]
+        return {
+            "max_concurrent": self._max_concurrent,
+            "max_per_model": self._max_per_model,
+            "queue_size": self._queue_size,
+            "queue_timeout": self._queue_timeout,
+            "inflight": self._inflight,
+            "inflight_by_model": dict(self._inflight_by_model),
+            "queue_length": len(self._waiters),
+            "avg_request_seconds": round(self._duration_ewma, 3) if self._duration_ewma is not None else None,
+            "avg_wait_seconds": round(self._stats["wait_seconds_total"] / waited, 3) if waited > 0 else 0.0,
+            **self._stats,
+        }
+
+# 创建一个单例实例
+admission_controller = AdmissionController()
@@ -0,0 +1,166 @@
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional, Dict, Any, Mapping
+
+from config import config
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+def parse_retry_at(headers: Optional[Mapping[str, str]], now: float) -> Optional[float]:
+    """
+    根据响应头推算Key可以再次使用的时间（Unix时间戳），没有相关响应头时返回None。
+    Retry-After可以是秒数或HTTP日期；X-RateLimit-Reset可以是毫秒或秒级的时间戳，也可以是剩余秒数。
+    """
+    if not headers:
+        return None
+    retry_after = headers.get("retry-after")
+    if retry_after:
+        try:
+            return now + max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return parsedate_to_datetime(retry_after).timestamp()
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            value = float(reset)
+        except ValueError:
+            return None
+        if value > 1e12:
+            return value / 1000
+        if value > 1e9:
+            return value
+        return now + max(0.0, value)
+    return None
+
+class KeyCircuit:
+    """
+    单个API Key的熔断状态：closed（正常）、open（暂停使用）、half_open（允许少量探测请求）。
+
+    401/403立即熔断 auth_open_seconds 秒；整个Key被限流的429（没有按模型的X-RateLimit-*响应头）熔断到Retry-After/X-RateLimit-Reset给出的时间；
+    5xx、连接失败和超过 slow_call_seconds 的慢响应累计 failure_threshold 次后熔断，
+    熔断时间从 open_seconds 开始，每次连续熔断加倍，不超过 max_open_seconds。
+    熔断到期后进入half_open，每 probe_interval 秒最多放行一个探测请求，成功后恢复closed，失败则重新熔断。
+    """
+    __slots__ = (
+        "state", "failures", "trips", "open_until", "probe_until", "reason",
+        "last_status", "last_failure", "successes", "total_failures",
+    )
+
+    failure_threshold = max(1, config.get('proxy.circuit_breaker.failure_threshold', 5))
+    open_seconds = config.get('proxy.circuit_breaker.open_seconds', 30.0)
+    max_open_seconds = config.get('proxy.circuit_breaker.max_open_seconds', 600.0)
+    auth_open_seconds = config.get('proxy.circuit_breaker.auth_open_seconds', 600.0)
+    rate_limit_open_seconds = config.get('proxy.circuit_breaker.rate_limit_open_seconds', 60.0)
+    slow_call_seconds = config.get('proxy.circuit_breaker.slow_call_seconds', 30.0)
+    probe_interval = config.get('proxy.circuit_breaker.probe_interval', 10.0)
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        # half_open状态下当前探测请求的截止时间，为0表示可以放行下一个探测
+        self.probe_until = 0.0
+        self.reason: Optional[str] = None
+        self.last_status: Optional[int] = None
+        self.last_failure: Optional[float] = None
+        self.successes = 0
+        self.total_failures = 0
+
+    @property
+    def selectable(self) -> bool:
+        """是否可以参与Key的挑选。"""
+        return self.state == CLOSED or (self.state == HALF_OPEN and not self.probe_until)
+
+    def record(
+        self, status: Optional[int], latency: Optional[float], headers: Optional[Mapping[str, str]], now: float,
+        model_limited: bool = False,
+    ) -> None:
+        """
+        记录一次上游响应。status为None表示连接失败。
+        model_limited为true表示这次429只针对请求的模型（已经由KeyRateLimiter的 (Key, 模型) 令牌桶处理），不熔断Key。
+        调用后由调用方根据 selectable 和 wake_at 调整Key在候选集合中的位置。
+        """
+        self.last_status = status
+        if status is not None and status < 400:
+            # X-RateLimit-Remaining等按模型计算的余量由KeyRateLimiter的令牌桶处理
+            if latency is None or latency <= self.slow_call_seconds:
+                self.successes += 1
+                self._close()
+                return
+        elif status is not None and status < 500 and (status not in (401, 403, 429) or (status == 429 and model_limited)):
+            # 其它4xx是请求本身的问题，按模型的限流只影响这个模型，都与Key的健康状况无关
+            self._close()
+            return
+
+        self.total_failures += 1
+        self.last_failure = now
+        if status in (401, 403):
+            self._trip("auth", now, now + self.auth_open_seconds)
+        elif status == 429:
+            self._trip("rate_limit", now, parse_retry_at(headers, now) or now + self.rate_limit_open_seconds)
+        else:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                duration = min(self.max_open_seconds, self.open_seconds * (2 ** self.trips))
+                self.trips += 1
+                reason = "error" if status is None else ("slow" if status < 400 else f"http_{status}")
+                self._trip(reason, now, now + duration)
+
+    def start_probe(self, now: float) -> None:
+        """half_open状态的Key被选中，在探测结果返回或probe_interval到期之前不再放行其它请求。"""
+        self.probe_until = now + self.probe_interval
+
+    def expire(self, now: float) -> bool:
+        """熔断或探测到期时调用，返回Key是否可以重新参与挑选。"""
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+            self.probe_until = 0.0
+            return True
+        if self.state == HALF_OPEN and self.probe_until and now >= self.probe_until:
+            # 探测请求没有返回结果（例如客户端取消），放行下一个探测
+            self.probe_until = 0.0
+            return True
+        return False
+
+    @property
+    def wake_at(self) -> Optional[float]:
+        """下一次需要调用expire()的时间，Key当前可选时为None。"""
+        if self.state == OPEN:
+            return self.open_until
+        if self.state == HALF_OPEN and self.probe_until:
+            return self.probe_until
+        return None
+
+    def _close(self) -> None:
+        self.failures = 0
+        if self.state == OPEN:
+            # 熔断之前发出的请求晚到的结果不提前结束熔断
+            return
+        self.trips = 0
+        self.state = CLOSED
+        self.probe_until = 0.0
+        self.reason = None
+
+    def _trip(self, reason: str, now: float, until: float) -> None:
+        self.state = OPEN
+        self.reason = reason
+        self.open_until = max(until, now + 1.0)
+        self.probe_until = 0.0
+
+    def as_dict(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = time.time() if now is None else now
+        return {
+            "state": self.state,
+            "reason": self.reason,
+            "consecutive_failures": self.failures,
+            "open_remaining": round(max(0.0, self.open_until - now), 1) if self.state == OPEN else 0.0,
+            "last_status": self.last_status,
+            "successes": self.successes,
+            "failures": self.total_failures,
+        }
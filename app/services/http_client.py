@@ -0,0 +1,100 @@
+import httpx
+import logging
+from typing import Dict, Any, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class UpstreamHTTPClient:
+    """
+    管理到OpenRouter的长连接HTTP客户端。
+    整个进程共享一个连接池，在lifespan中创建和关闭，避免每个请求都重新进行TCP/TLS握手。
+    """
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._http2 = False
+
+    async def start(self) -> None:
+        """根据配置创建共享的AsyncClient。"""
+        if self._client is None:
+            self._client = self._build_client()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=config.get('openrouter.http_pool.max_connections', 100),
+            max_keepalive_connections=config.get('openrouter.http_pool.max_keepalive_connections', 20),
+            keepalive_expiry=config.get('openrouter.http_pool.keepalive_expiry', 30.0),
+        )
+        timeout = httpx.Timeout(
+            config.get('openrouter.request_timeout', 60.0),
+            connect=config.get('openrouter.http_pool.connect_timeout', 10.0),
+            pool=config.get('openrouter.http_pool.pool_timeout', 10.0),
+        )
+
+        http2 = bool(config.get('openrouter.http_pool.http2', False))
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("⚠️ 配置启用了HTTP/2，但未安装h2依赖（pip install httpx[http2]），回退到HTTP/1.1。")
+                http2 = False
+
+        self._http2 = http2
+        logger.info(
+            f"✅ 上游HTTP连接池已创建: max_connections={limits.max_connections}, "
+            f"max_keepalive={limits.max_keepalive_connections}, keepalive_expiry={limits.keepalive_expiry}s, http2={http2}"
+        )
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
+
+    async def close(self) -> None:
+        """关闭共享客户端并释放所有连接。"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("上游HTTP连接池已关闭。")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        获取共享客户端。
+        在lifespan之外（例如脚本中直接调用）使用时会按需创建，以保持向后兼容。
+        """
+        if self._client is None:
+            self._client = self._build_client()
+        return self._client
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """返回连接池的使用情况：使用中、空闲和等待中的请求数量。"""
+        stats = {
+            "started": self._client is not None,
+            "http2": self._http2,
+            "max_connections": config.get('openrouter.http_pool.max_connections', 100),
+            "max_keepalive_connections": config.get('openrouter.http_pool.max_keepalive_connections', 20),
+            "keepalive_expiry": config.get('openrouter.http_pool.keepalive_expiry', 30.0),
+            "connections": 0,
+            "in_use": 0,
+            "idle": 0,
+            "waiting": 0,
+        }
+        if self._client is None:
+            return stats
+
+        # httpx没有公开连接池统计接口，这里从底层的httpcore连接池读取
+        pool = getattr(self._client._transport, "_pool", None)
+        if pool is None:
+            return stats
+
+        connections = list(getattr(pool, "connections", []))
+        idle = sum(1 for conn in connections if conn.is_idle())
+        requests = list(getattr(pool, "_requests", []))
+        waiting = sum(1 for req in requests if req.is_queued())
+
+        stats["connections"] = len(connections)
+        stats["idle"] = idle
+        stats["in_use"] = len(connections) - idle
+        stats["waiting"] = waiting
+        return stats
+
+# 创建一个单例实例
+upstream_http = UpstreamHTTPClient()
@@ -1,29 +1,741 @@
-from typing import Optional, Dict, Any
-from app import crud
+import asyncio
+import heapq
+import logging
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone, date
+from typing import Optional, Dict, Any, List, Set, Tuple, Iterable, Mapping, Deque
+
+from app import async_crud, crud
+from app.services.circuit_breaker import KeyCircuit, OPEN, HALF_OPEN, CLOSED
+from app.services.metrics import key_selection_seconds, admission_wait_seconds
+from app.services.rate_limiter import KeyRateLimiter
+from app.services.usage_writer import usage_writer
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 没有每日限额的Key在堆中的剩余额度
+UNLIMITED_HEADROOM = 1 << 62
+
+# 上游延迟的指数移动平均系数
+LATENCY_EWMA_ALPHA = 0.3
+
+DEFAULT_STRATEGY = "round_robin"
+
+_key_waits = admission_wait_seconds.labels("key")
+
+class _KeyState:
+    """单个API Key在内存中的状态。"""
+    __slots__ = (
+        "id", "key_name", "api_key", "daily_limit", "daily_usage", "usage_count",
+        "reset_day", "last_reset_time", "last_used", "inflight", "latency_ewma", "circuit",
+    )
+
+    def __init__(self, row: Dict[str, Any]):
+        self.id: int = row["id"]
+        self.key_name: str = row["key_name"]
+        self.api_key: str = row["api_key"]
+        self.daily_limit: int = row["daily_limit"] if row["daily_limit"] is not None else -1
+        self.daily_usage: int = row["daily_usage"] or 0
+        self.usage_count: int = row["usage_count"] or 0
+        self.last_reset_time: Optional[str] = row["last_reset_time"]
+        self.reset_day: Optional[date] = crud.parse_reset_date(row["last_reset_time"])
+        self.last_used: Optional[str] = row["last_used"]
+        self.inflight = 0
+        self.latency_ewma: Optional[float] = None
+        self.circuit = KeyCircuit()
+
+    def headroom(self, today: Optional[date] = None) -> int:
+        """剩余的每日额度。传入today时，尚未惰性重置的Key按已重置计算。"""
+        if self.daily_limit == -1:
+            return UNLIMITED_HEADROOM
+        if today is not None and self.reset_day != today:
+            return self.daily_limit
+        return self.daily_limit - self.daily_usage
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "key_name": self.key_name,
+            "api_key": self.api_key,
+            "daily_limit": self.daily_limit,
+            "daily_usage": self.daily_usage,
+            "usage_count": self.usage_count,
+        }
+
+# --- 负载均衡策略 ---
+
+class LoadBalanceStrategy:
+    """
+    负载均衡策略接口。
+    策略只负责在“可选”的Key集合中挑选一个，每日额度检查和惰性重置由APIKeyManager统一处理。
+    额度耗尽的Key会通过remove()移出集合，跨天后再通过add()放回。
+    today由APIKeyManager维护，为当前的UTC日期。
+    """
+    name = ""
+    today: Optional[date] = None
+
+    def rebuild(self, states: Iterable[_KeyState]) -> None:
+        """用给定的Key集合重建内部结构。"""
+        raise NotImplementedError
+
+    def add(self, state: _KeyState) -> None:
+        """把Key放回可选集合。"""
+        raise NotImplementedError
+
+    def remove(self, state: _KeyState) -> None:
+        """把Key移出可选集合。"""
+        raise NotImplementedError
+
+    def select(self) -> Optional[_KeyState]:
+        """挑选一个候选Key，集合为空时返回None。"""
+        raise NotImplementedError
+
+    def on_change(self, state: _KeyState) -> None:
+        """Key的使用量、并发数或延迟发生变化时调用。"""
+        pass
+
+    def on_new_day(self) -> None:
+        """UTC日期变化时调用。"""
+        pass
+
+class RoundRobinStrategy(LoadBalanceStrategy):
+    """按顺序轮流使用每个Key，O(1)。"""
+    name = "round_robin"
+
+    def __init__(self):
+        self._ring: List[_KeyState] = []
+        self._pos: Dict[int, int] = {}
+        self._cursor = -1
+
+    def rebuild(self, states: Iterable[_KeyState]) -> None:
+        self._ring = sorted(states, key=lambda s: s.id)
+        self._pos = {state.id: i for i, state in enumerate(self._ring)}
+        self._cursor = -1
+
+    def add(self, state: _KeyState) -> None:
+        if state.id not in self._pos:
+            self._pos[state.id] = len(self._ring)
+            self._ring.append(state)
+
+    def remove(self, state: _KeyState) -> None:
+        # 与最后一个元素交换后删除，保持O(1)
+        i = self._pos.pop(state.id, None)
+        if i is None:
+            return
+        last = self._ring.pop()
+        if last is not state:
+            self._ring[i] = last
+            self._pos[last.id] = i
+
+    def select(self) -> Optional[_KeyState]:
+        if not self._ring:
+            return None
+        self._cursor = (self._cursor + 1) % len(self._ring)
+        return self._ring[self._cursor]
+
+class RandomStrategy(RoundRobinStrategy):
+    """随机选择一个可用的Key，O(1)。"""
+    name = "random"
+
+    def select(self) -> Optional[_KeyState]:
+        if not self._ring:
+            return None
+        return self._ring[random.randrange(len(self._ring))]
+
+class PowerOfTwoLatencyStrategy(RoundRobinStrategy):
+    """
+    随机抽取两个Key，选择观测到的上游延迟（乘以当前并发数）更低的那个，O(1)。
+    还没有延迟数据的Key视为延迟为0，保证新Key能被探测到。
+    """
+    name = "p2c_latency"
+
+    def select(self) -> Optional[_KeyState]:
+        n = len(self._ring)
+        if n == 0:
+            return None
+        if n == 1:
+            return self._ring[0]
+        i, j = random.sample(range(n), 2)
+        a, b = self._ring[i], self._ring[j]
+        return a if self._score(a) <= self._score(b) else b
+
+    @staticmethod
+    def _score(state: _KeyState) -> float:
+        return (state.latency_ewma or 0.0) * (state.inflight + 1)
+
+class _HeapStrategy(LoadBalanceStrategy):
+    """基于带版本号的最小堆的策略基类，过期条目在选择时惰性丢弃，O(log n)。"""
+
+    def __init__(self):
+        self._heap: List[tuple] = []
+        self._members: Dict[int, _KeyState] = {}
+        self._versions: Dict[int, int] = {}
+
+    def _priority(self, state: _KeyState) -> tuple:
+        raise NotImplementedError
+
+    def rebuild(self, states: Iterable[_KeyState]) -> None:
+        self._members = {state.id: state for state in states}
+        self._versions = {key_id: 0 for key_id in self._members}
+        self._heap = [self._priority(s) + (0, s.id) for s in self._members.values()]
+        heapq.heapify(self._heap)
+
+    def add(self, state: _KeyState) -> None:
+        self._members[state.id] = state
+        self._push(state)
+
+    def remove(self, state: _KeyState) -> None:
+        if self._members.pop(state.id, None) is not None:
+            self._versions[state.id] = self._versions.get(state.id, 0) + 1
+
+    def on_change(self, state: _KeyState) -> None:
+        if state.id in self._members:
+            self._push(state)
+
+    def select(self) -> Optional[_KeyState]:
+        heap = self._heap
+        while heap:
+            entry = heap[0]
+            key_id = entry[-1]
+            state = self._members.get(key_id)
+            if state is None or self._versions.get(key_id) != entry[-2]:
+                heapq.heappop(heap)
+                continue
+            return state
+        return None
+
+    def _push(self, state: _KeyState) -> None:
+        version = self._versions.get(state.id, 0) + 1
+        self._versions[state.id] = version
+        heapq.heappush(self._heap, self._priority(state) + (version, state.id))
+        # 过期条目过多时压缩堆，保证堆大小与Key数量同阶
+        if len(self._heap) > 2 * len(self._members) + 64:
+            self._heap = [self._priority(s) + (self._versions[s.id], s.id) for s in self._members.values()]
+            heapq.heapify(self._heap)
+
+class LeastUsedStrategy(_HeapStrategy):
+    """优先使用总使用次数最少的Key，相同时优先剩余每日额度更多的Key。"""
+    name = "least_used"
+
+    def _priority(self, state: _KeyState) -> tuple:
+        return (state.usage_count, -state.headroom(self.today))
+
+class LeastInflightStrategy(_HeapStrategy):
+    """优先使用当前并发请求最少的Key，相同时优先最近最少被调度的Key。"""
+    name = "least_inflight"
+
+    def __init__(self):
+        super().__init__()
+        self._seq = 0
+
+    def _priority(self, state: _KeyState) -> tuple:
+        self._seq += 1
+        return (state.inflight, self._seq)
+
+class WeightedQuotaStrategy(LoadBalanceStrategy):
+    """
+    按剩余每日额度加权随机选择，O(log n)。
+    权重保存在树状数组中，没有每日限额的Key使用 proxy.unlimited_key_weight 作为权重。
+    """
+    name = "weighted_quota"
+
+    def __init__(self):
+        self._slots: List[_KeyState] = []
+        self._slot_of: Dict[int, int] = {}
+        self._weights: List[int] = []
+        self._tree: List[int] = [0]
+        # 通过remove()移出集合的Key（熔断或额度耗尽），槽位保留但权重保持为0，直到add()
+        self._removed: Set[int] = set()
+        self._unlimited_weight = max(1, int(config.get('proxy.unlimited_key_weight', 1000)))
+
+    def rebuild(self, states: Iterable[_KeyState]) -> None:
+        self._removed = set()
+        self._reset_slots(list(states))
+
+    def _reset_slots(self, slots: List[_KeyState]) -> None:
+        self._slots = slots
+        self._slot_of = {state.id: i for i, state in enumerate(slots)}
+        self._weights = [0] * len(slots)
+        self._tree = [0] * (len(slots) + 1)
+        for i, state in enumerate(slots):
+            if state.id not in self._removed:
+                self._set_weight(i, self._weight(state))
+
+    def add(self, state: _KeyState) -> None:
+        self._removed.discard(state.id)
+        i = self._slot_of.get(state.id)
+        if i is None:
+            # 新增的Key不在槽位中，重建一次（只发生在管理后台修改或熔断恢复之后）
+            self._reset_slots(self._slots + [state])
+            return
+        self._set_weight(i, self._weight(state))
+
+    def remove(self, state: _KeyState) -> None:
+        i = self._slot_of.get(state.id)
+        if i is not None:
+            self._removed.add(state.id)
+            self._set_weight(i, 0)
+
+    def on_change(self, state: _KeyState) -> None:
+        # 权重为0的Key已被移出或额度耗尽，等到add()或跨天时再恢复
+        i = self._slot_of.get(state.id)
+        if i is not None and self._weights[i] > 0:
+            self._set_weight(i, self._weight(state))
+
+    def on_new_day(self) -> None:
+        # 跨天后所有Key的剩余额度都恢复，重新计算仍在集合中的Key的权重
+        self._reset_slots(self._slots)
+
+    def select(self) -> Optional[_KeyState]:
+        n = len(self._slots)
+        total = self._prefix(n)
+        if total <= 0:
+            return None
+        # 在树状数组上二分查找第一个前缀和大于r的槽位
+        r = random.randrange(total)
+        pos = 0
+        step = 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and self._tree[nxt] <= r:
+                pos = nxt
+                r -= self._tree[nxt]
+            step >>= 1
+        return self._slots[pos]
+
+    def _weight(self, state: _KeyState) -> int:
+        if state.daily_limit == -1:
+            return self._unlimited_weight
+        return max(0, state.headroom(self.today))
+
+    def _set_weight(self, i: int, weight: int) -> None:
+        delta = weight - self._weights[i]
+        if delta == 0:
+            return
+        self._weights[i] = weight
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i: int) -> int:
+        total = 0
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+STRATEGIES = {
+    cls.name: cls
+    for cls in (
+        RoundRobinStrategy,
+        RandomStrategy,
+        LeastUsedStrategy,
+        WeightedQuotaStrategy,
+        LeastInflightStrategy,
+        PowerOfTwoLatencyStrategy,
+    )
+}
+
+def create_strategy(name: str) -> LoadBalanceStrategy:
+    """根据名称创建策略实例，未知名称会引发ValueError。"""
+    cls = STRATEGIES.get(name)
+    if cls is None:
+        raise ValueError(f"未知的负载均衡策略: {name}，可选值: {', '.join(STRATEGIES)}")
+    return cls()
 
 class APIKeyManager:
     """
     管理API Key的业务逻辑，包括选择下一个可用的Key。
+
+    所有激活的Key都缓存在内存中，由可切换的负载均衡策略挑选，单次选择为O(1)或O(log n)。
+    每日使用量在Key被选中时按UTC日期惰性重置，
+    使用计数先在内存中累加，再由usage_writer批量写回SQLite。
+    每个Key有一个熔断器（KeyCircuit），熔断的Key移出候选集合，到期时间保存在最小堆中，到期后重新放回。
+    每个Key和每个 (Key, 模型) 还有令牌桶（KeyRateLimiter），令牌用完的Key在挑选时被跳过。
     """
-    def get_next_key(self) -> Optional[Dict[str, Any]]:
+    def __init__(self):
+        self._states: Dict[int, _KeyState] = {}
+        self._exhausted: Set[int] = set()
+        # (到期时间, Key ID)，熔断或探测到期后需要重新检查的Key
+        self._wake_heap: List[Tuple[float, int]] = []
+        self._limiter = KeyRateLimiter()
+        # 每个Key同时进行中的请求数上限，0表示不限制
+        self._max_per_key = config.get('proxy.admission.max_per_key', 0)
+        # 所有Key都达到max_per_key时，等待Key被释放的请求（按到达顺序）和最长等待时间
+        self._release_waiters: Deque[asyncio.Future] = deque()
+        self._key_wait_timeout = config.get('proxy.admission.queue_timeout', 10.0)
+        self._loaded = False
+        self._strategy = self._initial_strategy()
+        self._today: Optional[date] = None
+        self._next_day_boundary = 0.0
+        self._reload_lock: Optional[asyncio.Lock] = None
+
+    # --- 生命周期 ---
+
+    async def start(self) -> None:
+        """从数据库加载所有激活的Key，必须在挑选Key之前调用。"""
+        rows = await async_crud.load_active_api_keys()
+        self._rebuild(rows)
+
+    async def invalidate(self) -> None:
         """
-        获取下一个可用的API Key。
-        选择逻辑是：在所有激活且未超每日限额的Key中，选择总使用次数最少的那个。
+        在管理后台修改Key之后调用，立即让内存中的调度状态失效。
+        先写回未提交的计数，再从数据库重新加载；加载期间暂停后台写入，
+        否则在读取之后、重建之前写回的计数既不在读到的行中，也不再是未提交的计数，会被丢失。
         """
-        # crud.get_active_api_keys() 已经处理了激活状态、每日限额检查和排序
-        active_keys = crud.get_active_api_keys()
-        
-        if not active_keys:
+        if self._reload_lock is None:
+            self._reload_lock = asyncio.Lock()
+        async with self._reload_lock, usage_writer.paused():
+            rows = await async_crud.load_active_api_keys()
+            self._rebuild(rows)
+        logger.info(f"🔄 API Key调度器已重新加载，共 {len(self._states)} 个激活的Key。")
+
+    # --- 负载均衡策略 ---
+
+    @property
+    def strategy_name(self) -> str:
+        return self._strategy.name
+
+    def set_strategy(self, name: str) -> None:
+        """在运行时切换负载均衡策略，未知名称会引发ValueError。"""
+        strategy = create_strategy(name)
+        strategy.today = self._today
+        strategy.rebuild(s for s in self._states.values() if self._in_pool(s))
+        self._strategy = strategy
+        logger.info(f"🔀 负载均衡策略已切换为: {name}")
+
+    def _initial_strategy(self) -> LoadBalanceStrategy:
+        name = config.get('proxy.load_balance_strategy', DEFAULT_STRATEGY)
+        try:
+            return create_strategy(name)
+        except ValueError as e:
+            logger.warning(f"⚠️ {e}，使用默认策略 {DEFAULT_STRATEGY}。")
+            return create_strategy(DEFAULT_STRATEGY)
+
+    # --- 选择与计数 ---
+
+    def get_next_key(self, exclude: Optional[Iterable[int]] = None, model: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        获取下一个可用的API Key，调度器尚未通过 start() 加载时返回None。
+        由当前的负载均衡策略在所有激活且未超每日限额的Key中挑选，选中的Key并发数加一，
+        调用方在请求结束后必须调用 release_key()。
+        exclude为本次挑选中需要跳过的Key ID（例如故障转移时已经尝试过的Key）；
+        传入model时，同时跳过在这个模型上令牌已经用完的Key；并发数达到 proxy.admission.max_per_key 的Key也会被跳过。
+        """
+        if not self._loaded:
+            logger.error("❌ API Key调度器尚未加载，请先在启动时调用 await key_manager.start()。")
             return None
-            
-        # 返回使用次数最少的Key
-        return active_keys[0]
+
+        started = time.perf_counter()
+        today = self._current_day()
+        strategy = self._strategy
+        if self._wake_heap and self._wake_heap[0][0] <= time.time():
+            self._wake_circuits()
+        # 需要跳过的Key在挑选期间暂时移出候选集合，挑选结束后放回
+        skipped = [
+            self._states[key_id] for key_id in (exclude or ())
+            if key_id in self._states and self._in_pool(self._states[key_id])
+        ]
+        for state in skipped:
+            strategy.remove(state)
+        try:
+            return self._select(strategy, today, model, skipped)
+        finally:
+            for state in skipped:
+                if self._in_pool(state):
+                    strategy.add(state)
+            key_selection_seconds.observe(time.perf_counter() - started)
+
+    async def acquire_key(self, model: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        与 get_next_key() 相同，但所有可用的Key都只是因为达到 max_per_key 而被跳过时，
+        按到达顺序等待其它请求释放Key后重新挑选，最多等待 proxy.admission.queue_timeout 秒。
+        """
+        key = self.get_next_key(model=model)
+        if key is not None or not self._at_capacity(model):
+            return key
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + self._key_wait_timeout
+        try:
+            while key is None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                waiter = loop.create_future()
+                self._release_waiters.append(waiter)
+                try:
+                    await asyncio.wait_for(waiter, remaining)
+                except asyncio.TimeoutError:
+                    break
+                except asyncio.CancelledError:
+                    if waiter.done() and not waiter.cancelled():
+                        # 已经被唤醒但不再需要Key，把这次唤醒交给下一个等待者
+                        self._notify_release()
+                    raise
+                finally:
+                    if not waiter.done() or waiter.cancelled():
+                        try:
+                            self._release_waiters.remove(waiter)
+                        except ValueError:
+                            pass
+                key = self.get_next_key(model=model)
+                if key is None and not self._at_capacity(model):
+                    # 释放的Key之后熔断或额度用完，等待也不会有结果
+                    break
+        finally:
+            _key_waits.observe(loop.time() - started)
+        return key
+
+    def _at_capacity(self, model: Optional[str]) -> bool:
+        """是否有Key除了并发数达到 max_per_key 之外都可以被挑选。"""
+        if not self._max_per_key:
+            return False
+        # 与挑选时一样按当前日期计算额度，跨天后尚未惰性重置的Key不算额度用完
+        today = self._current_day()
+        now = time.time()
+        return any(
+            state.inflight >= self._max_per_key and self._in_pool(state) and state.headroom(today) > 0
+            and self._limiter.allows(state.id, model, now)
+            for state in self._states.values()
+        )
+
+    def _notify_release(self) -> None:
+        """唤醒最早的一个等待Key的请求。"""
+        while self._release_waiters:
+            waiter = self._release_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _select(
+        self, strategy: LoadBalanceStrategy, today: date, model: Optional[str], skipped: List[_KeyState]
+    ) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        while True:
+            state = strategy.select()
+            if state is None:
+                return None
+
+            if not state.circuit.selectable:
+                # 熔断中或探测尚未返回的Key不应该在候选集合中，移出后由熔断到期时放回
+                strategy.remove(state)
+                continue
+
+            if state.reset_day != today:
+                # 惰性重置：只在Key被选中时才检查是否跨天
+                state.daily_usage = 0
+                state.reset_day = today
+                state.last_reset_time = crud.utc_now_str()
+                usage_writer.record_key_usage(state.id, 0, 0, None, state.last_reset_time)
+
+            if state.headroom() <= 0:
+                strategy.remove(state)
+                self._exhausted.add(state.id)
+                continue
+
+            if not self._limiter.allows(state.id, model, now) or (self._max_per_key and state.inflight >= self._max_per_key):
+                # 令牌用完或并发已满的Key只在本次挑选中跳过，由调用方在挑选结束后放回
+                strategy.remove(state)
+                skipped.append(state)
+                continue
+
+            if state.circuit.state == HALF_OPEN:
+                # 半开状态的Key只放行一个探测请求，结果返回之前移出候选集合
+                state.circuit.start_probe(now)
+                strategy.remove(state)
+                heapq.heappush(self._wake_heap, (state.circuit.probe_until, state.id))
+                logger.info(f"🔍 向熔断中的Key {state.key_name} 发送探测请求")
+
+            self._limiter.acquire(state.id, model, now)
+            state.inflight += 1
+            strategy.on_change(state)
+            return state.as_dict()
+
+    def release_key(self, key_id: int, latency: Optional[float] = None) -> None:
+        """
+        请求结束后释放Key的并发计数。
+        latency为上游返回响应头所用的秒数，用于基于延迟的策略。
+        """
+        state = self._states.get(key_id)
+        if state is None:
+            return
+        if state.inflight > 0:
+            state.inflight -= 1
+            if self._release_waiters:
+                self._notify_release()
+        if latency is not None:
+            if state.latency_ewma is None:
+                state.latency_ewma = latency
+            else:
+                state.latency_ewma += LATENCY_EWMA_ALPHA * (latency - state.latency_ewma)
+        self._strategy.on_change(state)
+
+    def report_upstream(
+        self, key_id: int, status: Optional[int], latency: Optional[float] = None,
+        headers: Optional[Mapping[str, str]] = None, model: Optional[str] = None,
+    ) -> None:
+        """
+        记录一次上游响应，更新Key的熔断状态和令牌桶。
+        status为None表示连接失败；headers用于读取Retry-After和X-RateLimit-*。
+        """
+        state = self._states.get(key_id)
+        if state is None:
+            return
+        model_limited = self._limiter.observe(key_id, model, status, headers, time.time())
+        circuit = state.circuit
+        was_in_pool = self._in_pool(state)
+        previous, previous_until = circuit.state, circuit.open_until
+        circuit.record(status, latency, headers, time.time(), model_limited)
+        in_pool = self._in_pool(state)
+        if was_in_pool and not in_pool:
+            self._strategy.remove(state)
+        elif in_pool and not was_in_pool:
+            self._strategy.add(state)
+
+        if circuit.state == OPEN and circuit.open_until != previous_until:
+            heapq.heappush(self._wake_heap, (circuit.open_until, state.id))
+        if circuit.state == OPEN and previous != OPEN:
+            logger.warning(
+                f"🚫 Key {state.key_name} 已熔断 ({circuit.reason}, 状态码 {status})，"
+                f"{circuit.open_until - time.time():.0f} 秒后重新探测"
+            )
+        elif circuit.state == CLOSED and previous != CLOSED:
+            logger.info(f"✅ Key {state.key_name} 已恢复")
+
+    def key_health(self, key_id: int) -> Optional[Dict[str, Any]]:
+        """返回Key的熔断状态和令牌桶，Key未激活时返回None。"""
+        state = self._states.get(key_id)
+        if state is None:
+            return None
+        return {**state.circuit.as_dict(), "rate_limit": self._limiter.key_stats(key_id)}
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """返回Key池的使用情况：激活、可选、额度用完的Key数量，各熔断状态的Key数量和进行中的请求数。"""
+        circuits = {CLOSED: 0, OPEN: 0, HALF_OPEN: 0}
+        available = inflight = 0
+        for state in self._states.values():
+            circuits[state.circuit.state] += 1
+            inflight += state.inflight
+            if self._in_pool(state):
+                available += 1
+        return {
+            "active": len(self._states),
+            "available": available,
+            "exhausted": len(self._exhausted),
+            "circuits": circuits,
+            "inflight": inflight,
+        }
+
+    def retry_after(self, model: Optional[str] = None, busy_seconds: Optional[float] = None) -> Optional[float]:
+        """
+        没有可用Key时，估算最早有Key可用的秒数（熔断到期、令牌补充或并发名额释放），无法估算时返回None。
+        busy_seconds为一个请求平均占用Key的秒数，用于估算达到 max_per_key 的Key何时释放，不传时按1秒估算。
+        """
+        now = time.time()
+        candidates = [s for s in self._states.values() if s.id not in self._exhausted]
+        if not candidates:
+            return None
+        earliest = None
+        for state in candidates:
+            at = state.circuit.wake_at if not state.circuit.selectable else now
+            at = max(at, self._limiter.next_available([state.id], model, now))
+            if self._max_per_key and state.inflight >= self._max_per_key:
+                at = max(at, now + (busy_seconds or 1.0))
+            if earliest is None or at < earliest:
+                earliest = at
+        return max(0.0, earliest - now)
 
     def update_key_usage(self, key_id: int):
         """
         更新指定Key的使用记录。
+        只修改内存状态，数据库由usage_writer批量写回。
         """
-        crud.update_key_usage(key_id)
+        state = self._states.get(key_id)
+        if state is None:
+            # Key已被删除或禁用，只累加总使用次数
+            usage_writer.record_key_usage(key_id, 1, None, None, None)
+            return
+
+        state.usage_count += 1
+        state.daily_usage += 1
+        state.last_used = crud.utc_now_str()
+        usage_writer.record_key_usage(key_id, 1, state.daily_usage, state.last_used, None)
+        self._strategy.on_change(state)
+
+    # --- 内部方法 ---
+
+    def _rebuild(self, rows: List[Dict[str, Any]]) -> None:
+        """根据数据库中的行重建内存状态，并叠加尚未写回的计数和运行时指标。"""
+        old_states = self._states
+        pending = usage_writer.pending_key_updates()
+        states: Dict[int, _KeyState] = {}
+        for row in rows:
+            state = _KeyState(row)
+            old = old_states.get(state.id)
+            if old is not None:
+                state.inflight = old.inflight
+                state.latency_ewma = old.latency_ewma
+                state.circuit = old.circuit
+                if state.id in pending:
+                    state.usage_count += pending[state.id][0]
+                    state.daily_usage = old.daily_usage
+                    state.reset_day = old.reset_day
+                    state.last_reset_time = old.last_reset_time
+                    state.last_used = old.last_used
+            states[state.id] = state
+
+        self._states = states
+        self._exhausted = set()
+        self._limiter.retain(states)
+        self._wake_heap = [(s.circuit.wake_at, s.id) for s in states.values() if s.circuit.wake_at is not None]
+        heapq.heapify(self._wake_heap)
+        self._strategy.rebuild(s for s in states.values() if s.circuit.selectable)
+        self._loaded = True
+
+    def _in_pool(self, state: _KeyState) -> bool:
+        """Key当前是否在策略的候选集合中。"""
+        return state.id not in self._exhausted and state.circuit.selectable
+
+    def _wake_circuits(self) -> None:
+        """把熔断或探测已经到期的Key放回候选集合。"""
+        now = time.time()
+        heap = self._wake_heap
+        while heap and heap[0][0] <= now:
+            _, key_id = heapq.heappop(heap)
+            state = self._states.get(key_id)
+            if state is None:
+                continue
+            wake_at = state.circuit.wake_at
+            # 过期的堆条目（Key之后又被重新熔断或已经恢复）直接丢弃
+            if wake_at is None or wake_at > now:
+                continue
+            if state.circuit.expire(now) and self._in_pool(state):
+                self._strategy.add(state)
+
+    def _current_day(self) -> date:
+        """返回当前UTC日期，跨天边界只在过期时重新计算。"""
+        now = time.time()
+        if now >= self._next_day_boundary:
+            today = datetime.now(timezone.utc).date()
+            midnight = datetime(today.year, today.month, today.day, tzinfo=timezone.utc) + timedelta(days=1)
+            self._next_day_boundary = midnight.timestamp()
+            if today != self._today:
+                self._today = today
+                self._strategy.today = today
+                # 新的一天，把已耗尽额度的Key放回候选集合，等待惰性重置
+                for key_id in self._exhausted:
+                    state = self._states.get(key_id)
+                    if state is not None and state.circuit.selectable:
+                        self._strategy.add(state)
+                self._exhausted = set()
+                self._strategy.on_new_day()
+        return self._today
 
 # 创建一个单例实例，以便在应用中共享
-key_manager = APIKeyManager()
\ No newline at end of file
+key_manager = APIKeyManager()
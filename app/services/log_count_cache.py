@@ -0,0 +1,69 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from app import async_crud
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class UsageLogCountCache:
+    """
+    缓存调用记录分页使用的总数。
+
+    每组筛选条件的COUNT(*)只在第一次请求时同步计算；之后直接返回缓存值，
+    缓存超过有效期后在后台重新计算，翻页请求不再等待对整张表的计数。
+    返回的总数因此可能略微落后于实际记录数。
+    """
+    def __init__(self):
+        self._ttl = config.get('usage_logs.count_cache_ttl', 30)
+        self._max_entries = config.get('usage_logs.count_cache_size', 256)
+        # 筛选条件 -> (总数, 计算时间)
+        self._counts: "OrderedDict[Tuple, Tuple[int, float]]" = OrderedDict()
+        self._refreshing: Dict[Tuple, asyncio.Task] = {}
+
+    @staticmethod
+    def _cache_key(filters: Dict[str, Any]) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in filters.items() if v))
+
+    async def get(self, **filters) -> Dict[str, Any]:
+        """返回 {"total": 总数, "age": 缓存已存在的秒数}。"""
+        key = self._cache_key(filters)
+        cached = self._counts.get(key)
+        if cached is None:
+            total = await self._refresh(key, filters)
+            return {"total": total, "age": 0.0}
+
+        self._counts.move_to_end(key)
+        total, computed_at = cached
+        age = time.monotonic() - computed_at
+        if age > self._ttl and key not in self._refreshing:
+            self._refreshing[key] = asyncio.create_task(self._refresh(key, filters))
+        return {"total": total, "age": round(age, 1)}
+
+    def invalidate(self) -> None:
+        """清空所有缓存的总数（例如批量删除记录之后）。"""
+        self._counts.clear()
+
+    async def _refresh(self, key: Tuple, filters: Dict[str, Any]) -> int:
+        try:
+            total = await async_crud.count_usage_logs(**filters)
+        except Exception as e:
+            logger.error(f"❌ 统计调用记录总数失败: {e}")
+            cached = self._counts.get(key)
+            if cached is None:
+                raise
+            return cached[0]
+        finally:
+            self._refreshing.pop(key, None)
+
+        self._counts[key] = (total, time.monotonic())
+        self._counts.move_to_end(key)
+        while len(self._counts) > self._max_entries:
+            self._counts.popitem(last=False)
+        return total
+
+# 创建一个单例实例
+usage_log_counts = UsageLogCountCache()
@@ -0,0 +1,217 @@
+import math
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# 各类耗时直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STREAM_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+SELECTION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+DB_WRITE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+def _label_str(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape("" if value is None else str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values) -> object:
+        """
+        返回一组标签值对应的子指标。子指标在第一次出现时创建，之后直接复用，
+        调用方可以在模块级别预先取好固定标签的子指标。
+        """
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self) -> object:
+        raise NotImplementedError
+
+    def render(self, out: List[str]) -> None:
+        out.append(f"# HELP {self.name} {self.documentation}")
+        out.append(f"# TYPE {self.name} {self.type_name}")
+        for values, child in list(self._children.items()):
+            self._render_child(out, _label_str(self.labelnames, values), values, child)
+
+    def _render_child(self, out: List[str], labels: str, values: Tuple[str, ...], child) -> None:
+        out.append(f"{self.name}{labels} {_format_value(child.value)}")
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+class Counter(_Metric):
+    """只增不减的计数器。"""
+    type_name = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+class Gauge(_Metric):
+    """可增可减的当前值。"""
+    type_name = "gauge"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+class _HistogramValue:
+    """固定桶的直方图，计数数组在创建时分配，记录时只做二分查找和加法。"""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # 最后一个位置是 +Inf 桶
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Histogram(_Metric):
+    """按上限分桶的分布，导出时转换为累计计数。"""
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _render_child(self, out: List[str], labels: str, values: Tuple[str, ...], child: _HistogramValue) -> None:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), child.counts):
+            cumulative += count
+            le = _label_str(self.labelnames, values, f'le="{_format_value(bound)}"')
+            out.append(f"{self.name}_bucket{le} {cumulative}")
+        out.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        out.append(f"{self.name}_count{labels} {child.count}")
+
+# 导出时调用的采集函数，返回 (指标名, 说明, 类型, [(标签字典, 值), ...])
+Collector = Callable[[], Iterable[Tuple[str, str, str, Iterable[Tuple[Dict[str, str], float]]]]]
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，以Prometheus文本格式（0.0.4）导出。
+
+    请求路径上只更新预先创建的计数器和直方图桶；连接池、队列等本来就有状态的数值
+    通过采集函数在 /metrics 被抓取时读取，不在请求路径上维护。
+    """
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Collector] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector: Collector) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        out: List[str] = []
+        for metric in self._metrics:
+            metric.render(out)
+        for collector in self._collectors:
+            for name, documentation, type_name, samples in collector():
+                out.append(f"# HELP {name} {documentation}")
+                out.append(f"# TYPE {name} {type_name}")
+                for labels, value in samples:
+                    out.append(f"{name}{_label_str(list(labels), list(labels.values()))} {_format_value(value)}")
+        out.append("")
+        return "\n".join(out)
+
+# 创建一个单例实例
+metrics = MetricsRegistry()
+
+# --- 请求路径上记录的指标 ---
+
+upstream_ttfb_seconds = metrics.histogram(
+    "openrouter_proxy_upstream_ttfb_seconds", "上游返回响应头所用的时间（每次尝试，包括故障转移）",
+)
+stream_duration_seconds = metrics.histogram(
+    "openrouter_proxy_stream_duration_seconds", "流式响应从开始到结束的总时间", buckets=STREAM_BUCKETS,
+)
+key_selection_seconds = metrics.histogram(
+    "openrouter_proxy_key_selection_seconds", "挑选API Key所用的时间", buckets=SELECTION_BUCKETS,
+)
+admission_wait_seconds = metrics.histogram(
+    "openrouter_proxy_admission_wait_seconds", "请求排队等待的时间（admission为准入名额，key为达到max_per_key的Key）", ("queue",),
+)
+db_write_seconds = metrics.histogram(
+    "openrouter_proxy_db_write_seconds", "批量写入使用记录所用的时间", buckets=DB_WRITE_BUCKETS,
+)
+tokens = metrics.histogram(
+    "openrouter_proxy_tokens", "每个请求的token数", ("type",), buckets=TOKEN_BUCKETS,
+)
+prompt_tokens = tokens.labels("prompt")
+completion_tokens = tokens.labels("completion")
+requests_total = metrics.counter(
+    "openrouter_proxy_requests_total", "写入使用记录的上游请求数", ("key_id", "model", "status"),
+)
+inflight_streams = metrics.gauge(
+    "openrouter_proxy_inflight_streams", "正在进行中的流式响应数",
+).labels()
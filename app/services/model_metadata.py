@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import re
+from typing import Optional, Dict, Any, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# 描述中的参数量写法："21B parameter"、"24B-parameter"、"7 billion parameters"、
+# "13B active parameters"、"1T total parameters" 等。单位由命名分组给出，
+# 整个描述只扫描一遍，取最先出现的一处（通常是总参数量）。
+_PARAMETER_PATTERN = re.compile(
+    r"""
+    (?<![\w.])(?P<value>\d+(?:\.\d+)?)[\s-]*
+    (?:
+        (?P<abbr>[kmbt])(?![a-z])
+      | (?P<word>thousand|million|billion|trillion)
+    )
+    [\s-]*(?:(?:total|active|activated)[\s-]+)?param
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+
+_UNIT_MULTIPLIERS = {"k": 10 ** 3, "m": 10 ** 6, "b": 10 ** 9, "t": 10 ** 12}
+
+# 单词写法的单位对应的缩写（"thousand"和"trillion"的首字母相同，不能直接取首字母）
+_WORD_UNITS = {"thousand": "k", "million": "m", "billion": "b", "trillion": "t"}
+
+class ParameterCount(NamedTuple):
+    """从描述中提取的参数量。label保留描述中的数字写法，例如 "21B"、"1.5B"、"7M"。"""
+    label: str
+    count: int
+
+def extract_parameters(description: str) -> Optional[ParameterCount]:
+    """从模型描述中提取参数量，没有找到时返回None。"""
+    if not description:
+        return None
+    match = _PARAMETER_PATTERN.search(description)
+    if match is None:
+        return None
+    value = match.group("value")
+    abbr = match.group("abbr")
+    unit = abbr.lower() if abbr else _WORD_UNITS[match.group("word").lower()]
+    return ParameterCount(
+        label=f"{value}{unit.upper()}",
+        count=round(float(value) * _UNIT_MULTIPLIERS[unit]),
+    )
+
+class ModelMetadataEnricher:
+    """
+    在写入数据库之前整理上游返回的模型信息，并从描述中提取参数量。
+
+    提取结果按描述内容的哈希缓存，描述没有变化的模型在之后的刷新中不会再次匹配；
+    每次刷新后只保留本次出现过的描述，缓存大小不超过模型数量。
+    """
+    def __init__(self):
+        self._cache: Dict[bytes, Optional[ParameterCount]] = {}
+        self._stats = {"hits": 0, "misses": 0}
+
+    def enrich(self, models: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        返回写入free_models表所需的模型信息：
+        id、name、context_length、created、parameters（如 "21B"）和 parameter_count（参数个数）。
+        """
+        previous, cache = self._cache, {}
+        enriched = []
+        for m in models:
+            description = m.get('description') or ''
+            key = hashlib.blake2b(description.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+            if key in previous:
+                self._stats["hits"] += 1
+                params = previous[key]
+            elif key in cache:
+                params = cache[key]
+            else:
+                self._stats["misses"] += 1
+                params = extract_parameters(description)
+            cache[key] = params
+            enriched.append({
+                "id": m.get('id', ''),
+                "name": m.get('name') or m.get('id', ''),
+                "context_length": m.get('context_length'),
+                "created": m.get('created'),
+                "parameters": params.label if params else None,
+                "parameter_count": params.count if params else None,
+            })
+        self._cache = cache
+        return enriched
+
+    def stats(self) -> Dict[str, Any]:
+        return {"cache_entries": len(self._cache), **self._stats}
+
+# 创建一个单例实例
+model_metadata = ModelMetadataEnricher()
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Optional, Dict, Any
+
+from app.services.model_metadata import model_metadata
+from app.services.model_registry import model_registry
+from app.services.openrouter_client import openrouter_client
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class ModelRefresher:
+    """
+    在后台定期刷新免费模型列表。
+
+    服务启动时直接使用数据库中保存的模型表，不等待上游；刷新间隔为 openrouter.model_cache_timeout 秒，
+    并加上 ±model_refresh_jitter 比例的随机抖动，避免多个实例同时请求上游。
+    刷新失败时在 model_refresh_retry_interval 秒后重试。
+    """
+    def __init__(self):
+        self._interval = config.get('openrouter.model_cache_timeout', 3600)
+        self._jitter = config.get('openrouter.model_refresh_jitter', 0.1)
+        self._retry_interval = config.get('openrouter.model_refresh_retry_interval', 60)
+        self._refresh_on_startup = config.get('openrouter.auto_update_models_on_startup', True)
+        self._task: Optional[asyncio.Task] = None
+        self._last_success: Optional[float] = None
+        self._last_attempt: Optional[float] = None
+        self._next_refresh: Optional[float] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _delay(self) -> float:
+        return self._interval * (1 + random.uniform(-self._jitter, self._jitter))
+
+    async def _run(self) -> None:
+        # 数据库中还没有任何模型时无论配置如何都立即刷新
+        delay = 0.0 if self._refresh_on_startup or not model_registry.active_count else self._delay()
+        while True:
+            self._next_refresh = time.time() + delay
+            await asyncio.sleep(delay)
+            self._last_attempt = time.time()
+            try:
+                count = await openrouter_client.update_free_models_cache(conditional=True)
+            except Exception as e:
+                logger.error(f"❌ 后台刷新免费模型失败: {e}")
+                count = None
+            if count is None:
+                delay = min(self._retry_interval, self._interval)
+            else:
+                self._last_success = time.time()
+                delay = self._delay()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "interval": self._interval,
+            "jitter": self._jitter,
+            "active_models": model_registry.active_count,
+            "last_attempt": self._last_attempt,
+            "last_success": self._last_success,
+            "next_refresh": self._next_refresh,
+            "metadata_cache": model_metadata.stats(),
+        }
+
+# 创建一个单例实例
+model_refresher = ModelRefresher()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import logging
+import time
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Mapping, NamedTuple, Tuple
+
+from app import async_crud
+
+logger = logging.getLogger(__name__)
+
+class ModelInfo(NamedTuple):
+    model_id: str
+    model_name: str
+    is_active: bool
+    context_length: Optional[int]
+    parameters: Optional[str]
+    parameter_count: Optional[int]
+    created: int
+
+class _Snapshot:
+    """某一次刷新后的不可变模型表，以及预先序列化好的 /v1/models 响应。"""
+    __slots__ = ("models", "models_body", "etag")
+
+    def __init__(self, models: Mapping[str, ModelInfo]):
+        self.models = models
+        body = {
+            "object": "list",
+            "data": [
+                {"id": info.model_id, "object": "model", "created": info.created, "owned_by": "openrouter"}
+                for info in models.values() if info.is_active
+            ],
+        }
+        self.models_body = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.etag = '"' + hashlib.blake2b(self.models_body, digest_size=16).hexdigest() + '"'
+
+class ModelRegistry:
+    """
+    内存中的免费模型表。
+
+    模型表从数据库加载后不再修改，刷新时构建一个新的快照并整体替换引用，
+    请求处理中读取的总是某一个完整的快照；模型检查和上下文长度查询都是O(1)的字典查找。
+    """
+    def __init__(self):
+        self._snapshot = _Snapshot(MappingProxyType({}))
+
+    async def reload(self) -> int:
+        """从数据库重新加载模型表，返回启用的模型数量。"""
+        rows = await async_crud.get_all_free_models_with_status()
+        self.replace(rows)
+        return self.active_count
+
+    def replace(self, rows: List[Dict[str, Any]]) -> None:
+        """用数据库中的模型行构建新的快照并替换当前快照。"""
+        now = int(time.time())
+        models = {}
+        for row in rows:
+            models[row["model_id"]] = ModelInfo(
+                model_id=row["model_id"],
+                model_name=row.get("model_name") or row["model_id"],
+                is_active=bool(row.get("is_active", True)),
+                context_length=row.get("context_length"),
+                parameters=row.get("parameters"),
+                parameter_count=row.get("parameter_count"),
+                # 上游没有提供创建时间的模型使用首次加载的时间，保证同一次刷新内不变
+                created=row.get("created") or now,
+            )
+        self._snapshot = _Snapshot(MappingProxyType(models))
+
+    # --- 查询 ---
+
+    def get(self, model_id: str) -> Optional[ModelInfo]:
+        return self._snapshot.models.get(model_id)
+
+    def is_allowed(self, model_id: str) -> bool:
+        """模型是否是启用的免费模型。"""
+        info = self._snapshot.models.get(model_id)
+        return info is not None and info.is_active
+
+    def context_length(self, model_id: str) -> Optional[int]:
+        """返回启用模型的上下文长度，未知时返回None。"""
+        info = self._snapshot.models.get(model_id)
+        if info is None or not info.is_active:
+            return None
+        return info.context_length or None
+
+    def models_response(self) -> Tuple[bytes, str]:
+        """返回预先序列化好的 /v1/models 响应体及其ETag。"""
+        snapshot = self._snapshot
+        return snapshot.models_body, snapshot.etag
+
+    def all_models(self) -> List[Dict[str, Any]]:
+        """按模型ID排序返回所有模型（包括未启用的），用于管理后台。"""
+        return [info._asdict() for _, info in sorted(self._snapshot.models.items())]
+
+    @property
+    def active_count(self) -> int:
+        return sum(1 for info in self._snapshot.models.values() if info.is_active)
+
+# 创建一个单例实例
+model_registry = ModelRegistry()
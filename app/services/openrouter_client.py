@@ -1,121 +1,287 @@
+import asyncio
 import httpx
 import logging
 import json
-from typing import List, Dict, Any, AsyncGenerator
+import random
+import time
+from typing import List, Dict, Any, AsyncGenerator, Optional, Tuple, Union
 
-from app import crud
+from app import async_crud
+from app.services.admission import AdmissionTicket
+from app.services.http_client import upstream_http
 from app.services.key_manager import key_manager
+from app.services.metrics import upstream_ttfb_seconds, stream_duration_seconds, inflight_streams
+from app.services.model_metadata import model_metadata
+from app.services.model_registry import model_registry
+from app.services.response_cache import response_cache
+from app.services.sse import SSEUsageParser
+from app.services.token_accounting import token_accountant, PromptCount
 from config import config
 
 logger = logging.getLogger(__name__)
 
+# 默认触发故障转移的上游状态码：Key无效、被限流或上游暂时故障
+DEFAULT_FAILOVER_STATUSES = [401, 429, 500, 502, 503, 504]
+
+def chat_headers(api_key: str) -> Dict[str, str]:
+    """转发聊天补全请求时使用的请求头。"""
+    return {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "HTTP-Referer": config.get('openrouter.http_referer'),
+        "X-Title": config.get('openrouter.x_title')
+    }
+
+class UpstreamAttempt:
+    """
+    故障转移后最终使用的一次上游请求。
+    response的响应体尚未读取，调用方负责关闭response，并调用 key_manager.release_key(key['id'], latency)。
+    """
+    __slots__ = ("key", "response", "latency", "attempts")
+
+    def __init__(self, key: Dict[str, Any], response: httpx.Response, latency: float, attempts: int):
+        self.key = key
+        self.response = response
+        self.latency = latency
+        self.attempts = attempts
+
+class ChatStream:
+    """
+    流式聊天补全的响应体，作为StreamingResponse的内容迭代。
+
+    开始迭代后，准入名额和Key由生成器的finally归还；客户端在响应开始之前断开时生成器不会运行，
+    aclose() 负责归还这两者。无论哪种情况，响应结束后都应该调用 aclose()，重复调用无副作用。
+    """
+    __slots__ = ("_generator", "_api_key_info", "_admission_ticket", "_started", "_closed")
+
+    def __init__(self, generator: AsyncGenerator[Union[bytes, str], None], api_key_info: Dict[str, Any], admission_ticket: Optional[AdmissionTicket]):
+        self._generator = generator
+        self._api_key_info = api_key_info
+        self._admission_ticket = admission_ticket
+        self._started = False
+        self._closed = False
+
+    def __aiter__(self) -> AsyncGenerator[Union[bytes, str], None]:
+        self._started = True
+        return self._generator
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        # 停在yield处的生成器在这里执行finally，不必等到被垃圾回收
+        await self._generator.aclose()
+        if self._started:
+            return
+        # 没有开始运行的生成器关闭时不会执行finally
+        if self._admission_ticket is not None:
+            self._admission_ticket.release()
+        key_manager.release_key(self._api_key_info['id'])
+
 class OpenRouterClient:
     """
     用于与OpenRouter API进行交互的客户端。
     """
-    async def fetch_models(self) -> List[Dict[str, Any]]:
-        """从OpenRouter获取所有可用模型。"""
+    def __init__(self):
+        # 上一次成功获取模型列表时上游返回的校验信息，用于条件请求
+        self._models_etag: Optional[str] = None
+        self._models_last_modified: Optional[str] = None
+        self._failover_attempts = max(1, config.get('proxy.failover.max_attempts', 3))
+        self._failover_deadline = config.get('proxy.failover.deadline', 20.0)
+        self._failover_backoff = config.get('proxy.failover.backoff_base', 0.05)
+        self._failover_backoff_max = config.get('proxy.failover.backoff_max', 1.0)
+        self._failover_statuses = frozenset(config.get('proxy.failover.statuses', DEFAULT_FAILOVER_STATUSES))
+
+    async def fetch_models(self, conditional: bool = False) -> Tuple[Optional[List[Dict[str, Any]]], Dict[str, Optional[str]]]:
+        """
+        从OpenRouter获取所有可用模型，返回 (模型列表, 校验信息)。
+        conditional为True时带上If-None-Match/If-Modified-Since，上游返回304（列表未变化）时模型列表为None；
+        请求失败时为空列表。校验信息是响应的ETag/Last-Modified，由调用方在模型表更新成功后保存。
+        """
+        headers = {
+            "HTTP-Referer": config.get('openrouter.http_referer'),
+            "X-Title": config.get('openrouter.x_title'),
+        }
+        if conditional:
+            if self._models_etag:
+                headers["If-None-Match"] = self._models_etag
+            if self._models_last_modified:
+                headers["If-Modified-Since"] = self._models_last_modified
         try:
-            async with httpx.AsyncClient(timeout=config.get('openrouter.request_timeout', 30.0)) as client:
-                response = await client.get(
-                    f"{config.get('openrouter.base_url')}/models",
-                    headers={
-                        "HTTP-Referer": config.get('openrouter.http_referer'),
-                        "X-Title": config.get('openrouter.x_title'),
-                    }
-                )
-                response.raise_for_status()
-                data = response.json()
-                return data.get('data', [])
+            response = await upstream_http.client.get(
+                f"{config.get('openrouter.base_url')}/models",
+                headers=headers
+            )
+            if response.status_code == 304:
+                return None, {}
+            response.raise_for_status()
+            data = response.json()
+            validators = {"etag": response.headers.get("etag"), "last_modified": response.headers.get("last-modified")}
+            return data.get('data', []), validators
         except httpx.HTTPStatusError as e:
             logger.error(f"获取OpenRouter模型列表失败，状态码: {e.response.status_code}, 响应: {e.response.text}")
         except Exception as e:
             logger.error(f"获取OpenRouter模型列表时发生未知错误: {e}")
-        return []
+        return [], {}
 
-    async def update_free_models_cache(self) -> int:
-        """获取最新的免费模型并更新数据库缓存。"""
-        models = await self.fetch_models()
+    async def update_free_models_cache(self, conditional: bool = False) -> Optional[int]:
+        """
+        获取最新的免费模型，按差异更新数据库并替换内存中的模型表。
+        返回当前启用的免费模型数量，获取失败时返回None。
+        上游的校验信息只在数据库和模型表都更新成功后保存，失败时清除，下一次刷新会重新获取完整列表。
+        """
+        models, validators = await self.fetch_models(conditional)
+        if models is None:
+            logger.info("免费模型列表未变化。")
+            return model_registry.active_count
         if not models:
             logger.warning("未能获取到任何模型，跳过免费模型更新。")
-            return 0
+            return None
             
         free_models = [
             model for model in models if config.get('openrouter.free_model_suffix') in model.get('id', '')
         ]
         
-        crud.update_free_models(free_models)
+        try:
+            changes = await async_crud.update_free_models(model_metadata.enrich(free_models))
+            if any(changes.values()) or not model_registry.active_count:
+                await model_registry.reload()
+        except Exception:
+            self._models_etag = None
+            self._models_last_modified = None
+            raise
+        self._models_etag = validators.get("etag")
+        self._models_last_modified = validators.get("last_modified")
         logger.info(f"✅ 成功更新了 {len(free_models)} 个免费模型。")
-        return len(free_models)
+        return model_registry.active_count
+
+    async def send_chat_completion(
+        self, api_key_info: Dict[str, Any], body: Dict, model: str, prompt: PromptCount
+    ) -> UpstreamAttempt:
+        """
+        发送聊天补全请求，在上游返回任何响应体之前进行故障转移。
 
-    async def stream_chat_completions(
-        self, body: Dict, headers: Dict, api_key_info: Dict, model: str
-    ) -> AsyncGenerator[str, None]:
-        """处理流式聊天补全请求，并从流中提取usage数据。"""
-        usage_data = None
+        api_key_info为已经由 key_manager.get_next_key() 选中的第一个Key。上游返回 proxy.failover.statuses
+        中的状态码或连接失败时，换一个尚未尝试过的Key重试，最多 proxy.failover.max_attempts 次；
+        重试前按指数退避等待，等待后会超过 proxy.failover.deadline 时不再重试。
+        失败的尝试各自写入一条使用记录并释放Key；最后一次尝试的响应交给调用方处理。
+        最后一次尝试连接失败时抛出异常（这次尝试同样已经记录并释放Key）。
+        """
+        url = f"{config.get('openrouter.base_url')}/chat/completions"
+        deadline = time.monotonic() + self._failover_deadline
+        tried = []
+        key = api_key_info
+        attempt = 0
+        while True:
+            attempt += 1
+            tried.append(key['id'])
+            request = upstream_http.client.build_request("POST", url, json=body, headers=chat_headers(key['api_key']))
+            request_start = time.monotonic()
+            try:
+                response = await upstream_http.client.send(request, stream=True)
+            except (httpx.TransportError, asyncio.CancelledError) as e:
+                if isinstance(e, httpx.TransportError):
+                    key_manager.report_upstream(key['id'], None, model=model)
+                key_manager.release_key(key['id'])
+                token_accountant.record(key['id'], model, 500, None, prompt)
+                next_key = self._failover_key(attempt, deadline, tried, model) if isinstance(e, httpx.TransportError) else None
+                if next_key is None:
+                    raise
+                logger.warning(f"🔁 Key {key['key_name']} 请求上游失败 ({e!r})，切换到下一个Key重试（第 {attempt} 次）")
+                key = await self._failover_backoff_wait(attempt, next_key)
+                continue
+
+            latency = time.monotonic() - request_start
+            upstream_ttfb_seconds.observe(latency)
+            key_manager.update_key_usage(key['id'])
+            status = response.status_code
+            key_manager.report_upstream(key['id'], status, latency, response.headers, model)
+            next_key = self._failover_key(attempt, deadline, tried, model) if status in self._failover_statuses else None
+            if next_key is None:
+                return UpstreamAttempt(key, response, latency, attempt)
+
+            try:
+                # 读完较短的错误响应体，让连接可以回到连接池
+                await response.aread()
+            except httpx.HTTPError:
+                pass
+            finally:
+                await response.aclose()
+            key_manager.release_key(key['id'], latency)
+            token_accountant.record(key['id'], model, status, None, prompt)
+            logger.warning(f"🔁 Key {key['key_name']} 返回 {status}，切换到下一个Key重试（第 {attempt} 次）")
+            key = await self._failover_backoff_wait(attempt, next_key)
+
+    def _failover_key(self, attempt: int, deadline: float, tried: List[int], model: str) -> Optional[Dict[str, Any]]:
+        """还可以重试时返回下一个尚未尝试过的Key（已占用并发计数），否则返回None。"""
+        if attempt >= self._failover_attempts:
+            return None
+        if time.monotonic() + self._backoff_delay(attempt) >= deadline:
+            return None
+        return key_manager.get_next_key(exclude=tried, model=model)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        return min(self._failover_backoff_max, self._failover_backoff * (2 ** (attempt - 1)))
+
+    async def _failover_backoff_wait(self, attempt: int, next_key: Dict[str, Any]) -> Dict[str, Any]:
+        delay = self._backoff_delay(attempt) * random.uniform(0.5, 1.0)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                key_manager.release_key(next_key['id'])
+                raise
+        return next_key
+
+    def stream_chat_completions(
+        self, body: Dict, api_key_info: Dict, model: str, prompt: PromptCount,
+        admission_ticket: Optional[AdmissionTicket] = None, cache_key: Optional[str] = None,
+    ) -> ChatStream:
+        """
+        处理流式聊天补全请求，并从流中提取usage数据。prompt为请求开始时计算的输入token数。
+        在向客户端发送第一个字节之前，失败的Key会由 send_chat_completion() 故障转移到其它Key。
+        admission_ticket为请求占用的准入名额，和api_key_info一起在流结束时（或 ChatStream.aclose() 中）归还。
+        传入cache_key时记录事件，流完整结束后存入响应缓存。
+        """
+        return ChatStream(
+            self._stream_chat_completions(body, api_key_info, model, prompt, admission_ticket, cache_key),
+            api_key_info, admission_ticket,
+        )
+
+    async def _stream_chat_completions(
+        self, body: Dict, api_key_info: Dict, model: str, prompt: PromptCount,
+        admission_ticket: Optional[AdmissionTicket], cache_key: Optional[str],
+    ) -> AsyncGenerator[Union[bytes, str], None]:
         status_code = 500
-        
-        # 用于备用token估算的变量
-        estimated_prompt_tokens = 0
-        estimated_completion_tokens = 0
-        completion_content = ""
-        
+        attempt = None
+        parser = SSEUsageParser(response_cache.max_entry_bytes if cache_key is not None else 0)
+        stream_start = time.monotonic()
+        inflight_streams.inc()
+
         try:
-            # 估算输入token数量（简单估算：4个字符约等于1个token）
-            estimated_prompt_tokens = self._estimate_tokens_from_messages(body.get("messages", []))
-            
-            async with httpx.AsyncClient(timeout=config.get('openrouter.request_timeout', 60.0)) as client:
-                async with client.stream(
-                    "POST",
-                    f"{config.get('openrouter.base_url')}/chat/completions",
-                    json=body,
-                    headers=headers
-                ) as response:
-                    key_manager.update_key_usage(api_key_info['id'])
-                    status_code = response.status_code
-
-                    if response.status_code != 200:
-                        error_content = await response.aread()
-                        error_message = error_content.decode('utf-8', errors='ignore')
-                        error_data = {
-                            "error": {
-                                "message": f"OpenRouter API error: {response.status_code} - {error_message}",
-                                "type": "api_error",
-                                "code": response.status_code
-                            }
-                        }
-                        yield f"data: {json.dumps(error_data)}\n\n"
-                        return
-
-                    async for chunk in response.aiter_bytes():
-                        if chunk:
-                            chunk_str = chunk.decode('utf-8', errors='ignore')
-                            yield chunk_str
-                            
-                            lines = chunk_str.strip().split('\n')
-                            for line in lines:
-                                if line.startswith('data:'):
-                                    data_str = line[len('data:'):].strip()
-                                    if data_str == '[DONE]':
-                                        continue
-                                    try:
-                                        data_json = json.loads(data_str)
-                                        
-                                        # 提取usage数据
-                                        if 'usage' in data_json:
-                                            usage_data = data_json['usage']
-                                            logger.info(f"📊 从流中获取到usage数据: {usage_data}")
-                                        
-                                        # 收集completion内容用于备用估算
-                                        if 'choices' in data_json and len(data_json['choices']) > 0:
-                                            choice = data_json['choices'][0]
-                                            if 'delta' in choice and 'content' in choice['delta']:
-                                                content = choice['delta']['content']
-                                                if content:
-                                                    completion_content += content
-                                                    
-                                    except json.JSONDecodeError:
-                                        pass
+            attempt = await self.send_chat_completion(api_key_info, body, model, prompt)
+            response = attempt.response
+            status_code = response.status_code
+
+            if response.status_code != 200:
+                error_content = await response.aread()
+                error_message = error_content.decode('utf-8', errors='ignore')
+                error_data = {
+                    "error": {
+                        "message": f"OpenRouter API error: {response.status_code} - {error_message}",
+                        "type": "api_error",
+                        "code": response.status_code
+                    }
+                }
+                yield f"data: {json.dumps(error_data)}\n\n"
+                return
+
+            # 上游的字节块原样转发，解析器只在旁边增量提取usage和内容
+            async for chunk in response.aiter_bytes():
+                if chunk:
+                    yield chunk
+                    parser.feed(chunk)
+            parser.close()
         except Exception as e:
             logger.error(f"流式处理错误: {e}")
             error_data = {
@@ -124,54 +290,23 @@ class OpenRouterClient:
             yield f"data: {json.dumps(error_data)}\n\n"
             status_code = 500
         finally:
-            # 优先使用API返回的usage数据
-            if usage_data:
-                prompt_tokens = usage_data.get("prompt_tokens", 0)
-                completion_tokens = usage_data.get("completion_tokens", 0)
-                total_tokens = usage_data.get("total_tokens", 0)
-                logger.info(f"✅ 使用API返回的token统计: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}")
-            else:
-                # 备用方案：使用估算的token数量
-                estimated_completion_tokens = self._estimate_tokens_from_text(completion_content)
-                prompt_tokens = estimated_prompt_tokens
-                completion_tokens = estimated_completion_tokens
-                total_tokens = prompt_tokens + completion_tokens
-                logger.warning(f"⚠️ API未返回usage数据，使用估算值: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}")
-            
-            crud.log_usage(
-                api_key_id=api_key_info['id'],
-                model=model,
-                prompt_tokens=prompt_tokens,
-                completion_tokens=completion_tokens,
-                total_tokens=total_tokens,
-                cost=0.0,
-                status=status_code
-            )
-    
-    def _estimate_tokens_from_messages(self, messages: list) -> int:
-        """从消息列表估算token数量"""
-        total_chars = 0
-        for message in messages:
-            if isinstance(message, dict):
-                content = message.get("content", "")
-                if isinstance(content, str):
-                    total_chars += len(content)
-                elif isinstance(content, list):
-                    # 处理多模态内容
-                    for item in content:
-                        if isinstance(item, dict) and item.get("type") == "text":
-                            total_chars += len(item.get("text", ""))
-        
-        # 简单估算：平均4个字符约等于1个token（对中文更准确）
-        estimated_tokens = max(1, total_chars // 3)  # 对中文使用更保守的估算
-        return estimated_tokens
-    
-    def _estimate_tokens_from_text(self, text: str) -> int:
-        """从文本估算token数量"""
-        if not text:
-            return 0
-        # 简单估算：平均3个字符约等于1个token（对中文更准确）
-        return max(1, len(text) // 3)
+            inflight_streams.dec()
+            stream_duration_seconds.observe(time.monotonic() - stream_start)
+            if admission_ticket is not None:
+                admission_ticket.release()
+            # 没有拿到最终响应时，每次尝试都已经在send_chat_completion中记录并释放了Key
+            if attempt is not None:
+                await attempt.response.aclose()
+                key_manager.release_key(attempt.key['id'], attempt.latency)
+
+                usage_data = parser.usage
+                if usage_data:
+                    logger.debug(f"✅ 使用API返回的token统计: prompt={usage_data.get('prompt_tokens', 0)}, completion={usage_data.get('completion_tokens', 0)}, total={usage_data.get('total_tokens', 0)}")
+                # 没有usage时由token_accountant在后台用tokenizer精确计算
+                token_accountant.record(attempt.key['id'], model, status_code, usage_data, prompt, parser.content)
+                transcript = parser.transcript
+                if cache_key is not None and status_code == 200 and transcript is not None:
+                    response_cache.put(cache_key, transcript, usage_data)
 
 # 创建一个单例实例
 openrouter_client = OpenRouterClient()
\ No newline at end of file
@@ -0,0 +1,177 @@
+import time
+from typing import Optional, Dict, Any, Mapping, Iterable
+
+from app.services.circuit_breaker import parse_retry_at
+from config import config
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+class TokenBucket:
+    """
+    令牌桶：容量为capacity，每秒补充rate个令牌。
+    updated可以是将来的时间，表示在那之前不补充令牌（例如上游返回429后等待到Retry-After）。
+    """
+    __slots__ = ("capacity", "rate", "tokens", "updated")
+
+    def __init__(self, capacity: float, rate: float, now: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def available(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def next_token_at(self, now: float) -> float:
+        """下一个令牌可用的时间。"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return now
+        start = max(now, self.updated)
+        return start + (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def seed(self, limit: Optional[float], remaining: Optional[float], reset_at: Optional[float], now: float) -> None:
+        """用上游返回的 X-RateLimit-Limit/Remaining/Reset 校正桶的容量、剩余令牌和补充速度。"""
+        self._refill(now)
+        if limit is not None and limit > 0:
+            self.capacity = limit
+        if remaining is not None:
+            self.tokens = min(self.capacity, max(0.0, remaining))
+            if reset_at is not None and reset_at > now:
+                # 到重置时间时恰好补满
+                missing = self.capacity - self.tokens
+                if missing > 0:
+                    self.rate = missing / (reset_at - now)
+
+    def block_until(self, until: float) -> None:
+        """清空令牌，在until之前不再补充。"""
+        self.tokens = 0.0
+        self.updated = max(self.updated, until)
+
+    def as_dict(self, now: float) -> Dict[str, Any]:
+        self._refill(now)
+        return {
+            "capacity": self.capacity,
+            "tokens": round(max(0.0, self.tokens), 2),
+            "refill_per_second": round(self.rate, 4),
+            "blocked_for": round(max(0.0, self.updated - now), 1),
+        }
+
+class KeyRateLimiter:
+    """
+    每个Key以及每个 (Key, 模型) 的令牌桶，在请求发出之前预估上游的限流，避免把请求发给必然返回429的Key。
+
+    每个Key的桶按 proxy.rate_limit.key_requests_per_minute 创建（0表示不限制），
+    每个 (Key, 模型) 的桶按 model_requests_per_minute 创建；上游响应中的 X-RateLimit-* 响应头会校正对应的桶，
+    429会清空 (Key, 模型) 的桶直到Retry-After/X-RateLimit-Reset；带有X-RateLimit-*响应头的429只影响这个模型，不熔断整个Key。
+    """
+    def __init__(self):
+        self._enabled = config.get('proxy.rate_limit.enabled', True)
+        self._key_rpm = config.get('proxy.rate_limit.key_requests_per_minute', 0)
+        self._model_rpm = config.get('proxy.rate_limit.model_requests_per_minute', 20)
+        self._key_buckets: Dict[int, TokenBucket] = {}
+        # Key ID -> 模型 -> 令牌桶
+        self._model_buckets: Dict[int, Dict[str, TokenBucket]] = {}
+
+    def _key_bucket(self, key_id: int, now: float) -> Optional[TokenBucket]:
+        bucket = self._key_buckets.get(key_id)
+        if bucket is None and self._key_rpm > 0:
+            bucket = self._key_buckets[key_id] = TokenBucket(self._key_rpm, self._key_rpm / 60, now)
+        return bucket
+
+    def _model_bucket(self, key_id: int, model: Optional[str], now: float) -> Optional[TokenBucket]:
+        if not model:
+            return None
+        buckets = self._model_buckets.setdefault(key_id, {})
+        bucket = buckets.get(model)
+        if bucket is None and self._model_rpm > 0:
+            bucket = buckets[model] = TokenBucket(self._model_rpm, self._model_rpm / 60, now)
+        return bucket
+
+    def _existing_model_bucket(self, key_id: int, model: Optional[str]) -> Optional[TokenBucket]:
+        buckets = self._model_buckets.get(key_id)
+        return buckets.get(model) if buckets and model else None
+
+    def allows(self, key_id: int, model: Optional[str], now: float) -> bool:
+        """Key（以及Key在这个模型上）的桶中是否还有令牌。"""
+        if not self._enabled:
+            return True
+        bucket = self._key_buckets.get(key_id)
+        if bucket is not None and not bucket.available(now):
+            return False
+        bucket = self._existing_model_bucket(key_id, model)
+        return bucket is None or bucket.available(now)
+
+    def acquire(self, key_id: int, model: Optional[str], now: float) -> None:
+        """Key被选中后从桶中取出一个令牌。"""
+        if not self._enabled:
+            return
+        for bucket in (self._key_bucket(key_id, now), self._model_bucket(key_id, model, now)):
+            if bucket is not None:
+                bucket.take(now)
+
+    def observe(self, key_id: int, model: Optional[str], status: Optional[int], headers: Optional[Mapping[str, str]], now: float) -> bool:
+        """
+        根据上游的响应头校正 (Key, 模型) 的桶。
+        返回429是否只针对这个模型（带有X-RateLimit-*响应头，已经由 (Key, 模型) 的桶处理），此时不需要熔断整个Key。
+        """
+        if not self._enabled or not headers:
+            return False
+        bucket = self._model_bucket(key_id, model, now) if model else self._key_bucket(key_id, now)
+        if bucket is None:
+            return False
+        limit = _header_number(headers, "x-ratelimit-limit")
+        remaining = _header_number(headers, "x-ratelimit-remaining")
+        if status == 429:
+            bucket.block_until(parse_retry_at(headers, now) or now + 60.0 / max(1.0, bucket.capacity))
+            return bool(model) and (limit is not None or remaining is not None or "x-ratelimit-reset" in headers)
+        if limit is None and remaining is None:
+            return False
+        reset_at = parse_retry_at({"x-ratelimit-reset": headers.get("x-ratelimit-reset", "")}, now)
+        bucket.seed(limit, remaining, reset_at, now)
+        return False
+
+    def next_available(self, key_ids: Iterable[int], model: Optional[str], now: Optional[float] = None) -> Optional[float]:
+        """这些Key中最早有令牌的时间，没有Key时返回None。"""
+        now = time.time() if now is None else now
+        earliest = None
+        for key_id in key_ids:
+            at = now
+            for bucket in (self._key_buckets.get(key_id), self._existing_model_bucket(key_id, model)):
+                if bucket is not None:
+                    at = max(at, bucket.next_token_at(now))
+            if earliest is None or at < earliest:
+                earliest = at
+        return earliest
+
+    def key_stats(self, key_id: int) -> Dict[str, Any]:
+        now = time.time()
+        bucket = self._key_buckets.get(key_id)
+        return {
+            "key": bucket.as_dict(now) if bucket is not None else None,
+            "models": {model: b.as_dict(now) for model, b in self._model_buckets.get(key_id, {}).items()},
+        }
+
+    def retain(self, key_ids: Iterable[int]) -> None:
+        """只保留仍然激活的Key的桶。"""
+        key_ids = set(key_ids)
+        self._key_buckets = {k: b for k, b in self._key_buckets.items() if k in key_ids}
+        self._model_buckets = {k: b for k, b in self._model_buckets.items() if k in key_ids}
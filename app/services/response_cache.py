@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Mapping, Set
+
+from app import async_crud
+from app.services.metrics import metrics
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 缓存命中写入使用记录时使用的状态码（203 Non-Authoritative Information），
+# 这些记录没有对应的Key（api_key_id为NULL），不计入任何Key的额度
+CACHE_HIT_STATUS = 203
+
+# 不影响响应内容的请求字段，不参与缓存键的计算
+IGNORED_FIELDS = ("stream", "stream_options")
+
+_lookups = metrics.counter("openrouter_proxy_response_cache_lookups_total", "响应缓存的查询次数", ("result",))
+_memory_hits = _lookups.labels("memory_hit")
+_sqlite_hits = _lookups.labels("sqlite_hit")
+_misses = _lookups.labels("miss")
+
+class CachedResponse:
+    """
+    一条缓存的上游响应和其中的usage。
+    非流式请求的body是上游的原始响应体；流式请求的body是 SSEUsageParser.transcript 记录的事件，回放时用 frame_transcript() 组装。
+    """
+    __slots__ = ("body", "usage", "expires_at", "size")
+
+    def __init__(self, body: bytes, usage: Optional[Dict[str, Any]], expires_at: float):
+        self.body = body
+        self.usage = usage
+        self.expires_at = expires_at
+        self.size = len(body)
+
+class ResponseCache:
+    """
+    聊天补全的精确匹配缓存（默认关闭，由 response_cache.enabled 开启）。
+
+    缓存键是请求体按键排序、紧凑序列化后的哈希，只缓存确定性的请求（deterministic_only 为true时要求 temperature 为0）
+    和上游返回200的响应。流式请求的缓存键带有 "sse:" 前缀，保存完整结束的事件记录，与非流式响应共用下面的大小上限和淘汰顺序。
+    第一层是内存中的LRU，条目超过 ttl 秒后失效，总大小不超过 max_bytes、条目数不超过 max_entries；
+    sqlite.enabled 为true时，条目同时在后台写入SQLite作为第二层，内存未命中时再查询，总大小不超过 sqlite.max_bytes，超出时先删除最早写入的条目。
+    请求带有 bypass_header 时既不读取也不写入缓存。
+    """
+    def __init__(self):
+        self.enabled = config.get('response_cache.enabled', False)
+        self._ttl = config.get('response_cache.ttl', 3600)
+        self._max_entries = config.get('response_cache.max_entries', 1024)
+        self._max_bytes = config.get('response_cache.max_bytes', 64 * 1024 * 1024)
+        self._max_entry_bytes = config.get('response_cache.max_entry_bytes', 1024 * 1024)
+        self._deterministic_only = config.get('response_cache.deterministic_only', True)
+        self.bypass_header = config.get('response_cache.bypass_header', 'X-Cache-Bypass').lower()
+        self._sqlite = self.enabled and config.get('response_cache.sqlite.enabled', False)
+        self._sqlite_max_bytes = config.get('response_cache.sqlite.max_bytes', 256 * 1024 * 1024)
+
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self._pending: Set[asyncio.Task] = set()
+        self._stats = {"memory_hits": 0, "sqlite_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "too_large": 0}
+
+    def cache_key(self, body: Dict[str, Any]) -> Optional[str]:
+        """返回请求的缓存键，缓存未启用或请求不可缓存时返回None。"""
+        if not self.enabled:
+            return None
+        if self._deterministic_only and (body.get("temperature") != 0 or body.get("n", 1) != 1):
+            return None
+        canonical = {k: v for k, v in body.items() if k not in IGNORED_FIELDS}
+        try:
+            raw = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        except (TypeError, ValueError):
+            return None
+        digest = hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+        return "sse:" + digest if body.get("stream") else digest
+
+    @property
+    def max_entry_bytes(self) -> int:
+        return self._max_entry_bytes
+
+    def bypassed(self, headers: Mapping[str, str]) -> bool:
+        value = headers.get(self.bypass_header)
+        return value is not None and value.lower() not in ("", "0", "false", "no")
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        """先查内存，再查SQLite（命中后放回内存），都未命中时返回None。"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > now:
+                self._entries.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                _memory_hits.inc()
+                return entry
+            self._remove(key)
+            self._stats["expired"] += 1
+
+        if self._sqlite:
+            try:
+                row = await async_crud.get_cached_response(key, now)
+            except Exception as e:
+                logger.error(f"❌ 读取SQLite响应缓存失败: {e}")
+                row = None
+            if row is not None:
+                body, usage, expires_at = row
+                entry = CachedResponse(body, json.loads(usage) if usage else None, expires_at)
+                self._insert(key, entry)
+                self._stats["sqlite_hits"] += 1
+                _sqlite_hits.inc()
+                return entry
+
+        self._stats["misses"] += 1
+        _misses.inc()
+        return None
+
+    def put(self, key: str, body: bytes, usage: Optional[Dict[str, Any]]) -> None:
+        """缓存一个上游响应，需要时在后台写入SQLite。"""
+        if len(body) > self._max_entry_bytes:
+            self._stats["too_large"] += 1
+            return
+        now = time.time()
+        entry = CachedResponse(body, usage, now + self._ttl)
+        self._insert(key, entry)
+        self._stats["stores"] += 1
+        if self._sqlite:
+            task = asyncio.create_task(self._write_through(key, entry, now))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _write_through(self, key: str, entry: CachedResponse, now: float) -> None:
+        try:
+            usage = json.dumps(entry.usage) if entry.usage else None
+            await async_crud.put_cached_response(key, entry.body, usage, now, entry.expires_at, self._sqlite_max_bytes)
+        except Exception as e:
+            logger.error(f"❌ 写入SQLite响应缓存失败: {e}")
+
+    def _insert(self, key: str, entry: CachedResponse) -> None:
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._entries and (self._bytes > self._max_bytes or len(self._entries) > self._max_entries):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self._stats["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    async def clear(self) -> None:
+        """清空内存和SQLite中的缓存。"""
+        self._entries.clear()
+        self._bytes = 0
+        if self._sqlite:
+            await self.drain()
+            await async_crud.clear_response_cache()
+
+    async def drain(self) -> None:
+        """等待后台的SQLite写入完成，在关闭数据库线程池之前调用。"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sqlite": self._sqlite,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self._max_entries,
+            "max_bytes": self._max_bytes,
+            "ttl": self._ttl,
+            "pending_writes": len(self._pending),
+            **self._stats,
+        }
+
+# 创建一个单例实例
+response_cache = ResponseCache()
@@ -0,0 +1,287 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+
+from app import async_crud, crud
+from app.database import run_analytics
+from app.services.log_count_cache import usage_log_counts
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 归档目录结构: <archive_dir>/usage_logs/date=YYYY-MM-DD/part-<第一条id>-<最后一条id>.jsonl.gz
+_PARTITION_PREFIX = "date="
+_PART_PATTERN = re.compile(r"^part-(\d+)-(\d+)\.jsonl\.gz$")
+
+def _archive_root() -> str:
+    return os.path.join(config.get('retention.archive_dir', 'archive'), 'usage_logs')
+
+def _partition_dir(day: str) -> str:
+    return os.path.join(_archive_root(), f"{_PARTITION_PREFIX}{day}")
+
+def _list_parts(day: str) -> List[Tuple[int, int, str]]:
+    """返回某一天已归档的分片 [(第一条id, 最后一条id, 路径)]，按id排序。"""
+    directory = _partition_dir(day)
+    if not os.path.isdir(directory):
+        return []
+    parts = []
+    for name in os.listdir(directory):
+        match = _PART_PATTERN.match(name)
+        if match:
+            parts.append((int(match.group(1)), int(match.group(2)), os.path.join(directory, name)))
+    parts.sort()
+    return parts
+
+def _export_day(day: str, after_id: int, batch_size: int) -> Tuple[int, int]:
+    """
+    把某一天id大于after_id的记录写入一个新的压缩分片，返回 (写入条数, 最后一条id)。
+    先写入临时文件并fsync，再原子重命名，中途失败不会留下不完整的分片。
+    """
+    directory = _partition_dir(day)
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".part-{after_id}.tmp")
+    first_id, last_id, count = None, after_id, 0
+    try:
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as gz:
+                while True:
+                    rows = crud.fetch_usage_logs_for_archive(day, last_id, batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        gz.write(json.dumps(row, ensure_ascii=False).encode('utf-8'))
+                        gz.write(b"\n")
+                    if first_id is None:
+                        first_id = rows[0]["id"]
+                    last_id = rows[-1]["id"]
+                    count += len(rows)
+            raw.flush()
+            os.fsync(raw.fileno())
+        if count:
+            os.replace(tmp_path, os.path.join(directory, f"part-{first_id:012d}-{last_id:012d}.jsonl.gz"))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return count, last_id
+
+# --- 归档数据的只读访问 ---
+
+def list_partitions() -> List[Dict[str, Any]]:
+    """列出所有已归档的日期分区。"""
+    root = _archive_root()
+    if not os.path.isdir(root):
+        return []
+    partitions = []
+    for name in sorted(os.listdir(root)):
+        if not name.startswith(_PARTITION_PREFIX):
+            continue
+        day = name[len(_PARTITION_PREFIX):]
+        parts = _list_parts(day)
+        if parts:
+            partitions.append({
+                "date": day,
+                "parts": len(parts),
+                "first_id": parts[0][0],
+                "last_id": parts[-1][1],
+                "bytes": sum(os.path.getsize(path) for _, _, path in parts),
+            })
+    return partitions
+
+def _matches(row: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    if filters.get("key_filter") and str(row.get("api_key_id")) != str(filters["key_filter"]):
+        return False
+    if filters.get("model_filter") and row.get("model") != filters["model_filter"]:
+        return False
+    status = row.get("response_status") or 0
+    if filters.get("status_filter") == "200" and not 200 <= status < 300:
+        return False
+    if filters.get("status_filter") == "400" and status < 400:
+        return False
+    return True
+
+def query_archived_logs(start_date: str, end_date: str, limit: int, **filters) -> Dict[str, Any]:
+    """按时间顺序读取 [start_date, end_date] 内已归档的记录，最多返回limit条。"""
+    logs: List[Dict[str, Any]] = []
+    for partition in list_partitions():
+        if not (start_date <= partition["date"] <= end_date):
+            continue
+        for _, _, path in _list_parts(partition["date"]):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    row = json.loads(line)
+                    if not _matches(row, filters):
+                        continue
+                    if len(logs) >= limit:
+                        return {"logs": logs, "truncated": True}
+                    logs.append(row)
+    return {"logs": logs, "truncated": False}
+
+class RetentionManager:
+    """
+    usage_logs的保留策略。
+
+    超过retention_days天的记录按天导出为gzip压缩的JSON Lines分片，然后分批从数据库中删除，
+    每批之间让出写入线程给使用记录的批量写入；最后用incremental_vacuum逐步把空闲页归还给文件系统。
+    每一天都是先确认分片已写入磁盘再删除，中途中断后重新执行不会重复归档或丢失记录。
+    小时/天汇总表不受影响，仪表盘的历史统计仍然完整。
+    """
+    def __init__(self):
+        self._enabled = config.get('retention.enabled', False)
+        self._retention_days = config.get('retention.retention_days', 30)
+        self._interval = config.get('retention.interval_hours', 24) * 3600
+        self._batch_size = config.get('retention.batch_size', 1000)
+        self._batch_pause = config.get('retention.batch_pause', 0.05)
+        self._vacuum_pages = config.get('retention.vacuum_pages', 1000)
+
+        self._task: Optional[asyncio.Task] = None
+        self._run_task: Optional[asyncio.Task] = None
+        self._progress: Dict[str, Any] = {
+            "phase": "idle",
+            "current_day": None,
+            "days_done": 0,
+            "rows_archived": 0,
+            "rows_deleted": 0,
+            "pages_freed": 0,
+            "started_at": None,
+            "finished_at": None,
+            "last_error": None,
+        }
+
+    # --- 生命周期 ---
+
+    async def start(self) -> None:
+        """启用时启动定期执行保留策略的后台任务。"""
+        if not self._enabled or self._task is not None:
+            return
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"✅ 使用记录保留任务已启动: 保留 {self._retention_days} 天，每 {self._interval / 3600:g} 小时执行一次")
+
+    async def stop(self) -> None:
+        for task in (self._task, self._run_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self._run_task = None
+
+    @property
+    def running(self) -> bool:
+        return self._run_task is not None and not self._run_task.done()
+
+    def trigger(self, retention_days: Optional[int] = None) -> bool:
+        """立即在后台执行一次，已经在执行时返回False。"""
+        if self.running:
+            return False
+        self._run_task = asyncio.create_task(self.run_once(retention_days))
+        return True
+
+    async def _loop(self) -> None:
+        while True:
+            if not self.running:
+                self._run_task = asyncio.create_task(self.run_once())
+            await self._run_task
+            await asyncio.sleep(self._interval)
+
+    # --- 执行 ---
+
+    async def run_once(self, retention_days: Optional[int] = None) -> Dict[str, Any]:
+        """归档并删除早于保留期的记录，返回本次执行的进度信息。"""
+        days = self._retention_days if retention_days is None else retention_days
+        cutoff = (datetime.utcnow().date() - timedelta(days=days)).isoformat()
+        progress = self._progress
+        progress.update({
+            "phase": "archiving", "current_day": None, "cutoff": cutoff,
+            "days_done": 0, "rows_archived": 0, "rows_deleted": 0, "pages_freed": 0,
+            "started_at": crud.utc_now_str(), "finished_at": None, "last_error": None,
+        })
+        logger.info(f"🗄️ 开始归档 {cutoff} 之前的使用记录...")
+        try:
+            while True:
+                day = await async_crud.get_oldest_usage_log_day()
+                if day is None or day >= cutoff:
+                    break
+                progress["current_day"] = day
+                await self._archive_day(day)
+                progress["days_done"] += 1
+
+            progress["phase"] = "vacuuming"
+            progress["current_day"] = None
+            await self._vacuum()
+            progress["phase"] = "idle"
+            logger.info(f"✅ 归档完成: {progress['days_done']} 天，归档 {progress['rows_archived']} 条，删除 {progress['rows_deleted']} 条，释放 {progress['pages_freed']} 页")
+        except asyncio.CancelledError:
+            progress["phase"] = "cancelled"
+            raise
+        except Exception as e:
+            progress["phase"] = "failed"
+            progress["last_error"] = str(e)
+            logger.error(f"❌ 归档使用记录失败: {e}")
+        finally:
+            progress["finished_at"] = crud.utc_now_str()
+            usage_log_counts.invalidate()
+        return dict(progress)
+
+    async def _archive_day(self, day: str) -> None:
+        # 已有分片覆盖的记录只需删除；之后才出现的记录写入新的分片
+        parts = await run_analytics(_list_parts, day)
+        archived_up_to = parts[-1][1] if parts else 0
+        count, archived_up_to = await run_analytics(_export_day, day, archived_up_to, self._batch_size)
+        self._progress["rows_archived"] += count
+
+        total_deleted = 0
+        while True:
+            deleted = await async_crud.delete_usage_logs_batch(day, archived_up_to, self._batch_size)
+            total_deleted += deleted
+            self._progress["rows_deleted"] += deleted
+            if deleted < self._batch_size:
+                break
+            await asyncio.sleep(self._batch_pause)
+
+        if not count and not total_deleted:
+            # 例如request_time格式无法解析，避免一直停在同一天
+            raise RuntimeError(f"无法归档 {day} 的记录")
+
+    async def _vacuum(self) -> None:
+        status = await async_crud.get_vacuum_status()
+        if status["auto_vacuum"] != "incremental":
+            if status["freelist_count"]:
+                logger.warning("⚠️ 数据库未启用auto_vacuum=INCREMENTAL，删除释放的空间不会归还给文件系统，可运行 python migrate_db.py --enable-incremental-vacuum")
+            return
+        while True:
+            freed = await async_crud.incremental_vacuum(self._vacuum_pages)
+            self._progress["pages_freed"] += freed
+            if freed < self._vacuum_pages:
+                break
+            await asyncio.sleep(self._batch_pause)
+
+    # --- 归档查询（文件读取在只读的分析线程池中执行） ---
+
+    async def partitions(self) -> List[Dict[str, Any]]:
+        return await run_analytics(list_partitions)
+
+    async def query_archive(self, start_date: str, end_date: str, limit: int, **filters) -> Dict[str, Any]:
+        return await run_analytics(query_archived_logs, start_date, end_date, limit, **filters)
+
+    # --- 状态 ---
+
+    async def status(self) -> Dict[str, Any]:
+        """返回配置、当前/上一次执行的进度和数据库文件的空间使用情况。"""
+        return {
+            "enabled": self._enabled,
+            "retention_days": self._retention_days,
+            "interval_hours": self._interval / 3600,
+            "running": self.running,
+            "progress": dict(self._progress),
+            "database": await async_crud.get_vacuum_status(),
+        }
+
+# 创建一个单例实例
+retention_manager = RetentionManager()
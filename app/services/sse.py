@@ -0,0 +1,123 @@
+import json
+from typing import Optional, Dict, Any, List
+
+_decoder = json.JSONDecoder()
+
+# 只有包含这些字段的事件才需要解析JSON
+_USAGE_MARKER = b'"usage"'
+_CONTENT_MARKER = b'"content"'
+_DONE = b"[DONE]"
+
+def frame_transcript(transcript: bytes) -> bytes:
+    """把 SSEUsageParser.transcript 记录的事件重新组装为完整的 text/event-stream 响应体。"""
+    if not transcript:
+        return b"data: [DONE]\n\n"
+    return b"data: " + transcript.replace(b"\n", b"\n\ndata: ") + b"\n\ndata: [DONE]\n\n"
+
+class SSEUsageParser:
+    """
+    增量解析上游的SSE字节流，提取usage和生成的内容。
+
+    调用方把上游的原始字节块原样转发给客户端，同时交给feed()；解析器自己维护字节缓冲区，
+    只在收到完整的事件（以空行结束）后才处理，因此跨块的data行和被截断的多字节UTF-8字符都不会丢失。
+    只有可能包含usage或delta.content的事件才会执行json.loads，内容片段保存在列表中，最后一次性拼接。
+
+    record_limit大于0时同时记录每个事件的data（不含注释行和 [DONE]），用于响应缓存的回放；
+    记录超过record_limit字节或遇到多行data时放弃记录。
+    """
+    __slots__ = ("_buffer", "_data", "_content", "usage", "done", "_events", "_recorded", "_record_limit")
+
+    def __init__(self, record_limit: int = 0):
+        self._buffer = bytearray()
+        # 当前事件中尚未分发的data行
+        self._data: List[bytes] = []
+        self._content: List[str] = []
+        self.usage: Optional[Dict[str, Any]] = None
+        # 是否收到了 [DONE]，即上游的流是否完整结束
+        self.done = False
+        self._events: Optional[List[bytes]] = [] if record_limit > 0 else None
+        self._recorded = 0
+        self._record_limit = record_limit
+
+    def feed(self, chunk: bytes) -> None:
+        """处理一个上游字节块。"""
+        buffer = self._buffer
+        if buffer:
+            # 缓冲区中只有一行尚未结束的内容，只需要在新的字节中查找换行，避免长行被反复复制和切分
+            scanned = len(buffer)
+            buffer += chunk
+            end = buffer.rfind(b"\n", scanned)
+            if end < 0:
+                return
+            lines = bytes(buffer[:end]).split(b"\n")
+            del buffer[:end + 1]
+        else:
+            lines = chunk.split(b"\n")
+            # 最后一段没有换行，留到下一块
+            tail = lines.pop()
+            if tail:
+                buffer += tail
+        data = self._data
+        for line in lines:
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                if data:
+                    self._dispatch()
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                data.append(value[1:] if value.startswith(b" ") else value)
+            # 注释行（例如 ": OPENROUTER PROCESSING"）以及event/id/retry字段不需要处理
+
+    def close(self) -> None:
+        """流结束时处理缓冲区中没有以换行结束的最后一个事件。"""
+        if self._buffer:
+            self.feed(b"\n")
+        if self._data:
+            self._dispatch()
+
+    @property
+    def content(self) -> str:
+        """目前为止收到的所有delta.content。"""
+        return "".join(self._content)
+
+    @property
+    def transcript(self) -> Optional[bytes]:
+        """记录的事件，每行一个data；没有开启记录、记录被放弃或流没有完整结束时为None。"""
+        if self._events is None or not self.done:
+            return None
+        return b"\n".join(self._events)
+
+    def _dispatch(self) -> None:
+        multiline = len(self._data) > 1
+        data = b"\n".join(self._data) if multiline else self._data[0]
+        self._data.clear()
+        if data == _DONE:
+            self.done = True
+            return
+        if self._events is not None:
+            self._recorded += len(data) + 1
+            if multiline or self._recorded > self._record_limit:
+                self._events = None
+            else:
+                self._events.append(data)
+        # 绝大多数事件都带有content，先检查它
+        if _CONTENT_MARKER not in data and _USAGE_MARKER not in data:
+            return
+        try:
+            event, _ = _decoder.raw_decode(data.decode("utf-8"))
+        except ValueError:
+            return
+        if not isinstance(event, dict):
+            return
+
+        usage = event.get("usage")
+        if usage:
+            self.usage = usage
+        choices = event.get("choices")
+        if choices and isinstance(choices[0], dict):
+            delta = choices[0].get("delta")
+            if isinstance(delta, dict):
+                content = delta.get("content")
+                if content:
+                    self._content.append(content)
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import Optional, Dict, Any, List, Set
+
+from app.services.metrics import requests_total, prompt_tokens as prompt_tokens_histogram, completion_tokens as completion_tokens_histogram
+from app.services.tokenizer import tokenizer, approximate_tokens
+from app.services.usage_writer import usage_writer
+from config import config
+
+logger = logging.getLogger(__name__)
+
+def message_texts(messages: list) -> List[str]:
+    """取出聊天消息中的所有文本内容（包括多模态消息中的text部分）。"""
+    texts = []
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        content = message.get("content", "")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and item.get("type") == "text":
+                    texts.append(item.get("text", ""))
+    return texts
+
+class PromptCount:
+    """一次请求的输入token计数，在请求开始时计算一次，一直传递到使用记录。"""
+    __slots__ = ("texts", "tokens", "exact")
+
+    def __init__(self, texts: List[str], tokens: int, exact: bool):
+        self.texts = texts
+        self.tokens = tokens
+        self.exact = exact
+
+class TokenAccountant:
+    """
+    统一的token计数。
+
+    请求开始时按 tokenizer.prompt_mode 计算一次输入token数：approximate 只按字符估算，不占用事件循环；
+    exact 使用tokenizer服务编码。这个结果既用于计算max_tokens，也作为estimated_prompt_tokens写入使用记录。
+    上游没有返回usage时，使用tokenizer精确计算输入和输出的token数，计算在后台任务中完成后再写入使用记录。
+    """
+    def __init__(self):
+        self._prompt_mode = config.get('tokenizer.prompt_mode', 'approximate')
+        self._pending: Set[asyncio.Task] = set()
+        # api_key_id -> 模型 -> 状态码 -> requests_total的子指标，第一次出现后直接复用
+        self._request_counters: Dict[Optional[int], Dict[str, Dict[int, Any]]] = {}
+
+    async def count_prompt(self, messages: list, model: str) -> PromptCount:
+        """计算请求的输入token数。"""
+        texts = message_texts(messages)
+        if self._prompt_mode == 'exact':
+            return PromptCount(texts, await tokenizer.count_texts(texts, model), True)
+        return PromptCount(texts, sum(approximate_tokens(text) for text in texts), False)
+
+    def record(
+        self, api_key_id: Optional[int], model: str, status: int, usage: Optional[Dict[str, Any]],
+        prompt: Optional[PromptCount], completion_text: Optional[str] = None,
+    ) -> None:
+        """
+        记录一次请求的使用量。有上游usage时直接写入；
+        没有usage但有输入或输出内容需要计数时，在后台精确计算后写入。
+        """
+        estimated = prompt.tokens if prompt is not None else None
+        if usage:
+            self._log(
+                api_key_id, model,
+                usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), usage.get("total_tokens", 0),
+                status, estimated,
+            )
+            return
+        if completion_text is None:
+            self._log(api_key_id, model, 0, 0, 0, status, estimated)
+            return
+        task = asyncio.create_task(self._record_exact(api_key_id, model, status, prompt, completion_text))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _record_exact(self, api_key_id: Optional[int], model: str, status: int, prompt: Optional[PromptCount], completion_text: str) -> None:
+        estimated = prompt.tokens if prompt is not None else None
+        try:
+            if prompt is None:
+                prompt_tokens = 0
+            elif prompt.exact:
+                prompt_tokens = prompt.tokens
+            else:
+                prompt_tokens = await tokenizer.count_texts(prompt.texts, model)
+            completion_tokens = await tokenizer.count_texts([completion_text], model)
+        except Exception as e:
+            logger.error(f"❌ 计算token数量失败，使用估算值: {e}")
+            prompt_tokens = estimated or 0
+            completion_tokens = approximate_tokens(completion_text)
+        total_tokens = prompt_tokens + completion_tokens
+        logger.warning(f"⚠️ API未返回usage数据，使用tokenizer计算: prompt={prompt_tokens}, completion={completion_tokens}, total={total_tokens}")
+        self._log(api_key_id, model, prompt_tokens, completion_tokens, total_tokens, status, estimated)
+
+    def _log(
+        self, api_key_id: Optional[int], model: str, prompt_tokens: int, completion_tokens: int, total_tokens: int,
+        status: int, estimated: Optional[int],
+    ) -> None:
+        """写入使用记录，同时更新请求计数和token分布指标。"""
+        self._request_counter(api_key_id, model, status).inc()
+        if status == 200:
+            prompt_tokens_histogram.observe(prompt_tokens)
+            completion_tokens_histogram.observe(completion_tokens)
+        usage_writer.log_usage(api_key_id, model, prompt_tokens, completion_tokens, total_tokens, 0.0, status, estimated)
+
+    def _request_counter(self, api_key_id: Optional[int], model: str, status: int) -> Any:
+        """按 (Key, 模型) 缓存requests_total的子指标，请求路径上不再为标签值创建元组和查找注册表。"""
+        by_model = self._request_counters.get(api_key_id)
+        if by_model is None:
+            by_model = self._request_counters[api_key_id] = {}
+        by_status = by_model.get(model)
+        if by_status is None:
+            by_status = by_model[model] = {}
+        counter = by_status.get(status)
+        if counter is None:
+            counter = by_status[status] = requests_total.labels(api_key_id, model, status)
+        return counter
+
+    async def drain(self) -> None:
+        """等待所有尚未完成的后台计数，在关闭使用记录写入任务之前调用。"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+# 创建一个单例实例
+token_accountant = TokenAccountant()
@@ -0,0 +1,166 @@
+import asyncio
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List
+
+import tiktoken
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 模型ID中包含的关键字 -> 编码器，按顺序匹配第一个
+DEFAULT_MODEL_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+    "gpt-4.1": "o200k_base",
+    "gpt-oss": "o200k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-3.5": "cl100k_base",
+}
+
+def approximate_tokens(text: str) -> int:
+    """
+    不做BPE编码的快速估算：ASCII字符约4个一个token，其它字符（中文等）约1个字符一个token。
+    非ASCII字符数由UTF-8编码后多出的字节数推算，整个计算都在C代码中完成。
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    extra_bytes = len(text.encode('utf-8', 'surrogatepass')) - chars
+    # 常见的非ASCII字符（中日韩文字）编码为3个字节
+    non_ascii = min(chars, (extra_bytes + 1) // 2)
+    return max(1, (chars - non_ascii) // 4 + non_ascii)
+
+class TokenizerService:
+    """
+    计算文本token数量的服务。
+
+    编码器在启动时从本地缓存目录（tokenizer.cache_dir，即TIKTOKEN_CACHE_DIR）加载一次，
+    请求处理中不会再触发tiktoken的下载；加载失败的编码器退化为按字符数估算。
+    重复出现的文本（例如相同的系统提示词）按内容哈希缓存在LRU中，
+    超过offload_threshold_chars的长文本在专用线程池中编码，不阻塞事件循环。
+    """
+    def __init__(self):
+        self._cache_dir = config.get('tokenizer.cache_dir', 'tiktoken_cache')
+        self._model_encodings: Dict[str, str] = config.get('tokenizer.model_encodings', DEFAULT_MODEL_ENCODINGS)
+        self._default_encoding = config.get('tokenizer.default_encoding', 'cl100k_base')
+        self._cache_size = config.get('tokenizer.cache_size', 2048)
+        self._cache_min_chars = config.get('tokenizer.cache_min_chars', 256)
+        self._offload_threshold = config.get('tokenizer.offload_threshold_chars', 20000)
+        self._threads = config.get('tokenizer.threads', 2)
+
+        self._encoders: Dict[str, Any] = {}
+        # (编码器名称, 内容哈希) -> token数
+        self._cache: "OrderedDict[tuple, int]" = OrderedDict()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._stats = {"hits": 0, "misses": 0, "offloaded": 0}
+
+    # --- 生命周期 ---
+
+    async def start(self) -> None:
+        """在线程池中加载配置中用到的所有编码器。"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._threads, thread_name_prefix="tokenizer")
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._load_encoders)
+
+    def stop(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _load_encoders(self) -> None:
+        if self._cache_dir:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.abspath(self._cache_dir))
+        for name in {self._default_encoding, *self._model_encodings.values()}:
+            if name in self._encoders:
+                continue
+            try:
+                self._encoders[name] = tiktoken.get_encoding(name)
+                logger.info(f"✅ 已加载tokenizer编码器: {name}")
+            except Exception as e:
+                logger.warning(f"⚠️ 无法加载tokenizer编码器 {name}，将按字符数估算: {e}")
+
+    # --- 计数 ---
+
+    def encoding_name(self, model: str) -> str:
+        """返回模型使用的编码器名称。"""
+        model = (model or "").lower()
+        for keyword, name in self._model_encodings.items():
+            if keyword in model:
+                return name
+        return self._default_encoding
+
+    def _encode_count(self, encoding: str, text: str) -> int:
+        encoder = self._encoders.get(encoding)
+        if encoder is None:
+            return approximate_tokens(text)
+        return len(encoder.encode_ordinary(text))
+
+    def _cache_key(self, encoding: str, text: str) -> Optional[tuple]:
+        if len(text) < self._cache_min_chars:
+            return None
+        return (encoding, hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest())
+
+    def _cache_get(self, key: Optional[tuple]) -> Optional[int]:
+        if key is None:
+            return None
+        count = self._cache.get(key)
+        if count is not None:
+            self._cache.move_to_end(key)
+            self._stats["hits"] += 1
+        return count
+
+    def _cache_put(self, key: Optional[tuple], count: int) -> None:
+        if key is None:
+            return
+        self._cache[key] = count
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def count_texts(self, texts: List[str], model: str = "") -> int:
+        """计算多段文本的token总数，长文本在线程池中编码。"""
+        encoding = self.encoding_name(model)
+        total = 0
+        pending = []
+        for text in texts:
+            if not text:
+                continue
+            key = self._cache_key(encoding, text)
+            count = self._cache_get(key)
+            if count is not None:
+                total += count
+            elif len(text) >= self._offload_threshold and self._executor is not None:
+                pending.append((key, text))
+            else:
+                self._stats["misses"] += 1
+                count = self._encode_count(encoding, text)
+                self._cache_put(key, count)
+                total += count
+
+        if pending:
+            self._stats["misses"] += len(pending)
+            self._stats["offloaded"] += len(pending)
+            loop = asyncio.get_running_loop()
+            counts = await loop.run_in_executor(
+                self._executor, lambda: [self._encode_count(encoding, text) for _, text in pending]
+            )
+            for (key, _), count in zip(pending, counts):
+                self._cache_put(key, count)
+                total += count
+        return total
+
+    def stats(self) -> Dict[str, Any]:
+        """已加载的编码器和计数缓存的命中情况，由 /metrics 导出。"""
+        return {
+            "encoders": sorted(self._encoders),
+            "cache_entries": len(self._cache),
+            **self._stats,
+        }
+
+# 创建一个单例实例
+tokenizer = TokenizerService()
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Deque, Set, AsyncIterator
+
+from app import async_crud, crud
+from app.services.metrics import db_write_seconds
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class UsageWriter:
+    """
+    后台批量写入使用记录。
+
+    请求处理中只把使用记录放入有界队列、把Key计数合并到内存字典，不做任何数据库操作。
+    后台任务在达到批量大小或时间间隔时，把积累的记录和Key计数放在同一个事务中用executemany写入。
+    队列已满时记录转入有界的溢出列表并立即唤醒后台任务，由下一次写入一起写入；只有溢出列表也满时才丢弃。
+    """
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        # key_id -> [usage_count增量, daily_usage, last_used, last_reset_time]
+        self._key_updates: Dict[int, List[Any]] = {}
+        # 写入失败、等待重试的记录
+        self._retry_rows: List[tuple] = []
+        # 队列已满时暂存的记录
+        self._overflow: Deque[tuple] = deque()
+        # 后台任务未启动时提交到写入线程池的写入
+        self._pending: Set[asyncio.Task] = set()
+
+        self._batch_size = config.get('usage_writer.batch_size', 200)
+        self._flush_interval = config.get('usage_writer.flush_interval', 1.0)
+        self._overflow_size = config.get('usage_writer.overflow_size', 100000)
+
+        self._stats = {
+            "flushes": 0,
+            "rows_written": 0,
+            "key_updates_written": 0,
+            "spilled": 0,
+            "dropped": 0,
+            "errors": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+        }
+
+    # --- 生命周期 ---
+
+    async def start(self) -> None:
+        """创建队列并启动后台写入任务。"""
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=config.get('usage_writer.queue_size', 10000))
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ 使用记录写入任务已启动: batch_size={self._batch_size}, flush_interval={self._flush_interval}s")
+
+    async def stop(self) -> None:
+        """停止后台任务，并把队列中剩余的记录全部写入数据库。"""
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        logger.info(f"使用记录写入任务已停止，共写入 {self._stats['rows_written']} 条记录。")
+
+    # --- 生产者接口（不阻塞事件循环） ---
+
+    def log_usage(self, api_key_id: Optional[int], model: str, prompt_tokens: int, completion_tokens: int, total_tokens: int, cost: float, status: int, estimated_prompt_tokens: Optional[int] = None) -> None:
+        """记录一次API调用，只入队，不等待数据库。estimated_prompt_tokens为请求开始时估算的输入token数。"""
+        row = (api_key_id, model, prompt_tokens, completion_tokens, total_tokens, cost, status, crud.utc_now_str(), estimated_prompt_tokens)
+        if self._queue is None:
+            self._write_unstarted(row)
+            return
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            if len(self._overflow) >= self._overflow_size:
+                self._stats["dropped"] += 1
+                logger.error(f"❌ 使用记录队列和溢出列表都已满，丢弃一条记录: key={api_key_id}, model={model}, status={status}")
+                return
+            if not self._overflow:
+                logger.warning("⚠️ 使用记录队列已满，新的记录暂存到溢出列表，等待后台写入。")
+            self._overflow.append(row)
+            self._stats["spilled"] += 1
+            self._wakeup.set()
+            return
+        if self._queue.qsize() >= self._batch_size:
+            self._wakeup.set()
+
+    def _write_unstarted(self, row: tuple) -> None:
+        """后台任务未启动时写入一条记录：在事件循环中交给写入线程池，没有事件循环时（例如在脚本中使用）直接同步写入。"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            crud.write_usage_batch([row], [])
+            return
+        task = loop.create_task(self._write_rows([row]))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _write_rows(self, rows: List[tuple]) -> None:
+        try:
+            await async_crud.write_usage_batch(rows, [])
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"❌ 写入使用记录失败: {e}")
+
+    def record_key_usage(self, key_id: int, increment: int, daily_usage: Optional[int], last_used: Optional[str], last_reset_time: Optional[str]) -> None:
+        """合并一次Key计数更新，同一个Key在两次写入之间只产生一条UPDATE。"""
+        update = self._key_updates.get(key_id)
+        if update is None:
+            self._key_updates[key_id] = [increment, daily_usage, last_used, last_reset_time]
+            return
+        update[0] += increment
+        if daily_usage is not None:
+            update[1] = daily_usage
+        if last_used is not None:
+            update[2] = last_used
+        if last_reset_time is not None:
+            update[3] = last_reset_time
+
+    def pending_key_updates(self) -> Dict[int, List[Any]]:
+        """返回尚未写入数据库的Key计数更新。"""
+        return self._key_updates
+
+    # --- 写入 ---
+
+    async def flush(self) -> None:
+        """立即写入当前积累的所有记录。"""
+        if self._lock is None:
+            await self._flush_locked()
+            return
+        async with self._lock:
+            await self._flush_locked()
+
+    @asynccontextmanager
+    async def paused(self) -> AsyncIterator[None]:
+        """写入当前积累的所有记录，并在退出上下文之前暂停后台写入。"""
+        if self._lock is None:
+            await self._flush_locked()
+            yield
+            return
+        async with self._lock:
+            await self._flush_locked()
+            yield
+
+    async def _flush_locked(self) -> None:
+        while True:
+            rows = self._retry_rows
+            self._retry_rows = []
+            if self._queue is not None:
+                while len(rows) < self._batch_size:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+            while self._overflow and len(rows) < self._batch_size:
+                rows.append(self._overflow.popleft())
+
+            key_updates, self._key_updates = self._key_updates, {}
+            if not rows and not key_updates:
+                return
+
+            key_rows = [(u[0], u[1], u[2], u[3], key_id) for key_id, u in key_updates.items()]
+            start = time.perf_counter()
+            try:
+                await async_crud.write_usage_batch(rows, key_rows)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"❌ 批量写入使用记录失败，将在下次重试: {e}")
+                self._retry_rows = rows
+                self._restore_key_updates(key_updates)
+                return
+
+            elapsed = time.perf_counter() - start
+            db_write_seconds.observe(elapsed)
+            elapsed_ms = elapsed * 1000
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += len(rows)
+            self._stats["key_updates_written"] += len(key_rows)
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["total_flush_ms"] += elapsed_ms
+            if elapsed_ms > self._stats["max_flush_ms"]:
+                self._stats["max_flush_ms"] = elapsed_ms
+
+            # 队列中还有足够多的记录或有溢出的记录时继续写下一批
+            if not self._overflow and (self._queue is None or self._queue.qsize() < self._batch_size):
+                return
+
+    def _restore_key_updates(self, key_updates: Dict[int, List[Any]]) -> None:
+        # 失败的更新比之后产生的更新旧，只补回增量和尚未被覆盖的字段
+        for key_id, (increment, daily_usage, last_used, last_reset_time) in key_updates.items():
+            newer = self._key_updates.get(key_id)
+            if newer is None:
+                self._key_updates[key_id] = [increment, daily_usage, last_used, last_reset_time]
+            else:
+                newer[0] += increment
+                newer[1] = newer[1] if newer[1] is not None else daily_usage
+                newer[2] = newer[2] if newer[2] is not None else last_used
+                newer[3] = newer[3] if newer[3] is not None else last_reset_time
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+            if self._stopping:
+                # 排空队列后退出
+                while self._queue.qsize() or self._overflow or self._key_updates or self._retry_rows:
+                    before = self._stats["errors"]
+                    await self.flush()
+                    if self._stats["errors"] != before:
+                        logger.error("❌ 关闭时写入使用记录失败，剩余记录将丢失。")
+                        return
+                return
+
+    # --- 统计 ---
+
+    def stats(self) -> Dict[str, Any]:
+        """返回队列深度和写入延迟等统计信息。"""
+        flushes = self._stats["flushes"]
+        return {
+            "running": self._task is not None,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self._queue.maxsize if self._queue is not None else 0,
+            "overflow_depth": len(self._overflow),
+            "pending_key_updates": len(self._key_updates),
+            "batch_size": self._batch_size,
+            "flush_interval": self._flush_interval,
+            "flushes": flushes,
+            "rows_written": self._stats["rows_written"],
+            "key_updates_written": self._stats["key_updates_written"],
+            "spilled": self._stats["spilled"],
+            "dropped": self._stats["dropped"],
+            "errors": self._stats["errors"],
+            "last_flush_ms": round(self._stats["last_flush_ms"], 3),
+            "avg_flush_ms": round(self._stats["total_flush_ms"] / flushes, 3) if flushes else 0.0,
+            "max_flush_ms": round(self._stats["max_flush_ms"], 3),
+        }
+
+# 创建一个单例实例
+usage_writer = UsageWriter()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+模型参数量提取的正确性和耗时：在一组OpenRouter模型描述上比较旧的逐个正则匹配实现
+和 app.services.model_metadata 中预编译的单次匹配实现。
+
+用法:
+    python benchmarks/bench_param_extraction.py [--models models.json] [--rounds 200]
+
+内置语料来自 test_model_metadata.py（节选自OpenRouter /models 返回的模型描述，每条都标注了期望的参数量）；
+--models 可以指定一份保存下来的 /models 响应（{"data": [...]}），
+只比较两种实现的结果差异和耗时（这些描述没有期望值）。
+任何内置语料的提取结果与期望不符时以非零状态退出。
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.model_metadata import extract_parameters, ModelMetadataEnricher
+from test_model_metadata import CORPUS
+
+def legacy_extract(description):
+    """旧的实现：逐个尝试14个正则，并根据正则源码中是否包含字母b判断单位。"""
+    if not description:
+        return None
+    patterns = [
+        r'(\d+(?:\.\d+)?)\s*[Bb][\s-]*parameter',
+        r'(\d+(?:\.\d+)?)\s*[Bb][\s-]*param',
+        r'(\d+(?:\.\d+)?)\s*[Mm][\s-]*parameter',
+        r'(\d+(?:\.\d+)?)\s*[Mm][\s-]*param',
+        r'(\d+(?:\.\d+)?)\s+billion[\s-]*parameter',
+        r'(\d+(?:\.\d+)?)\s+million[\s-]*parameter',
+        r'(\d+(?:\.\d+)?)\s+[Bb][\s-]*parameter',
+        r'(\d+(?:\.\d+)?)\s+[Mm][\s-]*parameter',
+        r'(\d+(?:\.\d+)?)\s*[Bb]\s+active\s+parameter',
+        r'(\d+(?:\.\d+)?)\s*[Mm]\s+active\s+parameter',
+        r'(\d+(?:\.\d+)?)\s*[Bb][\s-]*parameter[\s-]*count',
+        r'(\d+(?:\.\d+)?)\s*[Mm][\s-]*parameter[\s-]*count',
+        r'(\d+(?:\.\d+)?)\s*billion\s+param',
+        r'(\d+(?:\.\d+)?)\s*million\s+param',
+    ]
+    for pattern in patterns:
+        matches = re.findall(pattern, description, re.IGNORECASE)
+        if matches:
+            if any(x in pattern.lower() for x in ['b', 'billion']):
+                return f"{matches[0]}B"
+            elif any(x in pattern.lower() for x in ['m', 'million']):
+                return f"{matches[0]}M"
+            return f"{matches[0]}B"
+    return None
+
+def check_corpus():
+    failures = 0
+    legacy_wrong = 0
+    for model_id, description, label, count in CORPUS:
+        result = extract_parameters(description)
+        got = (result.label, result.count) if result else (None, None)
+        if got != (label, count):
+            failures += 1
+            print(f"❌ {model_id}: 期望 {label}/{count}，得到 {got[0]}/{got[1]}")
+        legacy = legacy_extract(description)
+        if legacy != label:
+            legacy_wrong += 1
+            print(f"   旧实现不一致 {model_id}: 期望 {label}，旧实现 {legacy}")
+    print(f"内置语料 {len(CORPUS)} 条：新实现错误 {failures} 条，旧实现错误 {legacy_wrong} 条")
+    return failures
+
+def timeit(fn, descriptions, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for description in descriptions:
+            fn(description)
+    return (time.perf_counter() - start) / (rounds * len(descriptions)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", help="保存下来的 /models 响应JSON文件")
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    failures = check_corpus()
+
+    models = [{"id": model_id, "description": description} for model_id, description, _, _ in CORPUS]
+    if args.models:
+        with open(args.models, encoding="utf-8") as f:
+            extra = json.load(f).get("data", [])
+        differ = 0
+        for m in extra:
+            new = extract_parameters(m.get("description") or "")
+            old = legacy_extract(m.get("description") or "")
+            if (new.label if new else None) != old:
+                differ += 1
+                print(f"   结果不同 {m.get('id')}: 旧实现 {old}，新实现 {new.label if new else None}")
+        print(f"{args.models}: {len(extra)} 个模型，{differ} 个结果不同")
+        models.extend(extra)
+
+    descriptions = [m.get("description") or "" for m in models]
+    legacy_us = timeit(legacy_extract, descriptions, args.rounds)
+    new_us = timeit(extract_parameters, descriptions, args.rounds)
+    print(f"旧实现   {legacy_us:8.2f} µs/描述")
+    print(f"单次匹配 {new_us:8.2f} µs/描述 ({legacy_us / new_us:.1f}x)")
+
+    enricher = ModelMetadataEnricher()
+    enricher.enrich(models)
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        enricher.enrich(models)
+    cached_us = (time.perf_counter() - start) / (args.rounds * len(models)) * 1e6
+    print(f"缓存刷新 {cached_us:8.2f} µs/模型 (描述未变化时)")
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+"""
+代理的端到端负载测试：在本机启动模拟上游（benchmarks/mock_upstream.py），
+用uvicorn运行 main.app，并按给定的并发发送聊天补全请求，不需要网络和真实的OpenRouter Key。
+
+用法:
+    python benchmarks/bench_proxy.py [--requests 1000] [--concurrency 50] [--stream-ratio 0.5]
+                                     [--keys 10] [--mock-latency-ms 50] [--mock-chunks 20]
+                                     [--set proxy.rate_limit.enabled=false] [--output result.json]
+                                     [--compare baseline.json]
+
+输出请求耗时和首字节时间（TTFB）的p50/p95/p99、吞吐量、事件循环延迟和SQLite使用记录的写入速度；
+--output 把结果保存为JSON（包含当前的git提交），--compare 与之前保存的结果逐项比较，便于发现不同提交之间的性能回退。
+--mock-* 参数原样传给模拟上游（去掉 mock- 前缀），可以模拟延迟、流式分块、错误率和限流响应头。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN_PASSWORD = "bench-admin"
+
+# --compare 时比较的指标及其方向（True表示越大越好）
+COMPARED_METRICS = [
+    ("throughput_rps", True),
+    ("latency_ms.p50", False),
+    ("latency_ms.p95", False),
+    ("latency_ms.p99", False),
+    ("ttfb_ms.p50", False),
+    ("ttfb_ms.p95", False),
+    ("ttfb_ms.p99", False),
+    ("event_loop_lag_ms.p99", False),
+    ("event_loop_lag_ms.max", False),
+    ("sqlite.rows_per_second", True),
+    ("sqlite.avg_flush_ms", False),
+]
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def distribution(values):
+    """返回一组毫秒值的分位数摘要。"""
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 3) if values else 0.0,
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "max": round(values[-1], 3) if values else 0.0,
+    }
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000, help="计时阶段的请求总数")
+    parser.add_argument("--warmup", type=int, default=50, help="计时之前的预热请求数")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="流式请求的比例")
+    parser.add_argument("--keys", type=int, default=10, help="添加到代理的模拟API Key数量")
+    parser.add_argument("--models-used", type=int, default=10, help="请求轮流使用的免费模型数量")
+    parser.add_argument("--prompt-chars", type=int, default=400, help="每个请求的用户消息长度")
+    parser.add_argument("--lag-interval-ms", type=float, default=10.0, help="事件循环延迟的采样间隔")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="覆盖代理的配置项，值按JSON解析，例如 proxy.admission.max_concurrent=64")
+    parser.add_argument("--log-level", default="WARNING", help="代理的日志级别，默认只输出警告，避免日志输出影响结果")
+    parser.add_argument("--access-log", action="store_true",
+                        help="保留配置中的结构化访问日志（默认关闭，避免每个请求一行日志影响结果），可以配合 --set access_log.sample_rate=0.01 使用")
+    parser.add_argument("--output", help="把结果保存为JSON文件")
+    parser.add_argument("--compare", help="与之前保存的JSON结果比较")
+    parser.add_argument("--mock-url", help="使用已经在运行的模拟上游（例如 http://127.0.0.1:9100/api/v1），不自动启动")
+    parser.add_argument("--mock-latency-ms", type=float, default=50.0)
+    parser.add_argument("--mock-latency-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--mock-chunks", type=int, default=20)
+    parser.add_argument("--mock-chunk-chars", type=int, default=16)
+    parser.add_argument("--mock-chunk-delay-ms", type=float, default=5.0)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-error-status", type=int, default=503)
+    parser.add_argument("--mock-rpm", type=int, default=0)
+    return parser.parse_args()
+
+def start_mock(args) -> (subprocess.Popen, str):
+    port = free_port()
+    cmd = [sys.executable, os.path.join(ROOT, "benchmarks", "mock_upstream.py"), "--port", str(port),
+           "--models", str(max(args.models_used, 1))]
+    for name, value in vars(args).items():
+        if name.startswith("mock_") and name != "mock_url":
+            cmd += ["--" + name[5:].replace("_", "-"), str(value)]
+    proc = subprocess.Popen(cmd)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return proc, f"http://127.0.0.1:{port}/api/v1"
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError("模拟上游启动失败")
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("等待模拟上游启动超时")
+
+def apply_overrides(config, overrides):
+    for item in overrides:
+        key, _, raw = item.partition("=")
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            value = raw
+        node = config._config
+        parts = key.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+
+# --- 负载发生器（在单独的线程和事件循环中运行，避免干扰代理自身的事件循环延迟） ---
+
+async def drive_load(base_url, args, models, count, results):
+    import httpx
+
+    headers = {"Authorization": f"Bearer {ADMIN_PASSWORD}"}
+    prompt = ("benchmark prompt " * (args.prompt_chars // 17 + 1))[:args.prompt_chars]
+    counter = iter(range(count))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=120.0, limits=limits) as client:
+        async def worker():
+            for i in counter:
+                stream = (i * args.stream_ratio) % 1 + args.stream_ratio >= 1 if 0 < args.stream_ratio < 1 else args.stream_ratio >= 1
+                body = {
+                    "model": models[i % len(models)],
+                    "stream": stream,
+                    "messages": [{"role": "user", "content": f"{i} {prompt}"}],
+                }
+                start = time.perf_counter()
+                ttfb = None
+                size = 0
+                try:
+                    async with client.stream("POST", "/v1/chat/completions", json=body) as response:
+                        async for chunk in response.aiter_raw():
+                            if ttfb is None:
+                                ttfb = time.perf_counter() - start
+                            size += len(chunk)
+                        status = response.status_code
+                except Exception as e:
+                    status = f"error:{type(e).__name__}"
+                total = time.perf_counter() - start
+                results.append((stream, status, total, ttfb if ttfb is not None else total, size))
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+def run_load_in_thread(base_url, args, models, count):
+    results = []
+    thread = threading.Thread(target=lambda: asyncio.run(drive_load(base_url, args, models, count, results)))
+    start = time.perf_counter()
+    thread.start()
+    return thread, results, start
+
+# --- 主流程 ---
+
+async def run(args, mock_url):
+    import httpx
+    import uvicorn
+
+    from config import config
+    # 访问日志不受 --log-level 影响，默认关闭；--set 中的设置优先
+    apply_overrides(config, ([] if args.access_log else ["access_log.enabled=false"]) + args.set)
+
+    import main
+    from app.services.usage_writer import usage_writer
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning", access_log=False, lifespan="on"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        if server_task.done():
+            server_task.result()
+        await asyncio.sleep(0.05)
+    base_url = f"http://127.0.0.1:{port}"
+
+    try:
+        headers = {"Authorization": f"Bearer {ADMIN_PASSWORD}"}
+        async with httpx.AsyncClient(base_url=base_url, headers=headers, timeout=30.0) as client:
+            for i in range(args.keys):
+                r = await client.post("/admin/keys", data={"key_name": f"bench-{i}", "api_key": f"sk-bench-{i}", "daily_limit": -1})
+                r.raise_for_status()
+            # 等待后台任务从模拟上游拉取模型列表
+            models = []
+            deadline = time.time() + 15
+            while not models and time.time() < deadline:
+                models = [m["id"] for m in (await client.get("/v1/models")).json()["data"]]
+                if not models:
+                    await asyncio.sleep(0.1)
+            if not models:
+                raise RuntimeError("代理没有从模拟上游加载到模型列表")
+            models = sorted(models)[:args.models_used]
+
+        # 预热：建立连接池、填充缓存
+        if args.warmup:
+            thread, _, _ = run_load_in_thread(base_url, args, models, args.warmup)
+            while thread.is_alive():
+                await asyncio.sleep(0.05)
+        await usage_writer.flush()
+
+        # 事件循环延迟：按固定间隔睡眠，记录实际醒来比预期晚了多少
+        lags = []
+        interval = args.lag_interval_ms / 1000
+        loop = asyncio.get_running_loop()
+
+        async def sample_lag():
+            while True:
+                t0 = loop.time()
+                await asyncio.sleep(interval)
+                lags.append((loop.time() - t0 - interval) * 1000)
+
+        writer_before = usage_writer.stats()
+        lag_task = asyncio.create_task(sample_lag())
+        thread, results, start = run_load_in_thread(base_url, args, models, args.requests)
+        while thread.is_alive():
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - start
+        lag_task.cancel()
+
+        flush_start = time.perf_counter()
+        await usage_writer.flush()
+        flush_elapsed = time.perf_counter() - flush_start
+        writer_after = usage_writer.stats()
+    finally:
+        server.should_exit = True
+        await server_task
+
+    rows = writer_after["rows_written"] - writer_before["rows_written"]
+    flushes = writer_after["flushes"] - writer_before["flushes"]
+    statuses = {}
+    for _, status, _, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    ok = [r for r in results if r[1] == 200]
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+            "mock_url": mock_url,
+        },
+        "requests": len(results),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "statuses": statuses,
+        "bytes_received": sum(r[4] for r in results),
+        "latency_ms": distribution([r[2] * 1000 for r in ok]),
+        "ttfb_ms": distribution([r[3] * 1000 for r in ok]),
+        "stream_latency_ms": distribution([r[2] * 1000 for r in ok if r[0]]),
+        "non_stream_latency_ms": distribution([r[2] * 1000 for r in ok if not r[0]]),
+        "event_loop_lag_ms": distribution(lags),
+        "sqlite": {
+            "rows_written": rows,
+            "flushes": flushes,
+            "rows_per_second": round(rows / (elapsed + flush_elapsed), 2) if rows else 0.0,
+            "avg_flush_ms": round(
+                (writer_after["avg_flush_ms"] * writer_after["flushes"] - writer_before["avg_flush_ms"] * writer_before["flushes"]) / flushes, 3
+            ) if flushes else 0.0,
+            "max_flush_ms": writer_after["max_flush_ms"],
+            "dropped": writer_after["dropped"] - writer_before["dropped"],
+        },
+    }
+
+def lookup(result, dotted):
+    value = result
+    for part in dotted.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+def print_report(result):
+    print(f"提交 {result['meta']['commit']}  请求 {result['requests']}  耗时 {result['elapsed_seconds']}s  "
+          f"吞吐 {result['throughput_rps']} req/s  状态 {result['statuses']}")
+    header = f"{'指标':<24} {'p50':>10} {'p95':>10} {'p99':>10} {'max':>10}"
+    print(header)
+    print("-" * len(header))
+    for name in ("latency_ms", "ttfb_ms", "stream_latency_ms", "non_stream_latency_ms", "event_loop_lag_ms"):
+        d = result[name]
+        print(f"{name:<24} {d['p50']:>10.2f} {d['p95']:>10.2f} {d['p99']:>10.2f} {d['max']:>10.2f}")
+    s = result["sqlite"]
+    print(f"SQLite: 写入 {s['rows_written']} 行 / {s['flushes']} 次提交，{s['rows_per_second']} 行/秒，"
+          f"平均提交 {s['avg_flush_ms']} ms，最长 {s['max_flush_ms']} ms，丢弃 {s['dropped']}")
+
+def print_comparison(baseline, result):
+    print(f"\n与 {baseline['meta'].get('commit', '?')} 比较:")
+    header = f"{'指标':<26} {'基准':>12} {'当前':>12} {'变化':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, higher_is_better in COMPARED_METRICS:
+        old, new = lookup(baseline, name), lookup(result, name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = change < 0 if higher_is_better else change > 0
+        mark = " ⚠️" if worse and abs(change) >= 10 else ""
+        print(f"{name:<26} {old:>12.2f} {new:>12.2f} {change:>+8.1f}%{mark}")
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="bench-proxy-")
+    mock_proc = None
+    if args.mock_url:
+        mock_url = args.mock_url
+    else:
+        mock_proc, mock_url = start_mock(args)
+
+    # 必须在导入config之前设置
+    os.environ["OPENROUTER_BASE_URL"] = mock_url
+    os.environ["DATABASE_URL"] = os.path.join(workdir, "bench.db")
+    os.environ["ADMIN_PASSWORD"] = ADMIN_PASSWORD
+    os.chdir(ROOT)
+
+    import logging
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+
+    try:
+        result = asyncio.run(run(args, mock_url))
+    finally:
+        if mock_proc is not None:
+            mock_proc.terminate()
+            mock_proc.wait(timeout=10)
+
+    print_report(result)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存到 {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+SSE解析的微基准测试：比较 stream_chat_completions 原来的逐块解码循环和 SSEUsageParser。
+
+用法:
+    python benchmarks/bench_sse_parser.py [--events 2000] [--rounds 20] [--seed 0]
+
+分别用"每块一个事件"和"随机切分的字节块"两种方式输入同一段流，
+输出每轮耗时、吞吐量，以及两种实现是否拿到了usage、内容是否完整。
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.sse import SSEUsageParser
+
+SAMPLE_TEXT = "你好，世界！Hello world. 这是一个流式响应的测试 🚀 with some ASCII mixed in. "
+
+def build_stream(events: int):
+    """生成一段类似OpenRouter的SSE响应，返回 (事件列表, 期望的内容, 期望的usage)。"""
+    frames = [b": OPENROUTER PROCESSING\n\n"]
+    frames.append(b'data: {"id":"gen-1","choices":[{"index":0,"delta":{"role":"assistant","content":""}}]}\n\n')
+    pieces = []
+    for i in range(events):
+        piece = SAMPLE_TEXT[i % len(SAMPLE_TEXT):][:7]
+        pieces.append(piece)
+        event = {"id": "gen-1", "object": "chat.completion.chunk", "created": 1700000000, "model": "foo/bar:free",
+                 "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+        frames.append(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+    usage = {"prompt_tokens": 12, "completion_tokens": events, "total_tokens": 12 + events}
+    frames.append(b"data: " + json.dumps({"id": "gen-1", "choices": [], "usage": usage}).encode("utf-8") + b"\n\n")
+    frames.append(b"data: [DONE]\n\n")
+    return frames, "".join(pieces), usage
+
+def split_randomly(data: bytes, rng: random.Random, max_size: int = 256):
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rng.randint(1, max_size)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+def legacy_parse(chunks):
+    """stream_chat_completions 原来的处理方式（去掉日志）。"""
+    usage_data = None
+    completion_content = ""
+    forwarded = []
+    for chunk in chunks:
+        chunk_str = chunk.decode('utf-8', errors='ignore')
+        # StreamingResponse会把yield的str重新编码为bytes
+        forwarded.append(chunk_str.encode('utf-8'))
+        for line in chunk_str.strip().split('\n'):
+            if line.startswith('data:'):
+                data_str = line[len('data:'):].strip()
+                if data_str == '[DONE]':
+                    continue
+                try:
+                    data_json = json.loads(data_str)
+                    if 'usage' in data_json:
+                        usage_data = data_json['usage']
+                    if 'choices' in data_json and len(data_json['choices']) > 0:
+                        choice = data_json['choices'][0]
+                        if 'delta' in choice and 'content' in choice['delta']:
+                            content = choice['delta']['content']
+                            if content:
+                                completion_content += content
+                except json.JSONDecodeError:
+                    pass
+    return usage_data, completion_content, forwarded
+
+def parser_parse(chunks):
+    parser = SSEUsageParser()
+    forwarded = []
+    for chunk in chunks:
+        forwarded.append(chunk)
+        parser.feed(chunk)
+    parser.close()
+    return parser.usage, parser.content, forwarded
+
+def bench(fn, chunks, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = fn(chunks)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    frames, expected_content, expected_usage = build_stream(args.events)
+    raw = b"".join(frames)
+    cases = {
+        "每块一个事件": frames,
+        "随机切分": split_randomly(raw, random.Random(args.seed)),
+    }
+
+    print(f"流大小: {len(raw) / 1024:.1f} KiB, 事件数: {len(frames)}")
+    for case, chunks in cases.items():
+        print(f"\n== {case} ({len(chunks)} 块) ==")
+        for name, fn in (("旧循环", legacy_parse), ("SSEUsageParser", parser_parse)):
+            median, (usage, content, forwarded) = bench(fn, chunks, args.rounds)
+            forwarded_ok = b"".join(forwarded) == raw
+            print(
+                f"{name:>15}: {median * 1000:8.2f} ms/轮, {len(raw) / median / 1024 / 1024:8.1f} MiB/s, "
+                f"usage={'正确' if usage == expected_usage else '丢失'}, "
+                f"内容={'完整' if content == expected_content else f'不完整({len(content)}/{len(expected_content)}字符)'}, "
+                f"转发字节={'一致' if forwarded_ok else '被修改'}"
+            )
+
+if __name__ == "__main__":
+    main()
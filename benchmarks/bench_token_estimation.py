@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+输入token估算误差报告：比较 usage_logs 中请求开始时估算的 estimated_prompt_tokens
+和上游返回的真实 prompt_tokens。
+
+用法:
+    python benchmarks/bench_token_estimation.py [--db openrouter_proxy.db] [--days 7] [--min-count 5]
+
+只统计状态为200且两个值都存在的记录；按模型输出记录数、平均偏差（正数表示高估）、
+平均绝对百分比误差以及绝对百分比误差的p50/p95。
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(pairs):
+    """pairs为 [(估算值, 真实值)]，返回误差统计。"""
+    bias = sum(est - real for est, real in pairs) / len(pairs)
+    ape = sorted(abs(est - real) / real * 100 for est, real in pairs)
+    return {
+        "count": len(pairs),
+        "bias": bias,
+        "mape": sum(ape) / len(ape),
+        "p50": percentile(ape, 50),
+        "p95": percentile(ape, 95),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=config.get('database.url', 'openrouter_proxy.db'))
+    parser.add_argument("--days", type=int, default=7, help="只统计最近N天的记录")
+    parser.add_argument("--min-count", type=int, default=5, help="记录数少于此值的模型不单独列出")
+    args = parser.parse_args()
+
+    since = (datetime.utcnow() - timedelta(days=args.days)).strftime('%Y-%m-%d %H:%M:%S')
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    rows = conn.execute("""
+        SELECT model, estimated_prompt_tokens, prompt_tokens
+        FROM usage_logs
+        WHERE request_time >= ? AND response_status = 200
+          AND estimated_prompt_tokens IS NOT NULL AND prompt_tokens > 0
+    """, (since,)).fetchall()
+    conn.close()
+
+    if not rows:
+        print("没有同时包含估算值和真实usage的记录。")
+        return
+
+    by_model = {}
+    for model, estimated, real in rows:
+        by_model.setdefault(model, []).append((estimated, real))
+
+    header = f"{'模型':<48} {'记录数':>8} {'平均偏差':>10} {'MAPE%':>8} {'p50%':>8} {'p95%':>8}"
+    print(header)
+    print("-" * len(header))
+    for model, pairs in sorted(by_model.items(), key=lambda item: -len(item[1])):
+        if len(pairs) < args.min_count:
+            continue
+        s = summarize(pairs)
+        print(f"{model:<48} {s['count']:>8} {s['bias']:>10.1f} {s['mape']:>8.1f} {s['p50']:>8.1f} {s['p95']:>8.1f}")
+    s = summarize([pair for pairs in by_model.values() for pair in pairs])
+    print("-" * len(header))
+    print(f"{'全部':<48} {s['count']:>8} {s['bias']:>10.1f} {s['mape']:>8.1f} {s['p50']:>8.1f} {s['p95']:>8.1f}")
+
+if __name__ == "__main__":
+    main()
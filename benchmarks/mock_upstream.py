@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+本地模拟的OpenRouter上游，供基准测试使用，不需要网络和真实的API Key。
+
+用法:
+    python benchmarks/mock_upstream.py [--port 9100] [--latency-ms 50] [--chunks 20] [--chunk-chars 16] ...
+
+提供 /api/v1/models 和 /api/v1/chat/completions（流式和非流式）：
+- --latency-ms/--latency-jitter-ms: 返回响应头之前的延迟
+- --chunks/--chunk-chars/--chunk-delay-ms: 流式响应的事件数、每个事件的内容长度和事件间隔
+- --error-rate/--error-status: 按比例返回错误状态码
+- --rpm: 每个 (Key, 模型) 每分钟的请求数上限，响应带 X-RateLimit-* 响应头，超出时返回429和Retry-After
+- --models: 免费模型的数量
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+WORDS = "the quick brown fox jumps over the lazy dog 你好 世界 流式 响应 测试".split()
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="返回响应头之前的平均延迟")
+    parser.add_argument("--latency-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--chunks", type=int, default=20, help="流式响应的内容事件数")
+    parser.add_argument("--chunk-chars", type=int, default=16, help="每个内容事件的字符数")
+    parser.add_argument("--chunk-delay-ms", type=float, default=5.0, help="流式事件之间的间隔")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误状态码的比例")
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--rpm", type=int, default=0, help="每个 (Key, 模型) 每分钟的请求数上限，0表示不限制")
+    parser.add_argument("--models", type=int, default=20, help="免费模型的数量")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser
+
+class _RateWindow:
+    """固定一分钟窗口的请求计数，对应OpenRouter的 X-RateLimit-* 响应头。"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.windows = {}
+
+    def hit(self, key: str, model: str):
+        now = time.time()
+        start, count = self.windows.get((key, model), (now, 0))
+        if now - start >= 60:
+            start, count = now, 0
+        count += 1
+        self.windows[(key, model)] = (start, count)
+        reset_ms = int((start + 60) * 1000)
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(max(0, self.limit - count)),
+            "X-RateLimit-Reset": str(reset_ms),
+        }
+        if count > self.limit:
+            headers["Retry-After"] = str(max(1, int(start + 60 - now)))
+            return False, headers
+        return True, headers
+
+def create_app(args: argparse.Namespace) -> Starlette:
+    rng = random.Random(args.seed)
+    rate = _RateWindow(args.rpm) if args.rpm > 0 else None
+
+    models = [
+        {
+            "id": f"mock/model-{i}:free",
+            "name": f"Mock Model {i}",
+            "created": 1700000000 + i,
+            "context_length": 8192 * (1 + i % 4),
+            "description": f"A {7 + i}B parameter mock model used for offline benchmarks.",
+        }
+        for i in range(args.models)
+    ] + [{"id": "mock/paid-model", "name": "Paid", "created": 1700000000, "context_length": 32768, "description": ""}]
+    models_body = json.dumps({"data": models}).encode("utf-8")
+    models_etag = '"mock-models-1"'
+
+    def delay() -> float:
+        return max(0.0, args.latency_ms + rng.uniform(-args.latency_jitter_ms, args.latency_jitter_ms)) / 1000
+
+    def content_piece() -> str:
+        text = ""
+        while len(text) < args.chunk_chars:
+            text += rng.choice(WORDS) + " "
+        return text[:args.chunk_chars]
+
+    async def list_models(request: Request) -> Response:
+        if request.headers.get("if-none-match") == models_etag:
+            return Response(status_code=304, headers={"ETag": models_etag})
+        return Response(models_body, media_type="application/json", headers={"ETag": models_etag})
+
+    async def chat_completions(request: Request) -> Response:
+        body = await request.json()
+        model = body.get("model", "")
+        api_key = request.headers.get("authorization", "")[7:]
+        await asyncio.sleep(delay())
+
+        headers = {}
+        if rate is not None:
+            allowed, headers = rate.hit(api_key, model)
+            if not allowed:
+                return JSONResponse({"error": {"message": "Rate limit exceeded", "code": 429}}, status_code=429, headers=headers)
+        if args.error_rate and rng.random() < args.error_rate:
+            return JSONResponse({"error": {"message": "Mock upstream error", "code": args.error_status}},
+                                status_code=args.error_status, headers=headers)
+
+        prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []) if isinstance(m.get("content"), str))
+        usage = {"prompt_tokens": max(1, prompt_chars // 4), "completion_tokens": args.chunks, "total_tokens": max(1, prompt_chars // 4) + args.chunks}
+
+        if not body.get("stream"):
+            text = "".join(content_piece() for _ in range(args.chunks))
+            return JSONResponse({
+                "id": "gen-mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            }, headers=headers)
+
+        async def events():
+            yield b": OPENROUTER PROCESSING\n\n"
+            for _ in range(args.chunks):
+                event = {"id": "gen-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                         "choices": [{"index": 0, "delta": {"content": content_piece()}, "finish_reason": None}]}
+                yield b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n"
+                if args.chunk_delay_ms:
+                    await asyncio.sleep(args.chunk_delay_ms / 1000)
+            yield b"data: " + json.dumps({"id": "gen-mock", "choices": [], "usage": usage}).encode("utf-8") + b"\n\n"
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    return Starlette(routes=[
+        Route("/api/v1/models", list_models),
+        Route("/api/v1/chat/completions", chat_completions, methods=["POST"]),
+    ])
+
+def main():
+    import uvicorn
+
+    args = build_parser().parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning", access_log=False)
+
+if __name__ == "__main__":
+    main()
@@ -39,6 +39,15 @@ def load_config(path: str = "config.json") -> AppConfig:
         port = os.getenv("SERVER_PORT")
         if port:
             config_data['server']['port'] = int(port)
+
+        # 指向其它上游（例如基准测试中的本地模拟服务）和其它数据库文件
+        base_url = os.getenv("OPENROUTER_BASE_URL")
+        if base_url:
+            config_data['openrouter']['base_url'] = base_url
+
+        database_url = os.getenv("DATABASE_URL")
+        if database_url:
+            config_data.setdefault('database', {})['url'] = database_url
             
         return AppConfig(config_data)
     except FileNotFoundError:
@@ -1,14 +1,22 @@
 import logging
-import time
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
-from app.database import init_db
-from app.routers import admin, proxy
-from app.services.openrouter_client import openrouter_client
+from app.database import init_db, close_all_connections, run_write, shutdown_executors
+from app.routers import admin, metrics, proxy
+from app.services.access_log import access_log, AccessLogMiddleware
+from app.services.http_client import upstream_http
+from app.services.key_manager import key_manager
+from app.services.model_refresher import model_refresher
+from app.services.model_registry import model_registry
+from app.services.response_cache import response_cache
+from app.services.retention import retention_manager
+from app.services.token_accounting import token_accountant
+from app.services.tokenizer import tokenizer
+from app.services.usage_writer import usage_writer
 from config import config
 
 # 配置日志
@@ -21,14 +29,37 @@ async def lifespan(app: FastAPI):
     应用生命周期管理，在启动时执行初始化任务。
     """
     logger.info("🚀 服务启动中...")
+    if config.get('access_log.enabled', True):
+        access_log.start()
     # 1. 初始化数据库
-    init_db()
-    # 2. 更新免费模型缓存
-    logger.info("🔄 正在从OpenRouter获取免费模型列表...")
-    await openrouter_client.update_free_models_cache()
+    await run_write(init_db)
+    # 2. 创建共享的上游HTTP连接池
+    await upstream_http.start()
+    # 3. 启动后台使用记录写入任务
+    await usage_writer.start()
+    # 4. 加载API Key调度器
+    await key_manager.start()
+    # 5. 从本地缓存加载tokenizer编码器
+    await tokenizer.start()
+    # 6. 直接使用数据库中保存的免费模型，由后台任务定期从OpenRouter刷新
+    logger.info(f"📦 已从数据库加载 {await model_registry.reload()} 个免费模型。")
+    await model_refresher.start()
+    # 7. 启动使用记录归档任务（未启用时不做任何事）
+    await retention_manager.start()
     logger.info("✅ 服务启动完成。")
     yield
+    await retention_manager.stop()
+    await model_refresher.stop()
+    # 等待后台的token计数完成，再写入队列中剩余的使用记录
+    await token_accountant.drain()
+    await response_cache.drain()
+    await usage_writer.stop()
+    await upstream_http.close()
+    tokenizer.stop()
+    shutdown_executors()
+    close_all_connections()
     logger.info("🛑 服务已关闭。")
+    access_log.stop()
 
 app = FastAPI(
     title="OpenRouter API Proxy",
@@ -39,33 +70,6 @@ app = FastAPI(
 
 # --- 中间件配置 ---
 
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    """记录所有HTTP请求的详细信息。"""
-    start_time = time.time()
-    
-    # 记录请求
-    log_msg = f"\n🔍 收到请求: {request.method} {request.url}\n"
-    log_msg += f"   - 客户端IP: {request.client.host if request.client else 'N/A'}\n"
-    # 可以在这里添加更多需要记录的Header
-    
-    logger.info(log_msg)
-    
-    # 处理请求
-    response = await call_next(request)
-    
-    # 记录响应
-    process_time = time.time() - start_time
-    log_msg = f"   - 响应状态: {response.status_code}\n"
-    log_msg += f"   - 处理时间: {process_time:.3f}s\n"
-    
-    if response.status_code >= 400:
-        logger.error(f"❌ 错误响应: {log_msg}")
-    else:
-        logger.info(f"✅ 成功响应: {log_msg}")
-        
-    return response
-
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -74,6 +78,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 访问日志放在最外层，CORS预检请求也会被记录
+if config.get('access_log.enabled', True):
+    app.add_middleware(AccessLogMiddleware)
+
 # --- 静态文件和路由包含 ---
 
 # 挂载静态文件目录，用于提供admin.html中的CSS和JS
@@ -82,6 +90,8 @@ app.mount("/static", StaticFiles(directory="templates"), name="static")
 # 包含管理后台和代理服务的路由
 app.include_router(admin.router)
 app.include_router(proxy.router)
+if config.get('metrics.enabled', True):
+    app.include_router(metrics.router)
 
 @app.get("/")
 async def root():
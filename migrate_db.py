@@ -1,57 +1,60 @@
+import argparse
 import sqlite3
 import sys
 
-def migrate_database():
-    db_path = 'openrouter_proxy.db'
-    print(f"Connecting to database: {db_path}")
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Get list of columns in api_keys table
-    cursor.execute("PRAGMA table_info(api_keys)")
-    columns = [column[1] for column in cursor.fetchall()]
-    
-    print(f"Existing columns in 'api_keys': {columns}")
-
-    # Add 'daily_limit' column if it doesn't exist
-    if 'daily_limit' not in columns:
-        print("Adding 'daily_limit' column with default value 500...")
-        try:
-            cursor.execute("ALTER TABLE api_keys ADD COLUMN daily_limit INTEGER DEFAULT 500")
-            print("'daily_limit' column added successfully.")
-        except sqlite3.OperationalError as e:
-            print(f"Error adding 'daily_limit' column: {e}", file=sys.stderr)
+from app import crud
+from app.database import DATABASE_URL, get_db_connection, enable_incremental_vacuum
+from app.migrations import MIGRATIONS, apply_migrations, get_schema_version
 
-    # Add 'daily_usage' column if it doesn't exist
-    if 'daily_usage' not in columns:
-        print("Adding 'daily_usage' column with default value 0...")
-        try:
-            cursor.execute("ALTER TABLE api_keys ADD COLUMN daily_usage INTEGER DEFAULT 0")
-            print("'daily_usage' column added successfully.")
-        except sqlite3.OperationalError as e:
-            print(f"Error adding 'daily_usage' column: {e}", file=sys.stderr)
-
-    # Add 'last_reset_time' column if it doesn't exist
-    if 'last_reset_time' not in columns:
-        print("Adding 'last_reset_time' column...")
-        try:
-            cursor.execute("ALTER TABLE api_keys ADD COLUMN last_reset_time TIMESTAMP")
-            print("'last_reset_time' column added successfully.")
-        except sqlite3.OperationalError as e:
-            print(f"Error adding 'last_reset_time' column: {e}", file=sys.stderr)
-    
-    # Set default value for existing rows where daily_limit might be NULL
-    print("Updating existing NULL 'daily_limit' values to 500...")
+def migrate_database():
+    print(f"Connecting to database: {DATABASE_URL}")
     try:
-        cursor.execute("UPDATE api_keys SET daily_limit = 500 WHERE daily_limit IS NULL")
-        print(f"{cursor.rowcount} rows updated.")
-    except sqlite3.OperationalError as e:
-        print(f"Error updating NULL 'daily_limit' values: {e}", file=sys.stderr)
-
-
-    conn.commit()
-    conn.close()
-    print("Database migration check completed.")
+        with get_db_connection() as conn:
+            current = get_schema_version(conn)
+            latest = MIGRATIONS[-1][0]
+            print(f"Current schema version: {current}, latest: {latest}")
+            version = apply_migrations(conn)
+    except sqlite3.Error as e:
+        print(f"Database migration failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Database migration check completed. Schema version: {version}")
+
+def backfill_rollups():
+    print("Rebuilding usage rollup tables from usage_logs...")
+    try:
+        crud.rebuild_usage_rollups()
+    except sqlite3.Error as e:
+        print(f"Rollup backfill failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    print("Usage rollup tables rebuilt.")
+
+def incremental_vacuum():
+    print("Switching database to auto_vacuum=INCREMENTAL (runs a full VACUUM, the database is locked meanwhile)...")
+    try:
+        with get_db_connection() as conn:
+            enable_incremental_vacuum(conn)
+    except sqlite3.Error as e:
+        print(f"Enabling incremental vacuum failed: {e}", file=sys.stderr)
+        sys.exit(1)
+    print("Incremental vacuum enabled.")
 
 if __name__ == "__main__":
-    migrate_database()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Apply database migrations.")
+    parser.add_argument(
+        "--backfill-rollups",
+        action="store_true",
+        help="rebuild the hourly/daily usage rollups from usage_logs after migrating (archived rows are no longer in usage_logs and drop out of the rollups)",
+    )
+    parser.add_argument(
+        "--enable-incremental-vacuum",
+        action="store_true",
+        help="switch an existing database to auto_vacuum=INCREMENTAL so retention can return freed pages to disk",
+    )
+    args = parser.parse_args()
+
+    migrate_database()
+    if args.backfill_rollups:
+        backfill_rollups()
+    if args.enable_incremental_vacuum:
+        incremental_vacuum()
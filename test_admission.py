@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+准入控制的测试：按到达顺序唤醒、排队超时返回503、队列已满时按限制类型返回429或503、Retry-After的估算和取消排队。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_admission.py
+    python -m pytest -q test_admission.py
+"""
+
+import asyncio
+
+from app.services.admission import AdmissionController, AdmissionRejected
+from app.services.metrics import admission_wait_seconds
+
+def make_controller(max_concurrent=0, max_per_model=0, queue_size=10, queue_timeout=1.0) -> AdmissionController:
+    controller = AdmissionController()
+    controller._max_concurrent = max_concurrent
+    controller._max_per_model = max_per_model
+    controller._queue_size = queue_size
+    controller._queue_timeout = queue_timeout
+    return controller
+
+async def rejection(awaitable) -> AdmissionRejected:
+    try:
+        await awaitable
+    except AdmissionRejected as e:
+        return e
+    raise AssertionError("请求应该被拒绝")
+
+def test_waiters_are_admitted_in_arrival_order():
+    async def run():
+        controller = make_controller(max_concurrent=1)
+        first = await controller.admit("m")
+        order = []
+
+        async def wait(name):
+            ticket = await controller.admit("m")
+            order.append(name)
+            return ticket
+
+        tasks = []
+        for name in ("a", "b", "c"):
+            tasks.append(asyncio.ensure_future(wait(name)))
+            await asyncio.sleep(0)
+        assert controller.stats()["queue_length"] == 3
+
+        first.release()
+        # 重复归还没有副作用
+        first.release()
+        for task in tasks:
+            ticket = await task
+            assert controller.stats()["inflight"] == 1
+            ticket.release()
+        assert order == ["a", "b", "c"]
+        stats = controller.stats()
+        assert stats["inflight"] == 0 and stats["queue_length"] == 0
+        assert stats["admitted"] == 4 and stats["queued"] == 3
+    asyncio.run(run())
+
+def test_queue_timeout_is_503_with_retry_after():
+    async def run():
+        controller = make_controller(max_concurrent=1, queue_timeout=0.05)
+        ticket = await controller.admit("m")
+        waits = admission_wait_seconds.labels("admission")
+        observed = waits.count
+        e = await rejection(controller.admit("m"))
+        assert e.status_code == 503 and e.reason == "排队超时"
+        assert e.retry_after >= 1
+        assert controller.stats()["rejected_timeout"] == 1 and controller.stats()["queue_length"] == 0
+        assert waits.count == observed + 1
+        ticket.release()
+        assert controller.stats()["inflight"] == 0
+    asyncio.run(run())
+
+def test_queue_full_is_429_for_model_limit_and_503_for_global_limit():
+    async def run():
+        controller = make_controller(max_per_model=1, queue_size=1, queue_timeout=5.0)
+        ticket = await controller.admit("m")
+        waiter = asyncio.ensure_future(controller.admit("m"))
+        await asyncio.sleep(0)
+        e = await rejection(controller.admit("m"))
+        assert e.status_code == 429 and e.reason == "等待队列已满"
+        # 其它模型不受这个模型的上限影响
+        other = await controller.admit("other")
+        other.release()
+        ticket.release()
+        (await waiter).release()
+
+        controller = make_controller(max_concurrent=1, max_per_model=1, queue_size=1, queue_timeout=5.0)
+        ticket = await controller.admit("m")
+        waiter = asyncio.ensure_future(controller.admit("other"))
+        await asyncio.sleep(0)
+        e = await rejection(controller.admit("m"))
+        assert e.status_code == 503
+        assert controller.stats()["rejected_queue_full"] == 1
+        ticket.release()
+        (await waiter).release()
+    asyncio.run(run())
+
+def test_retry_after_follows_average_request_duration():
+    controller = make_controller(max_concurrent=1)
+    assert controller._rejection("m", "排队超时").retry_after == 1
+    controller._duration_ewma = 2.4
+    assert controller.avg_request_seconds == 2.4
+    assert controller._rejection("m", "排队超时").retry_after == 3
+
+def test_cancelled_waiter_leaves_queue():
+    async def run():
+        controller = make_controller(max_concurrent=1)
+        ticket = await controller.admit("m")
+        waiter = asyncio.ensure_future(controller.admit("m"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            pass
+        assert controller.stats()["queue_length"] == 0
+        ticket.release()
+        assert controller.stats()["inflight"] == 0
+
+        # 分配到名额的同时被取消：要么名额立即归还，要么取消被忽略、名额交给调用方
+        ticket = await controller.admit("m")
+        waiter = asyncio.ensure_future(controller.admit("m"))
+        await asyncio.sleep(0)
+        ticket.release()
+        waiter.cancel()
+        try:
+            (await waiter).release()
+        except asyncio.CancelledError:
+            pass
+        assert controller.stats()["inflight"] == 0
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    test_waiters_are_admitted_in_arrival_order()
+    test_queue_timeout_is_503_with_retry_after()
+    test_queue_full_is_429_for_model_limit_and_503_for_global_limit()
+    test_retry_after_follows_average_request_duration()
+    test_cancelled_waiter_leaves_queue()
+    print("✅ 全部通过")
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+API Key调度器的回归测试：熔断中的Key不能被任何负载均衡策略选中；按模型的429不熔断Key；Key的并发都已满时请求排队等待；
+未加载时不访问数据库；重新加载期间写回的计数不会丢失。
+
+重新加载的测试使用临时数据库，都不需要网络，直接运行或使用pytest:
+    python test_key_manager.py
+    python -m pytest -q test_key_manager.py
+"""
+
+import asyncio
+import heapq
+import os
+import tempfile
+import time
+from datetime import date
+
+import app.database as database
+from app import async_crud, crud
+from app.services.key_manager import APIKeyManager, STRATEGIES
+from app.services.usage_writer import usage_writer
+
+def make_manager(strategy: str, count: int = 3) -> APIKeyManager:
+    manager = APIKeyManager()
+    manager.set_strategy(strategy)
+    manager._rebuild([
+        {
+            "id": i, "key_name": f"k{i}", "api_key": f"sk-{i}", "daily_limit": -1, "daily_usage": 0,
+            "usage_count": 0, "last_reset_time": None, "last_used": None,
+        }
+        for i in range(1, count + 1)
+    ])
+    return manager
+
+def pick(manager: APIKeyManager, times: int) -> dict:
+    counts = {}
+    for _ in range(times):
+        key = manager.get_next_key()
+        assert key is not None
+        counts[key["key_name"]] = counts.get(key["key_name"], 0) + 1
+        manager.release_key(key["id"])
+    return counts
+
+def test_revoked_key_not_selected_after_day_rollover():
+    for name in STRATEGIES:
+        manager = make_manager(name)
+        manager.get_next_key()
+        manager.report_upstream(1, 401)
+        # 模拟UTC跨天
+        manager._today = date(2000, 1, 1)
+        manager._next_day_boundary = 0.0
+        counts = pick(manager, 50)
+        assert "k1" not in counts, (name, counts)
+
+def test_open_key_not_selected_when_another_key_is_readded():
+    for name in STRATEGIES:
+        manager = make_manager(name)
+        # k2连续失败熔断后，管理后台的修改触发重建，k2不在策略的候选集合中
+        for _ in range(manager._states[2].circuit.failure_threshold):
+            manager.report_upstream(2, 500)
+        manager._rebuild([
+            {
+                "id": s.id, "key_name": s.key_name, "api_key": s.api_key, "daily_limit": -1, "daily_usage": 0,
+                "usage_count": 0, "last_reset_time": None, "last_used": None,
+            }
+            for s in manager._states.values()
+        ])
+        # k1因401熔断
+        manager.report_upstream(1, 401)
+        # k2熔断到期，被放回候选集合
+        manager._states[2].circuit.open_until = time.time() - 1
+        heapq.heappush(manager._wake_heap, (0.0, 2))
+        counts = pick(manager, 60)
+        assert "k1" not in counts, (name, counts)
+        assert counts.get("k2", 0) + counts.get("k3", 0) == 60, (name, counts)
+
+def test_model_rate_limit_does_not_trip_key():
+    manager = make_manager("round_robin", count=1)
+    reset = str(int((time.time() + 30) * 1000))
+    key = manager.get_next_key(model="a/model:free")
+    manager.report_upstream(key["id"], 429, 0.1, {"x-ratelimit-limit": "20", "x-ratelimit-remaining": "0", "x-ratelimit-reset": reset}, "a/model:free")
+    manager.release_key(key["id"])
+    assert manager._states[1].circuit.state == "closed"
+    assert manager.get_next_key(model="a/model:free") is None
+    assert manager.get_next_key(model="b/model:free") is not None
+
+    # 没有按模型的限流响应头时视为整个Key被限流
+    manager.report_upstream(1, 429, 0.1, {"retry-after": "30"}, "b/model:free")
+    assert manager._states[1].circuit.state == "open"
+    assert manager.get_next_key(model="c/model:free") is None
+
+def test_request_waits_for_key_at_max_per_key():
+    async def run():
+        manager = make_manager("round_robin", count=1)
+        manager._max_per_key = 1
+        manager._key_wait_timeout = 1.0
+        first = await manager.acquire_key()
+        assert first is not None
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.05, manager.release_key, first["id"])
+        started = time.monotonic()
+        second = await manager.acquire_key()
+        assert second is not None and second["id"] == first["id"]
+        assert 0.03 < time.monotonic() - started < 0.5
+        assert manager.pool_stats()["inflight"] == 1
+
+        # 超时后返回None，Retry-After按请求的平均耗时估算
+        manager._key_wait_timeout = 0.05
+        assert await manager.acquire_key() is None
+        assert manager.retry_after(busy_seconds=3.0) >= 2.9
+        assert not manager._release_waiters
+    asyncio.run(run())
+
+def test_request_waits_for_key_exhausted_yesterday():
+    async def run():
+        manager = make_manager("round_robin", count=1)
+        manager._max_per_key = 1
+        manager._key_wait_timeout = 1.0
+        # 昨天用完了每日额度、跨天时仍有一个进行中请求的Key
+        state = manager._states[1]
+        state.daily_limit, state.daily_usage = 1, 1
+        state.reset_day = date(2000, 1, 1)
+        state.inflight = 1
+        assert manager._at_capacity(None)
+        asyncio.get_running_loop().call_later(0.05, manager.release_key, 1)
+        key = await manager.acquire_key()
+        assert key is not None and key["id"] == 1
+    asyncio.run(run())
+
+def test_unloaded_manager_does_not_touch_database():
+    load_active_api_keys = crud.load_active_api_keys
+
+    def fail():
+        raise AssertionError("不能在事件循环中同步读取数据库")
+
+    crud.load_active_api_keys = fail
+    try:
+        assert APIKeyManager().get_next_key() is None
+    finally:
+        crud.load_active_api_keys = load_active_api_keys
+
+def test_usage_flushed_during_reload_is_not_lost():
+    database.DATABASE_URL = os.path.join(tempfile.mkdtemp(), "test.db")
+    database.init_db()
+    crud.add_api_key("k1", "sk-1", -1)
+    load_active_api_keys = async_crud.load_active_api_keys
+
+    async def run():
+        await usage_writer.start()
+        manager = APIKeyManager()
+        await manager.start()
+        key_id = manager.get_next_key()["id"]
+        manager.release_key(key_id)
+        manager.update_key_usage(key_id)
+        flushes = []
+
+        async def slow_load():
+            rows = await load_active_api_keys()
+            # 读取之后又有一次计数，后台写入在重建之前触发
+            manager.update_key_usage(key_id)
+            flushes.append(asyncio.ensure_future(usage_writer.flush()))
+            await asyncio.sleep(0.05)
+            return rows
+
+        async_crud.load_active_api_keys = slow_load
+        try:
+            await manager.invalidate()
+        finally:
+            async_crud.load_active_api_keys = load_active_api_keys
+        await asyncio.gather(*flushes)
+        await usage_writer.stop()
+        return manager._states[key_id].usage_count
+
+    assert asyncio.run(run()) == 2
+    assert crud.load_active_api_keys()[0]["usage_count"] == 2
+
+if __name__ == "__main__":
+    test_revoked_key_not_selected_after_day_rollover()
+    test_open_key_not_selected_when_another_key_is_readded()
+    test_model_rate_limit_does_not_trip_key()
+    test_request_waits_for_key_at_max_per_key()
+    test_request_waits_for_key_exhausted_yesterday()
+    test_unloaded_manager_does_not_touch_database()
+    test_usage_flushed_during_reload_is_not_lost()
+    print("✅ 全部通过")
@@ -105,6 +105,10 @@ def test_model_context_info():
     sys.path.append(os.path.dirname(os.path.abspath(__file__)))
     
     from app import crud
+    from app.services.model_registry import model_registry
+    
+    # 与代理服务相同，从内存中的模型表读取上下文长度
+    model_registry.replace(crud.get_all_free_models_with_status())
     
     test_models = [
         "openai/gpt-oss-20b:free",
@@ -113,7 +117,7 @@ def test_model_context_info():
     ]
     
     for model in test_models:
-        context_length = crud.get_model_context_length(model)
+        context_length = model_registry.context_length(model)
         print(f"📋 模型: {model}")
         print(f"   上下文长度: {context_length if context_length else '未知'}")
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+指标导出的测试：Prometheus文本格式的HELP/TYPE行、标签值转义、直方图的累计桶和_sum/_count，
+采集函数的输出，请求计数子指标的复用，以及 /metrics 接口。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_metrics.py
+    python -m pytest -q test_metrics.py
+"""
+
+import re
+
+from fastapi.testclient import TestClient
+
+from app.services.metrics import MetricsRegistry, requests_total
+from app.services.token_accounting import TokenAccountant
+
+# 样本行：指标名、可选的标签、数值
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\[\\"n])*",?)*\})? (-?[0-9.e+-]+|\+Inf|NaN)$')
+
+def parse(text: str) -> dict:
+    """
+    按文本格式解析导出结果，检查每个样本都属于之前声明了HELP和TYPE的指标，
+    返回 {指标名: {"type": 类型, "help": 说明, "samples": [(样本名, 标签字符串, 数值)]}}。
+    """
+    assert text.endswith("\n")
+    families, current = {}, None
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            name, documentation = line[7:].split(" ", 1)
+            assert name not in families, f"重复的指标: {name}"
+            current = families[name] = {"help": documentation, "type": None, "samples": []}
+        elif line.startswith("# TYPE "):
+            name, type_name = line[7:].split(" ")
+            assert current is families.get(name) and current["type"] is None, line
+            assert type_name in ("counter", "gauge", "histogram")
+            current["type"] = type_name
+        else:
+            match = SAMPLE.match(line)
+            assert match, f"格式错误的样本行: {line!r}"
+            sample_name, labels, value = match.group(1), match.group(2) or "", match.group(3)
+            assert current is not None and current["type"] is not None, line
+            suffixes = ("_bucket", "_sum", "_count") if current["type"] == "histogram" else ("",)
+            assert any(sample_name == name + suffix for suffix in suffixes), line
+            current["samples"].append((sample_name, labels, float(value)))
+    return families
+
+def test_help_type_and_label_escaping():
+    registry = MetricsRegistry()
+    counter = registry.counter("test_requests_total", "请求数", ("key_id", "model"))
+    counter.labels(1, 'a"b\\c\nd').inc()
+    counter.labels(None, "m").inc(2)
+    registry.gauge("test_inflight", "进行中").set(3)
+    families = parse(registry.render())
+
+    assert families["test_requests_total"]["type"] == "counter"
+    assert families["test_requests_total"]["help"] == "请求数"
+    assert families["test_requests_total"]["samples"] == [
+        ("test_requests_total", '{key_id="1",model="a\\"b\\\\c\\nd"}', 1.0),
+        # None的标签值导出为空字符串
+        ("test_requests_total", '{key_id="",model="m"}', 2.0),
+    ]
+    assert families["test_inflight"]["samples"] == [("test_inflight", "", 3.0)]
+
+def test_histogram_buckets_sum_and_count():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("test_seconds", "耗时", ("queue",), buckets=(0.1, 1.0, 5.0))
+    child = histogram.labels("a")
+    # 等于上限的值计入这个桶（le表示小于等于）
+    for value in (0.05, 0.1, 0.5, 1.0, 2.0, 10.0):
+        child.observe(value)
+    samples = parse(registry.render())["test_seconds"]["samples"]
+    assert samples == [
+        ("test_seconds_bucket", '{queue="a",le="0.1"}', 2.0),
+        ("test_seconds_bucket", '{queue="a",le="1"}', 4.0),
+        ("test_seconds_bucket", '{queue="a",le="5"}', 5.0),
+        ("test_seconds_bucket", '{queue="a",le="+Inf"}', 6.0),
+        ("test_seconds_sum", '{queue="a"}', 13.65),
+        ("test_seconds_count", '{queue="a"}', 6.0),
+    ]
+
+    # 没有标签的直方图
+    registry = MetricsRegistry()
+    registry.histogram("test_plain", "无标签", buckets=(1,)).observe(0.5)
+    samples = parse(registry.render())["test_plain"]["samples"]
+    assert samples == [
+        ("test_plain_bucket", '{le="1"}', 1.0),
+        ("test_plain_bucket", '{le="+Inf"}', 1.0),
+        ("test_plain_sum", "", 0.5),
+        ("test_plain_count", "", 1.0),
+    ]
+
+def test_collectors():
+    registry = MetricsRegistry()
+
+    def collect():
+        yield "test_pool", "连接数", "gauge", [({"state": "idle"}, 2), ({"state": 'in"use'}, 1)]
+        yield "test_max", "上限", "gauge", [({}, 100)]
+
+    registry.register_collector(collect)
+    families = parse(registry.render())
+    assert families["test_pool"]["samples"] == [("test_pool", '{state="idle"}', 2.0), ("test_pool", '{state="in\\"use"}', 1.0)]
+    assert families["test_max"]["samples"] == [("test_max", "", 100.0)]
+
+def test_request_counter_child_is_reused():
+    accountant = TokenAccountant()
+    counter = accountant._request_counter(7, "m", 200)
+    assert accountant._request_counter(7, "m", 200) is counter
+    assert counter is requests_total.labels(7, "m", 200)
+    assert accountant._request_counter(7, "m", 429) is not counter
+    assert accountant._request_counter(8, "m", 200) is not counter
+    before = counter.value
+    counter.inc()
+    assert requests_total.labels(7, "m", 200).value == before + 1
+
+def test_metrics_endpoint():
+    import main
+    client = TestClient(main.app)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "text/plain; version=0.0.4; charset=utf-8"
+    families = parse(response.text)
+    assert families["openrouter_proxy_requests_total"]["type"] == "counter"
+    assert families["openrouter_proxy_upstream_ttfb_seconds"]["type"] == "histogram"
+    assert families["openrouter_proxy_usage_queue_depth"]["type"] == "gauge"
+    assert families["openrouter_proxy_admission_rejected_total"]["type"] == "counter"
+
+if __name__ == "__main__":
+    test_help_type_and_label_escaping()
+    test_histogram_buckets_sum_and_count()
+    test_collectors()
+    test_request_counter_child_is_reused()
+    test_metrics_endpoint()
+    print("✅ 全部通过")
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+数据库迁移的测试：在引入版本号之前创建的旧数据库升级到最新结构、保留已有数据并回填汇总表，再次执行时不做任何修改。
+
+使用临时数据库，不需要网络，直接运行或使用pytest:
+    python test_migrations.py
+    python -m pytest -q test_migrations.py
+"""
+
+import os
+import sqlite3
+import tempfile
+
+import app.database as database
+from app.migrations import MIGRATIONS, apply_migrations, get_schema_version
+
+# 最早版本的表结构：api_keys还没有每日限额字段，free_models没有上下文长度和参数
+OLD_SCHEMA = """
+CREATE TABLE api_keys (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key_name TEXT NOT NULL,
+    api_key TEXT NOT NULL UNIQUE,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used TIMESTAMP,
+    usage_count INTEGER DEFAULT 0
+);
+CREATE TABLE usage_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    api_key_id INTEGER,
+    model TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    total_tokens INTEGER,
+    cost REAL,
+    request_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    response_status INTEGER,
+    FOREIGN KEY (api_key_id) REFERENCES api_keys (id)
+);
+CREATE TABLE free_models (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    model_id TEXT UNIQUE NOT NULL,
+    model_name TEXT NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE
+);
+INSERT INTO api_keys (key_name, api_key, usage_count) VALUES ('k1', 'sk-1', 3);
+INSERT INTO free_models (model_id, model_name) VALUES ('foo/bar:free', 'Bar');
+INSERT INTO usage_logs (api_key_id, model, prompt_tokens, completion_tokens, total_tokens, cost, request_time, response_status) VALUES
+    (1, 'foo/bar:free', 3, 1, 4, 0, '2026-01-01 10:15:00', 200),
+    (1, 'foo/bar:free', 5, 2, 7, 0, '2026-01-01 10:45:00', 200),
+    (1, 'foo/bar:free', 0, 0, 0, 0, '2026-01-01 11:00:00', 429),
+    (NULL, 'foo/bar:free', 1, 1, 2, 0, '2026-01-02 00:00:01', 203);
+"""
+
+def make_old_database() -> str:
+    path = os.path.join(tempfile.mkdtemp(), "old.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    conn.close()
+    return path
+
+def columns(conn: sqlite3.Connection, table: str) -> list:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+def dump(conn: sqlite3.Connection) -> list:
+    return list(conn.iterdump())
+
+def test_old_database_is_upgraded_to_latest_version():
+    database.DATABASE_URL = make_old_database()
+    database.init_db()
+
+    with database.get_db_connection() as conn:
+        assert get_schema_version(conn) == 8 == MIGRATIONS[-1][0]
+        # 补齐的字段，旧Key使用迁移时的默认每日限额
+        assert {"daily_limit", "daily_usage", "last_reset_time"} <= set(columns(conn, "api_keys"))
+        assert [tuple(r) for r in conn.execute("SELECT key_name, usage_count, daily_limit, daily_usage FROM api_keys")] == [("k1", 3, 500, 0)]
+        assert {"context_length", "parameters", "created", "parameter_count"} <= set(columns(conn, "free_models"))
+        assert "estimated_prompt_tokens" in columns(conn, "usage_logs")
+        assert conn.execute("SELECT COUNT(*) FROM usage_logs").fetchone()[0] == 4
+
+        indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"idx_usage_logs_request_time", "idx_usage_logs_time_id", "idx_response_cache_created"} <= indexes
+        assert conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0] == 0
+
+        # 汇总表从已有记录回填
+        hourly = [tuple(r) for r in conn.execute(
+            "SELECT bucket, api_key_id, status_class, request_count, total_tokens FROM usage_rollup_hourly ORDER BY bucket, status_class"
+        )]
+        assert hourly == [
+            ("2026-01-01 10:00:00", 1, 2, 2, 11),
+            ("2026-01-01 11:00:00", 1, 4, 1, 0),
+            ("2026-01-02 00:00:00", 0, 2, 1, 2),
+        ]
+        daily = [tuple(r) for r in conn.execute("SELECT bucket, SUM(request_count) FROM usage_rollup_daily GROUP BY bucket ORDER BY bucket")]
+        assert daily == [("2026-01-01", 3), ("2026-01-02", 1)]
+
+def test_second_run_is_a_no_op():
+    path = make_old_database()
+    database.DATABASE_URL = path
+    database.init_db()
+
+    conn = sqlite3.connect(path)
+    try:
+        # 绕过汇总表直接插入一条记录：如果回填再次执行，汇总表会包含它
+        conn.execute("INSERT INTO usage_logs (api_key_id, model, total_tokens, request_time, response_status) VALUES (1, 'x', 9, '2026-01-03 00:00:00', 200)")
+        conn.commit()
+        before = dump(conn)
+        changes = conn.total_changes
+        assert apply_migrations(conn) == 8
+        assert conn.total_changes == changes
+        assert dump(conn) == before
+        assert conn.execute("SELECT COUNT(*) FROM usage_rollup_daily WHERE bucket = '2026-01-03'").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+    # 通过init_db再次启动同样不做任何修改
+    database.init_db()
+    conn = sqlite3.connect(path)
+    try:
+        assert dump(conn) == before and get_schema_version(conn) == 8
+    finally:
+        conn.close()
+
+def test_failed_migration_is_rolled_back():
+    database.DATABASE_URL = make_old_database()
+    conn = sqlite3.connect(database.DATABASE_URL, isolation_level=None)
+
+    def broken(cursor):
+        cursor.execute("CREATE TABLE half_done (id INTEGER)")
+        raise sqlite3.OperationalError("disk I/O error")
+
+    MIGRATIONS.append((9, "broken", broken))
+    try:
+        try:
+            apply_migrations(conn)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise AssertionError("迁移失败应该引发异常")
+    finally:
+        MIGRATIONS.pop()
+    try:
+        # 之前的迁移已经提交，失败的迁移没有留下任何修改
+        assert get_schema_version(conn) == 8
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'half_done'").fetchone()[0] == 0
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    test_old_database_is_upgraded_to_latest_version()
+    test_second_run_is_a_no_op()
+    test_failed_migration_is_rolled_back()
+    print("✅ 全部通过")
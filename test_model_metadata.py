@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+模型参数量提取的测试：一组OpenRouter模型描述的期望提取结果，以及按描述缓存的提取。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_model_metadata.py
+    python -m pytest -q test_model_metadata.py
+"""
+
+from app.services.model_metadata import extract_parameters, ModelMetadataEnricher
+
+# 节选自OpenRouter /models 返回的模型描述：(模型ID, 描述节选, 期望的参数量标签, 期望的参数个数)
+# benchmarks/bench_param_extraction.py 也使用这份语料
+CORPUS = [
+    ("mistralai/mistral-small-3.1-24b-instruct:free",
+     "Mistral Small 3.1 24B Instruct is an upgraded variant of Mistral Small 3 (2501), featuring 24 billion parameters "
+     "with advanced multimodal capabilities.", "24B", 24 * 10 ** 9),
+    ("mistralai/mistral-small-24b-instruct-2501:free",
+     "Mistral Small 3 is a 24B-parameter language model optimized for low-latency performance across common AI tasks.",
+     "24B", 24 * 10 ** 9),
+    ("deepseek/deepseek-r1:free",
+     "DeepSeek R1 is here: Performance on par with OpenAI o1, but open-sourced and with fully open reasoning tokens. "
+     "It's 671B parameters in size, with 37B active in an inference pass.", "671B", 671 * 10 ** 9),
+    ("deepseek/deepseek-chat-v3-0324:free",
+     "DeepSeek V3, a 685B-parameter, mixture-of-experts model, is the latest iteration of the flagship chat model "
+     "family from the DeepSeek team.", "685B", 685 * 10 ** 9),
+    ("qwen/qwen3-235b-a22b:free",
+     "Qwen3-235B-A22B is a 235B parameter mixture-of-experts (MoE) model developed by Qwen, activating 22B parameters "
+     "per forward pass.", "235B", 235 * 10 ** 9),
+    ("qwen/qwen3-30b-a3b:free",
+     "Qwen3, the latest generation in the Qwen large language model series, features both dense and mixture-of-experts "
+     "(MoE) architectures. This 30.5B total parameters model activates 3.3B parameters per token.", "30.5B", 30_500_000_000),
+    ("moonshotai/kimi-k2:free",
+     "Kimi K2 Instruct is a large-scale Mixture-of-Experts (MoE) language model developed by Moonshot AI, featuring "
+     "1 trillion total parameters with 32 billion active per forward pass.", "1T", 10 ** 12),
+    ("openai/gpt-oss-20b:free",
+     "gpt-oss-20b is an open-weight 21B parameter model released by OpenAI under the Apache 2.0 license. It uses a "
+     "Mixture-of-Experts (MoE) architecture with 3.6B active parameters per forward pass.", "21B", 21 * 10 ** 9),
+    ("meta-llama/llama-3.3-70b-instruct:free",
+     "The Meta Llama 3.3 multilingual large language model (LLM) is a pretrained and instruction tuned generative model "
+     "in 70B (text in/text out).", None, None),
+    ("meta-llama/llama-3.2-3b-instruct:free",
+     "Llama 3.2 3B is a 3-billion-parameter multilingual large language model, optimized for advanced natural language "
+     "processing tasks like dialogue generation, reasoning, and summarization.", "3B", 3 * 10 ** 9),
+    ("google/gemma-3n-e4b-it:free",
+     "Gemma 3n E4B-it is optimized for efficient execution on mobile and low-resource devices. It uses selective "
+     "parameter activation to run with a memory footprint comparable to a 4B parameter model.", "4B", 4 * 10 ** 9),
+    ("tngtech/deepseek-r1t2-chimera:free",
+     "DeepSeek-TNG-R1T2-Chimera is the second-generation Chimera model from TNG Tech. It is a 671 B-parameter "
+     "mixture-of-experts text-generation model.", "671B", 671 * 10 ** 9),
+    ("arcee-ai/afm-4.5b:free",
+     "AFM-4.5B is a 4.5 billion parameter instruction-tuned language model developed by Arcee AI, trained on "
+     "8 trillion tokens.", "4.5B", 4_500_000_000),
+    ("liquid/lfm-350m:free",
+     "LFM2-350M is a compact 350M parameter hybrid model designed for on-device deployment with 32K context.",
+     "350M", 350 * 10 ** 6),
+    ("example/tiny-embed:free",
+     "A 110 million parameter encoder distilled for retrieval; it supports a 512-token context.", "110M", 110 * 10 ** 6),
+    ("nvidia/nemotron-nano-9b-v2:free",
+     "NVIDIA-Nemotron-Nano-9B-v2 is a large language model (LLM) trained from scratch by NVIDIA, and designed as a "
+     "unified model for both reasoning and non-reasoning tasks.", None, None),
+    ("z-ai/glm-4.5-air:free",
+     "GLM-4.5-Air is the lightweight variant of our latest flagship model family. It adopts a Mixture-of-Experts (MoE) "
+     "architecture with 106B total parameters and 12B active parameters.", "106B", 106 * 10 ** 9),
+    ("openrouter/auto:free",
+     "Your prompt will be processed by a meta-model and routed to one of dozens of models, each with 128k context and "
+     "different parameter settings.", None, None),
+]
+
+def test_corpus():
+    for model_id, description, label, count in CORPUS:
+        result = extract_parameters(description)
+        got = (result.label, result.count) if result else (None, None)
+        assert got == (label, count), (model_id, got)
+
+def test_empty_and_unit_spellings():
+    assert extract_parameters("") is None
+    assert extract_parameters(None) is None
+    for description, expected in (
+        ("a 7b parameter model", ("7B", 7 * 10 ** 9)),
+        ("1.5B-parameter", ("1.5B", 1_500_000_000)),
+        ("500 thousand parameters", ("500K", 500_000)),
+        ("2 Trillion params", ("2T", 2 * 10 ** 12)),
+        # 先出现的总参数量优先于激活参数量
+        ("30B total parameters, 3B active parameters", ("30B", 30 * 10 ** 9)),
+    ):
+        result = extract_parameters(description)
+        assert (result.label, result.count) == expected, description
+    # 版本号和上下文长度不是参数量
+    assert extract_parameters("v3.5 with 128k context") is None
+    assert extract_parameters("Llama-3.1-8B instruct") is None
+
+def test_enricher_caches_by_description():
+    enricher = ModelMetadataEnricher()
+    models = [{"id": model_id, "description": description} for model_id, description, _, _ in CORPUS]
+    enriched = enricher.enrich(models)
+    assert [(m["parameters"], m["parameter_count"]) for m in enriched] == [(label, count) for _, _, label, count in CORPUS]
+    assert enriched[0]["name"] == CORPUS[0][0]
+    misses = enricher.stats()["misses"]
+    enricher.enrich(models)
+    assert enricher.stats()["misses"] == misses
+    assert enricher.stats()["hits"] == len(CORPUS)
+    # 只保留本次刷新出现过的描述
+    enricher.enrich(models[:2])
+    assert enricher.stats()["cache_entries"] == 2
+
+if __name__ == "__main__":
+    test_corpus()
+    test_empty_and_unit_spellings()
+    test_enricher_caches_by_description()
+    print("✅ 全部通过")
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+免费模型刷新的回归测试：ETag/Last-Modified只在数据库和模型表都更新成功后保存，失败时清除。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_openrouter_client.py
+    python -m pytest -q test_openrouter_client.py
+"""
+
+import asyncio
+
+from app import async_crud
+from app.services import openrouter_client as client_module
+from app.services.model_registry import model_registry
+from app.services.openrouter_client import OpenRouterClient
+
+MODELS = [{"id": "foo/bar:free", "name": "Bar", "context_length": 8192}]
+VALIDATORS = {"etag": '"v2"', "last_modified": "Thu, 01 Jan 2026 00:00:00 GMT"}
+
+def run_refresh(update_free_models, reload):
+    client = OpenRouterClient()
+    client._models_etag = '"v1"'
+
+    async def fetch_models(conditional=False):
+        return MODELS, VALIDATORS
+
+    client.fetch_models = fetch_models
+    saved = (async_crud.update_free_models, model_registry.reload, client_module.model_metadata.enrich)
+    async_crud.update_free_models = update_free_models
+    model_registry.reload = reload
+    client_module.model_metadata.enrich = lambda models: models
+    try:
+        try:
+            asyncio.run(client.update_free_models_cache(conditional=True))
+        except RuntimeError:
+            pass
+    finally:
+        async_crud.update_free_models, model_registry.reload, client_module.model_metadata.enrich = saved
+    return client
+
+async def changed(models):
+    return {"added": len(models), "updated": 0, "deactivated": 0}
+
+async def reloaded():
+    pass
+
+async def fail(*args):
+    raise RuntimeError("database is locked")
+
+def test_validators_saved_after_successful_update():
+    client = run_refresh(changed, reloaded)
+    assert client._models_etag == VALIDATORS["etag"]
+    assert client._models_last_modified == VALIDATORS["last_modified"]
+
+def test_validators_cleared_when_database_write_fails():
+    client = run_refresh(fail, reloaded)
+    assert client._models_etag is None and client._models_last_modified is None
+
+def test_validators_cleared_when_registry_reload_fails():
+    client = run_refresh(changed, fail)
+    assert client._models_etag is None and client._models_last_modified is None
+
+if __name__ == "__main__":
+    test_validators_saved_after_successful_update()
+    test_validators_cleared_when_database_write_fails()
+    test_validators_cleared_when_registry_reload_fails()
+    print("✅ 全部通过")
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+令牌桶的测试：按速率补充、突发容量、用上游的 X-RateLimit-* 响应头校正桶、429之后等待到重置时间，
+以及每个Key和每个 (Key, 模型) 的桶互不影响。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_rate_limiter.py
+    python -m pytest -q test_rate_limiter.py
+"""
+
+from app.services.rate_limiter import TokenBucket, KeyRateLimiter
+
+NOW = 1_700_000_000.0
+
+def make_limiter(key_rpm: int = 0, model_rpm: int = 20) -> KeyRateLimiter:
+    limiter = KeyRateLimiter()
+    limiter._enabled = True
+    limiter._key_rpm = key_rpm
+    limiter._model_rpm = model_rpm
+    return limiter
+
+def drain(limiter: KeyRateLimiter, key_id: int, model, now: float) -> int:
+    taken = 0
+    while limiter.allows(key_id, model, now):
+        limiter.acquire(key_id, model, now)
+        taken += 1
+        assert taken < 10000
+    return taken
+
+# --- TokenBucket ---
+
+def test_bucket_allows_burst_up_to_capacity():
+    bucket = TokenBucket(capacity=5, rate=1, now=NOW)
+    for _ in range(5):
+        assert bucket.available(NOW)
+        bucket.take(NOW)
+    assert not bucket.available(NOW)
+    # 长时间空闲后也不会超过容量
+    assert bucket.as_dict(NOW + 3600)["tokens"] == 5
+
+def test_bucket_refills_at_rate():
+    bucket = TokenBucket(capacity=10, rate=2, now=NOW)
+    bucket.tokens = 0
+    assert not bucket.available(NOW + 0.4)
+    assert bucket.available(NOW + 0.5)
+    assert abs(bucket.as_dict(NOW + 2)["tokens"] - 4) < 1e-9
+    bucket.take(NOW + 2)
+    bucket.take(NOW + 2)
+    bucket.take(NOW + 2)
+    bucket.take(NOW + 2)
+    assert abs(bucket.next_token_at(NOW + 2) - (NOW + 2.5)) < 1e-6
+
+def test_bucket_seeded_from_headers_and_blocked():
+    bucket = TokenBucket(capacity=20, rate=20 / 60, now=NOW)
+    # 上游报告容量100、剩余10、10秒后重置：到重置时间恰好补满
+    bucket.seed(100, 10, NOW + 10, NOW)
+    assert bucket.capacity == 100 and bucket.tokens == 10
+    assert abs(bucket.rate - 9) < 1e-9
+    assert abs(bucket.as_dict(NOW + 10)["tokens"] - 100) < 1e-9
+
+    bucket.block_until(NOW + 30)
+    assert not bucket.available(NOW + 29)
+    assert abs(bucket.next_token_at(NOW + 29) - (NOW + 30 + 1 / 9)) < 1e-6
+    assert bucket.as_dict(NOW)["blocked_for"] == 30
+
+# --- KeyRateLimiter ---
+
+def test_model_buckets_are_per_key_and_model():
+    limiter = make_limiter(model_rpm=3)
+    assert drain(limiter, 1, "a", NOW) == 3
+    assert not limiter.allows(1, "a", NOW)
+    # 同一个Key的其它模型、其它Key的同一个模型都不受影响
+    assert drain(limiter, 1, "b", NOW) == 3
+    assert drain(limiter, 2, "a", NOW) == 3
+    # 每分钟3个请求：20秒补充一个令牌
+    assert abs(limiter.next_available([1], "a", NOW) - (NOW + 20)) < 1e-6
+    assert not limiter.allows(1, "a", NOW + 19)
+    assert limiter.allows(1, "a", NOW + 21)
+
+def test_key_bucket_limits_all_models():
+    limiter = make_limiter(key_rpm=4, model_rpm=3)
+    assert drain(limiter, 1, "a", NOW) == 3
+    # Key的桶只剩一个令牌，其它模型也只能再用一个
+    assert drain(limiter, 1, "b", NOW) == 1
+    assert not limiter.allows(1, None, NOW)
+    assert limiter.allows(2, "a", NOW)
+    # 最早的Key：2现在就有令牌
+    assert limiter.next_available([1, 2], "a", NOW) == NOW
+
+def test_observe_seeds_model_bucket_from_headers():
+    limiter = make_limiter(model_rpm=20)
+    headers = {"x-ratelimit-limit": "50", "x-ratelimit-remaining": "0", "x-ratelimit-reset": str(int((NOW + 5) * 1000))}
+    assert limiter.observe(1, "a", 200, headers, NOW) is False
+    assert not limiter.allows(1, "a", NOW)
+    assert limiter.allows(1, "b", NOW)
+    stats = limiter.key_stats(1)["models"]["a"]
+    assert stats["capacity"] == 50 and stats["refill_per_second"] == 10
+    # 到重置时间时补满
+    assert drain(limiter, 1, "a", NOW + 5) == 50
+    # 没有X-RateLimit-*响应头时不改变桶
+    assert limiter.observe(1, "a", 200, {"content-type": "application/json"}, NOW + 5) is False
+    assert limiter.key_stats(1)["models"]["a"]["capacity"] == 50
+
+def test_observe_429_blocks_only_that_model():
+    limiter = make_limiter(key_rpm=100, model_rpm=20)
+    headers = {"x-ratelimit-limit": "20", "x-ratelimit-remaining": "0", "x-ratelimit-reset": "30"}
+    # 带有X-RateLimit-*响应头的429只针对这个模型
+    assert limiter.observe(1, "a", 429, headers, NOW) is True
+    assert not limiter.allows(1, "a", NOW + 29)
+    assert limiter.allows(1, "a", NOW + 30 + 6)
+    assert limiter.allows(1, "b", NOW)
+
+    # 只有Retry-After的429由调用方熔断Key
+    assert limiter.observe(1, "c", 429, {"retry-after": "10"}, NOW) is False
+    assert not limiter.allows(1, "c", NOW + 9)
+
+    # 没有模型时校正Key的桶
+    assert limiter.observe(2, None, 429, {"retry-after": "10"}, NOW) is False
+    assert not limiter.allows(2, "a", NOW + 9)
+    assert limiter.allows(2, "a", NOW + 11)
+
+def test_disabled_and_retain():
+    limiter = make_limiter(model_rpm=1)
+    limiter._enabled = False
+    assert all(limiter.allows(1, "a", NOW) for _ in range(3))
+    limiter.acquire(1, "a", NOW)
+    assert limiter.key_stats(1)["models"] == {}
+
+    limiter._enabled = True
+    drain(limiter, 1, "a", NOW)
+    drain(limiter, 2, "a", NOW)
+    limiter.retain([2])
+    assert limiter.allows(1, "a", NOW) and not limiter.allows(2, "a", NOW)
+
+if __name__ == "__main__":
+    test_bucket_allows_burst_up_to_capacity()
+    test_bucket_refills_at_rate()
+    test_bucket_seeded_from_headers_and_blocked()
+    test_model_buckets_are_per_key_and_model()
+    test_key_bucket_limits_all_models()
+    test_observe_seeds_model_bucket_from_headers()
+    test_observe_429_blocks_only_that_model()
+    test_disabled_and_retain()
+    print("✅ 全部通过")
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+响应缓存的测试：缓存键、TTL和LRU淘汰、绕过缓存的请求头、SQLite第二层，命中时写入的203使用记录，以及流式响应的记录和回放。
+
+使用临时数据库和模拟的上游，不需要网络，直接运行或使用pytest:
+    python test_response_cache.py
+    python -m pytest -q test_response_cache.py
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import httpx
+from fastapi.testclient import TestClient
+
+import app.database as database
+from app import crud
+from app.services import http_client
+from app.services.response_cache import ResponseCache, response_cache, CACHE_HIT_STATUS
+from app.services.sse import SSEUsageParser, frame_transcript
+
+H = {"Authorization": "Bearer admin123"}
+MODEL = "foo/bar:free"
+USAGE = {"prompt_tokens": 3, "completion_tokens": 1, "total_tokens": 4}
+SSE_BODY = (
+    b'data: {"choices":[{"delta":{"content":"he"}}]}\n\n'
+    b'data: {"choices":[{"delta":{"content":"llo \xe4\xbd\xa0"}}]}\n\n'
+    b'data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":1,"total_tokens":4}}\n\n'
+    b'data: [DONE]\n\n'
+)
+
+def use_temp_db() -> str:
+    path = os.path.join(tempfile.mkdtemp(), "test.db")
+    database.DATABASE_URL = path
+    database.init_db()
+    return path
+
+def make_cache(**overrides) -> ResponseCache:
+    cache = ResponseCache()
+    cache.enabled = True
+    cache._deterministic_only = True
+    cache._sqlite = False
+    for name, value in overrides.items():
+        setattr(cache, "_" + name, value)
+    return cache
+
+def body(**fields):
+    return {"model": MODEL, "temperature": 0, "messages": [{"role": "user", "content": "hi"}], **fields}
+
+def test_cache_key_only_for_deterministic_requests():
+    cache = make_cache()
+    assert cache.cache_key(body()) is not None
+    assert cache.cache_key(body(temperature=0.7)) is None
+    assert cache.cache_key(body(temperature=0.7, seed=42)) is None
+    assert cache.cache_key(body(n=2)) is None
+    no_temperature = body()
+    del no_temperature["temperature"]
+    assert cache.cache_key(no_temperature) is None
+    # seed和客户端自己指定的max_tokens会影响输出，参与缓存键
+    assert cache.cache_key(body(seed=1)) != cache.cache_key(body(seed=2))
+    assert cache.cache_key(body(max_tokens=10)) != cache.cache_key(body(max_tokens=20))
+
+    cache._deterministic_only = False
+    assert cache.cache_key(body(temperature=0.7)) is not None
+
+def test_cache_key_ignores_stream_options_and_marks_streams():
+    cache = make_cache()
+    plain = cache.cache_key(body())
+    assert cache.cache_key(body(stream_options={"include_usage": True})) == plain
+    assert cache.cache_key(body(stream=False)) == plain
+    stream = cache.cache_key(body(stream=True))
+    assert stream == "sse:" + plain
+    assert cache.cache_key(body(stream=True, stream_options={"include_usage": True})) == stream
+    # 键的顺序不影响缓存键
+    reordered = dict(reversed(list(body().items())))
+    assert cache.cache_key(reordered) == plain
+
+def test_disabled_cache_has_no_keys():
+    cache = make_cache()
+    cache.enabled = False
+    assert cache.cache_key(body()) is None
+
+def test_ttl_expiry():
+    cache = make_cache()
+    cache.put("a", b"{}", USAGE)
+    assert asyncio.run(cache.get("a")) is not None
+    cache._entries["a"].expires_at = time.time() - 1
+    assert asyncio.run(cache.get("a")) is None
+    stats = cache.stats()
+    assert stats["expired"] == 1 and stats["entries"] == 0 and stats["bytes"] == 0
+
+def test_lru_eviction_by_entry_count():
+    cache = make_cache(max_entries=2)
+    cache.put("a", b"1", None)
+    cache.put("b", b"2", None)
+    # 读取a之后，最久没有使用的是b
+    assert asyncio.run(cache.get("a")) is not None
+    cache.put("c", b"3", None)
+    assert list(cache._entries) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+
+def test_lru_eviction_by_bytes_and_entry_size_limit():
+    cache = make_cache(max_bytes=10, max_entry_bytes=8)
+    cache.put("a", b"123456", None)
+    cache.put("b", b"123456", None)
+    assert list(cache._entries) == ["b"]
+    assert cache.stats()["bytes"] == 6
+    cache.put("c", b"123456789", None)
+    assert "c" not in cache._entries
+    assert cache.stats()["too_large"] == 1
+    # 覆盖已有的键不会重复计算大小
+    cache.put("b", b"12", None)
+    assert cache.stats()["bytes"] == 2
+
+def test_bypass_header():
+    cache = make_cache()
+    assert cache.bypassed({"x-cache-bypass": "1"})
+    assert cache.bypassed({"x-cache-bypass": "true"})
+    for value in ("0", "false", "no", ""):
+        assert not cache.bypassed({"x-cache-bypass": value})
+    assert not cache.bypassed({})
+
+def test_sqlite_round_trip():
+    use_temp_db()
+    cache = make_cache(sqlite=True)
+
+    async def run():
+        cache.put("a", b'{"ok":true}', USAGE)
+        await cache.drain()
+        # 只剩SQLite中的条目
+        cache._entries.clear()
+        cache._bytes = 0
+        entry = await cache.get("a")
+        assert entry is not None
+        assert entry.body == b'{"ok":true}' and entry.usage == USAGE
+        assert cache.stats()["sqlite_hits"] == 1
+        # 命中后放回内存
+        assert "a" in cache._entries
+
+        await cache.clear()
+        assert await cache.get("a") is None
+    asyncio.run(run())
+
+def record(chunks, record_limit: int = 1 << 20):
+    parser = SSEUsageParser(record_limit)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser
+
+def test_stream_transcript_replays_byte_for_byte():
+    chunks = [SSE_BODY[i:i + 7] for i in range(0, len(SSE_BODY), 7)]
+    parser = record(chunks)
+    assert parser.done
+    assert frame_transcript(parser.transcript) == SSE_BODY
+
+    # 注释行和\r\n换行在回放时规范化为标准的SSE格式
+    noisy = b": OPENROUTER PROCESSING\r\n\r\n" + SSE_BODY.replace(b"\n", b"\r\n")
+    assert frame_transcript(record([noisy]).transcript) == SSE_BODY
+    # 回放的响应再次解析得到同样的usage和内容
+    replayed = record([frame_transcript(parser.transcript)])
+    assert replayed.usage == USAGE and replayed.content == parser.content and replayed.done
+
+def test_stream_transcript_not_kept_when_incomplete_or_too_large():
+    # 没有 [DONE]
+    assert record([SSE_BODY.replace(b"data: [DONE]\n\n", b"")]).transcript is None
+    # 超过记录上限
+    assert record([SSE_BODY], record_limit=40).transcript is None
+    # 多行data无法按行回放
+    assert record([b"data: a\ndata: b\n\ndata: [DONE]\n\n"]).transcript is None
+    # 没有开启记录
+    assert record([SSE_BODY], record_limit=0).transcript is None
+    assert frame_transcript(b"") == b"data: [DONE]\n\n"
+
+# --- 通过代理接口的测试 ---
+
+@contextmanager
+def running_app(handler):
+    """用临时数据库、模拟的上游和开启的响应缓存运行整个应用。"""
+    use_temp_db()
+    build_client = http_client.UpstreamHTTPClient._build_client
+    http_client.UpstreamHTTPClient._build_client = lambda self: httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    saved = (response_cache.enabled, response_cache._sqlite, dict(response_cache._entries), response_cache._bytes)
+    response_cache.enabled, response_cache._sqlite = True, False
+    response_cache._entries.clear()
+    response_cache._bytes = 0
+    import main
+    try:
+        with TestClient(main.app) as client:
+            client.post('/admin/keys', data={"key_name": "k1", "api_key": "sk-1", "daily_limit": -1}, headers=H)
+            deadline = time.time() + 5
+            while client.get('/v1/models', headers=H).json().get("data") == [] and time.time() < deadline:
+                time.sleep(0.05)
+            yield client
+    finally:
+        http_client.UpstreamHTTPClient._build_client = build_client
+        response_cache.enabled, response_cache._sqlite, entries, response_cache._bytes = saved
+        response_cache._entries.clear()
+        response_cache._entries.update(entries)
+
+def upstream(calls):
+    def handler(request: httpx.Request):
+        if request.url.path.endswith('/models'):
+            return httpx.Response(200, json={"data": [{"id": MODEL, "name": "Bar", "context_length": 8192}]})
+        calls.append(json.loads(request.content))
+        if calls[-1].get("stream"):
+            chunks = [SSE_BODY[i:i + 11] for i in range(0, len(SSE_BODY), 11)]
+
+            async def stream():
+                for chunk in chunks:
+                    yield chunk
+            return httpx.Response(200, content=stream(), headers={"content-type": "text/event-stream"})
+        return httpx.Response(200, json={"choices": [{"message": {"content": "hi"}}], "usage": USAGE})
+    return handler
+
+def test_hit_is_recorded_as_203_without_key():
+    calls = []
+    with running_app(upstream(calls)) as client:
+        request = {"model": MODEL, "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}
+        first = client.post('/v1/chat/completions', json=request, headers=H)
+        second = client.post('/v1/chat/completions', json=request, headers=H)
+        bypass = client.post('/v1/chat/completions', json=request, headers={**H, "X-Cache-Bypass": "1"})
+        assert (first.headers["x-cache"], second.headers["x-cache"], bypass.headers["x-cache"]) == ("MISS", "HIT", "BYPASS")
+        assert second.content == first.content
+        # 代理注入的max_tokens不影响缓存键；绕过缓存的请求发往上游
+        assert len(calls) == 2 and "max_tokens" in calls[0]
+
+    rows = crud.get_usage_logs(page=1, page_size=50)["logs"]
+    statuses = sorted((row["response_status"], row["key_name"]) for row in rows)
+    assert statuses == [(200, "k1"), (200, "k1"), (CACHE_HIT_STATUS, None)]
+    hit = next(row for row in rows if row["response_status"] == CACHE_HIT_STATUS)
+    assert hit["total_tokens"] == USAGE["total_tokens"]
+
+def test_stream_is_recorded_and_replayed():
+    calls = []
+    with running_app(upstream(calls)) as client:
+        request = {"model": MODEL, "temperature": 0, "stream": True, "messages": [{"role": "user", "content": "hi"}]}
+        first = client.post('/v1/chat/completions', json=request, headers=H)
+        assert first.headers["x-cache"] == "MISS" and first.content == SSE_BODY
+        assert all(key.startswith("sse:") for key in response_cache._entries)
+        second = client.post('/v1/chat/completions', json=request, headers=H)
+        assert second.headers["x-cache"] == "HIT"
+        assert second.headers["content-type"].startswith("text/event-stream")
+        assert second.content == first.content
+        assert len(calls) == 1
+        # 非流式的同一个请求使用不同的缓存键
+        plain = client.post('/v1/chat/completions', json={**request, "stream": False}, headers=H)
+        assert plain.headers["x-cache"] == "MISS" and len(calls) == 2
+
+if __name__ == "__main__":
+    test_cache_key_only_for_deterministic_requests()
+    test_cache_key_ignores_stream_options_and_marks_streams()
+    test_disabled_cache_has_no_keys()
+    test_ttl_expiry()
+    test_lru_eviction_by_entry_count()
+    test_lru_eviction_by_bytes_and_entry_size_limit()
+    test_bypass_header()
+    test_sqlite_round_trip()
+    test_stream_transcript_replays_byte_for_byte()
+    test_stream_transcript_not_kept_when_incomplete_or_too_large()
+    test_hit_is_recorded_as_203_without_key()
+    test_stream_is_recorded_and_replayed()
+    print("✅ 全部通过")
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+使用记录保留策略的测试：按天导出gzip压缩的JSON Lines分片后删除、重复执行不重复归档，
+在写入分片之后、删除之前中断的执行重新运行时不产生重复记录，以及incremental_vacuum按配置的页数分批执行。
+
+使用临时数据库和临时归档目录，不需要网络，直接运行或使用pytest:
+    python test_retention.py
+    python -m pytest -q test_retention.py
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import app.database as database
+from app import async_crud, crud
+from app.services import retention
+from app.services.retention import RetentionManager
+from config import config
+
+OLD_DAYS = ("2020-01-01", "2020-01-02")
+
+@contextmanager
+def temp_storage():
+    """切换到临时数据库和临时归档目录。"""
+    directory = tempfile.mkdtemp()
+    database.DATABASE_URL = os.path.join(directory, "test.db")
+    database.init_db()
+    section = config._config.setdefault("retention", {})
+    saved = section.get("archive_dir")
+    section["archive_dir"] = os.path.join(directory, "archive")
+    try:
+        yield
+    finally:
+        section["archive_dir"] = saved
+
+def insert(day: str, count: int, model: str = "m") -> None:
+    crud.write_usage_batch(
+        [(None, model, i, 0, i, 0.0, 200, f"{day} 00:00:{i % 60:02d}", None) for i in range(count)], [],
+    )
+
+def make_manager(batch_size: int = 3, vacuum_pages: int = 1000) -> RetentionManager:
+    manager = RetentionManager()
+    manager._retention_days = 30
+    manager._batch_size = batch_size
+    manager._batch_pause = 0
+    manager._vacuum_pages = vacuum_pages
+    return manager
+
+def archived_ids(day: str) -> list:
+    """返回某一天所有分片中的记录id，按分片顺序。"""
+    ids = []
+    for _, _, path in retention._list_parts(day):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            ids.extend(json.loads(line)["id"] for line in f)
+    return ids
+
+def log_ids(day: str) -> list:
+    with database.get_db_connection() as conn:
+        return [row[0] for row in conn.execute(
+            "SELECT id FROM usage_logs WHERE request_time >= ? AND request_time < ? ORDER BY id", (f"{day} 00:00:00", f"{day} 99")
+        )]
+
+def test_archive_then_delete_is_idempotent():
+    with temp_storage():
+        for day in OLD_DAYS:
+            insert(day, 7)
+        today = crud.utc_now_str()[:10]
+        insert(today, 2)
+        expected = {day: log_ids(day) for day in OLD_DAYS}
+
+        manager = make_manager()
+        progress = asyncio.run(manager.run_once())
+        assert progress["phase"] == "idle" and progress["days_done"] == 2
+        assert progress["rows_archived"] == 14 and progress["rows_deleted"] == 14
+        for day in OLD_DAYS:
+            assert archived_ids(day) == expected[day]
+            assert log_ids(day) == []
+        # 保留期内的记录不受影响，汇总表保留归档前的统计
+        assert len(log_ids(today)) == 2
+        assert crud.get_model_stats()[0]["usage_count"] == 16
+
+        # 再次执行不产生新的分片
+        parts = {day: retention._list_parts(day) for day in OLD_DAYS}
+        progress = asyncio.run(manager.run_once())
+        assert progress["days_done"] == 0 and progress["rows_archived"] == 0
+        assert {day: retention._list_parts(day) for day in OLD_DAYS} == parts
+        assert [p["date"] for p in retention.list_partitions()] == list(OLD_DAYS)
+
+def test_rerun_after_crash_between_export_and_delete():
+    with temp_storage():
+        insert(OLD_DAYS[0], 10)
+        expected = log_ids(OLD_DAYS[0])
+        delete_batch = async_crud.delete_usage_logs_batch
+        calls = []
+
+        async def crash_after_first_batch(day, max_id, limit):
+            # 第一批删除成功，第二批之前进程中断
+            if calls:
+                raise RuntimeError("进程被终止")
+            calls.append(day)
+            return await delete_batch(day, max_id, limit)
+
+        manager = make_manager(batch_size=4)
+        async_crud.delete_usage_logs_batch = crash_after_first_batch
+        try:
+            progress = asyncio.run(manager.run_once())
+        finally:
+            async_crud.delete_usage_logs_batch = delete_batch
+        assert progress["phase"] == "failed"
+        assert archived_ids(OLD_DAYS[0]) == expected
+        assert len(log_ids(OLD_DAYS[0])) == 6
+
+        # 中断后写入的同一天的记录（例如延迟写入）进入新的分片
+        insert(OLD_DAYS[0], 2)
+        late = log_ids(OLD_DAYS[0])[-2:]
+        progress = asyncio.run(manager.run_once())
+        assert progress["phase"] == "idle"
+        assert progress["rows_archived"] == 2 and progress["rows_deleted"] == 8
+        assert log_ids(OLD_DAYS[0]) == []
+        parts = retention._list_parts(OLD_DAYS[0])
+        assert len(parts) == 2
+        # 每条记录恰好归档一次
+        assert archived_ids(OLD_DAYS[0]) == expected + late
+
+def test_failed_export_leaves_no_partial_part():
+    with temp_storage():
+        insert(OLD_DAYS[0], 5)
+        fetch = crud.fetch_usage_logs_for_archive
+
+        def fail_on_second_batch(day, after_id, limit):
+            if after_id:
+                raise OSError("磁盘已满")
+            return fetch(day, after_id, limit)
+
+        crud.fetch_usage_logs_for_archive = fail_on_second_batch
+        try:
+            progress = asyncio.run(make_manager().run_once())
+        finally:
+            crud.fetch_usage_logs_for_archive = fetch
+        assert progress["phase"] == "failed" and progress["rows_deleted"] == 0
+        assert retention._list_parts(OLD_DAYS[0]) == []
+        assert os.listdir(retention._partition_dir(OLD_DAYS[0])) == []
+        assert len(log_ids(OLD_DAYS[0])) == 5
+
+def test_incremental_vacuum_runs_in_page_batches():
+    with temp_storage():
+        assert crud.get_vacuum_status()["auto_vacuum"] == "incremental"
+        # 较大的记录占用足够多的页
+        insert(OLD_DAYS[0], 300, model="x" * 2000)
+        vacuum = async_crud.incremental_vacuum
+        batches = []
+
+        async def record_batches(pages):
+            freed = await vacuum(pages)
+            batches.append((pages, freed))
+            return freed
+
+        async_crud.incremental_vacuum = record_batches
+        try:
+            progress = asyncio.run(make_manager(batch_size=100, vacuum_pages=20).run_once())
+        finally:
+            async_crud.incremental_vacuum = vacuum
+        assert progress["phase"] == "idle"
+        assert len(batches) > 2
+        assert all(pages == 20 for pages, _ in batches)
+        # 每批释放配置的页数，最后一批不足时结束
+        assert all(freed == 20 for _, freed in batches[:-1]) and batches[-1][1] < 20
+        assert progress["pages_freed"] == sum(freed for _, freed in batches)
+        assert crud.get_vacuum_status()["freelist_count"] == 0
+
+if __name__ == "__main__":
+    test_archive_then_delete_is_idempotent()
+    test_rerun_after_crash_between_export_and_delete()
+    test_failed_export_leaves_no_partial_part()
+    test_incremental_vacuum_runs_in_page_batches()
+    print("✅ 全部通过")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+SSE解析器的测试：任意切分的字节块、跨块的多字节UTF-8字符、\r\n换行、缺少 [DONE] 的流和很长的未结束data行。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_sse.py
+    python -m pytest -q test_sse.py
+"""
+
+import json
+import random
+import time
+
+from app.services.sse import SSEUsageParser
+
+TEXT = "你好，世界！Hello 🚀 ünïcödé "
+USAGE = {"prompt_tokens": 12, "completion_tokens": 40, "total_tokens": 52}
+
+def build_stream(events: int = 40, newline: bytes = b"\n", done: bool = True):
+    """生成一段类似OpenRouter的SSE响应，返回 (字节流, 期望的内容)。"""
+    frames = [b": OPENROUTER PROCESSING" + newline + newline]
+    pieces = []
+    for i in range(events):
+        piece = TEXT[i % len(TEXT):][:5]
+        pieces.append(piece)
+        event = {"id": "gen-1", "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+        frames.append(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + newline + newline)
+    frames.append(b"data: " + json.dumps({"id": "gen-1", "choices": [], "usage": USAGE}).encode("utf-8") + newline + newline)
+    if done:
+        frames.append(b"data: [DONE]" + newline + newline)
+    return b"".join(frames), "".join(pieces)
+
+def split_randomly(data: bytes, rng: random.Random, max_size: int = 64):
+    chunks, pos = [], 0
+    while pos < len(data):
+        size = rng.randint(1, max_size)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+def parse(chunks, record_limit: int = 0) -> SSEUsageParser:
+    parser = SSEUsageParser(record_limit)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return parser
+
+def test_random_splits():
+    rng = random.Random(0)
+    for newline in (b"\n", b"\r\n"):
+        data, content = build_stream(newline=newline)
+        for _ in range(50):
+            parser = parse(split_randomly(data, rng))
+            assert parser.usage == USAGE
+            assert parser.content == content
+            assert parser.done
+
+def test_multibyte_characters_split_across_chunks():
+    data, content = build_stream()
+    # 每个字节单独一块，所有多字节字符都被切开
+    parser = parse([data[i:i + 1] for i in range(len(data))])
+    assert parser.content == content
+    assert parser.usage == USAGE
+
+def test_missing_done():
+    data, content = build_stream(done=False)
+    parser = parse(split_randomly(data, random.Random(1)), record_limit=1 << 20)
+    assert parser.content == content
+    assert parser.usage == USAGE
+    assert not parser.done
+    # 没有完整结束的流不能被缓存
+    assert parser.transcript is None
+
+def test_last_event_without_trailing_newline():
+    parser = parse([b'data: {"choices":[],"usage":{"total_tokens":3}}'])
+    assert parser.usage == {"total_tokens": 3}
+
+def test_long_unterminated_line_is_linear():
+    content = "x" * 4_000_000
+    event = b"data: " + json.dumps({"choices": [{"delta": {"content": content}}]}).encode() + b"\n\n"
+    chunks = [event[i:i + 1024] for i in range(0, len(event), 1024)]
+    started = time.perf_counter()
+    parser = parse(chunks)
+    elapsed = time.perf_counter() - started
+    assert parser.content == content
+    # 每块都复制整个缓冲区时需要数十秒
+    assert elapsed < 2.0, elapsed
+
+if __name__ == "__main__":
+    test_random_splits()
+    test_multibyte_characters_split_across_chunks()
+    test_missing_done()
+    test_last_event_without_trailing_newline()
+    test_long_unterminated_line_is_linear()
+    print("✅ 全部通过")
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+负载均衡策略的测试：weighted_quota的树状数组按剩余额度加权、移出后放回、无限额Key的权重和额度耗尽的Key；
+least_used的带版本号最小堆；p2c_latency按延迟和并发数比较。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_strategies.py
+    python -m pytest -q test_strategies.py
+"""
+
+import random
+from datetime import date
+
+from app.services import key_manager as key_manager_module
+from app.services.key_manager import (
+    _KeyState, WeightedQuotaStrategy, LeastUsedStrategy, PowerOfTwoLatencyStrategy,
+)
+
+TODAY = date(2026, 1, 2)
+
+def make_state(key_id: int, daily_limit: int = -1, daily_usage: int = 0, usage_count: int = 0) -> _KeyState:
+    state = _KeyState({
+        "id": key_id, "key_name": f"k{key_id}", "api_key": f"sk-{key_id}", "daily_limit": daily_limit,
+        "daily_usage": daily_usage, "usage_count": usage_count, "last_reset_time": None, "last_used": None,
+    })
+    state.reset_day = TODAY
+    return state
+
+def weighted(*states: _KeyState, unlimited_weight: int = 1000) -> WeightedQuotaStrategy:
+    strategy = WeightedQuotaStrategy()
+    strategy._unlimited_weight = unlimited_weight
+    strategy.today = TODAY
+    strategy.rebuild(states)
+    return strategy
+
+def distribution(strategy: WeightedQuotaStrategy) -> dict:
+    """对每个可能的随机数挑选一次，返回每个Key被选中的次数，即它在树状数组中的权重。"""
+    total = strategy._prefix(len(strategy._slots))
+    counts = {}
+    randrange = key_manager_module.random.randrange
+    try:
+        for r in range(total):
+            key_manager_module.random.randrange = lambda n, r=r: r
+            state = strategy.select()
+            counts[state.id] = counts.get(state.id, 0) + 1
+    finally:
+        key_manager_module.random.randrange = randrange
+    return counts
+
+# --- weighted_quota ---
+
+def test_weighted_quota_follows_remaining_quota():
+    a, b, c = make_state(1, 100), make_state(2, 300, 100), make_state(3, 50, 20)
+    strategy = weighted(a, b, c)
+    assert distribution(strategy) == {1: 100, 2: 200, 3: 30}
+
+    # 使用量变化后只更新这个Key的权重
+    b.daily_usage = 250
+    strategy.on_change(b)
+    assert distribution(strategy) == {1: 100, 2: 50, 3: 30}
+
+    # 随机挑选的比例接近权重
+    random.seed(0)
+    counts = {}
+    for _ in range(18000):
+        key_id = strategy.select().id
+        counts[key_id] = counts.get(key_id, 0) + 1
+    for key_id, weight in ((1, 100), (2, 50), (3, 30)):
+        assert abs(counts[key_id] / 18000 - weight / 180) < 0.02, counts
+
+def test_weighted_quota_remove_then_add():
+    a, b, c = make_state(1, 10), make_state(2, 20), make_state(3, 30)
+    strategy = weighted(a, b, c)
+    strategy.remove(b)
+    assert distribution(strategy) == {1: 10, 3: 30}
+    # 被移出的Key在使用量变化时不会恢复权重
+    b.daily_usage = 5
+    strategy.on_change(b)
+    assert distribution(strategy) == {1: 10, 3: 30}
+    strategy.add(b)
+    assert distribution(strategy) == {1: 10, 2: 15, 3: 30}
+
+    # 不在槽位中的新Key加入后同样按权重挑选，移出的Key保持移出
+    strategy.remove(a)
+    strategy.add(make_state(4, 5))
+    assert distribution(strategy) == {2: 15, 3: 30, 4: 5}
+    # 跨天重新计算权重时，移出的Key仍然不会被选中
+    strategy.on_new_day()
+    assert 1 not in distribution(strategy)
+
+def test_weighted_quota_unlimited_key_weight():
+    strategy = weighted(make_state(1), make_state(2, 100), unlimited_weight=300)
+    assert distribution(strategy) == {1: 300, 2: 100}
+    # 无限额的Key使用量增加，权重不变
+    unlimited = strategy._slots[0]
+    unlimited.daily_usage = 10 ** 6
+    strategy.on_change(unlimited)
+    assert distribution(strategy) == {1: 300, 2: 100}
+
+def test_weighted_quota_excludes_exhausted_keys():
+    a, b = make_state(1, 10, 10), make_state(2, 10, 3)
+    strategy = weighted(a, b)
+    assert distribution(strategy) == {2: 7}
+    b.daily_usage = 10
+    strategy.on_change(b)
+    assert strategy.select() is None
+    # 跨天后额度恢复
+    strategy.today = date(2026, 1, 3)
+    strategy.on_new_day()
+    assert distribution(strategy) == {1: 10, 2: 10}
+
+# --- least_used ---
+
+def test_least_used_picks_lowest_usage_and_follows_changes():
+    states = [make_state(1, usage_count=5), make_state(2, usage_count=2), make_state(3, usage_count=9)]
+    strategy = LeastUsedStrategy()
+    strategy.today = TODAY
+    strategy.rebuild(states)
+    picked = []
+    for _ in range(6):
+        state = strategy.select()
+        picked.append(state.id)
+        state.usage_count += 1
+        strategy.on_change(state)
+    # 2先追上1，之后两者轮流
+    assert picked == [2, 2, 2, 1, 2, 1]
+
+def test_least_used_breaks_ties_by_remaining_quota():
+    states = [make_state(1, 100, 90), make_state(2, 100, 10), make_state(3, 100, 50)]
+    strategy = LeastUsedStrategy()
+    strategy.today = TODAY
+    strategy.rebuild(states)
+    assert strategy.select().id == 2
+
+def test_least_used_remove_and_stale_entries():
+    a, b = make_state(1, usage_count=0), make_state(2, usage_count=10)
+    strategy = LeastUsedStrategy()
+    strategy.today = TODAY
+    strategy.rebuild([a, b])
+    strategy.remove(a)
+    assert strategy.select() is b
+    # 移出的Key的使用量变化不会让它回到堆中
+    a.usage_count = 1
+    strategy.on_change(a)
+    assert strategy.select() is b
+    strategy.add(a)
+    assert strategy.select() is a
+    strategy.remove(a)
+    strategy.remove(b)
+    assert strategy.select() is None
+
+def test_least_used_heap_stays_bounded():
+    states = [make_state(i) for i in range(1, 4)]
+    strategy = LeastUsedStrategy()
+    strategy.today = TODAY
+    strategy.rebuild(states)
+    for i in range(1000):
+        state = states[i % 3]
+        state.usage_count += 1
+        strategy.on_change(state)
+    assert len(strategy._heap) <= 2 * len(states) + 65
+    assert strategy.select().usage_count == min(s.usage_count for s in states)
+
+# --- p2c_latency ---
+
+def latency_strategy(*states: _KeyState) -> PowerOfTwoLatencyStrategy:
+    strategy = PowerOfTwoLatencyStrategy()
+    strategy.rebuild(states)
+    return strategy
+
+def test_p2c_prefers_lower_latency_times_inflight():
+    fast, slow = make_state(1), make_state(2)
+    fast.latency_ewma, slow.latency_ewma = 0.2, 1.0
+    strategy = latency_strategy(fast, slow)
+    assert all(strategy.select() is fast for _ in range(20))
+    # 并发数放大延迟：0.2 * 6 > 1.0 * 1
+    fast.inflight = 5
+    assert all(strategy.select() is slow for _ in range(20))
+
+def test_p2c_never_picks_the_worst_key_and_probes_new_keys():
+    random.seed(1)
+    states = [make_state(i) for i in range(1, 6)]
+    for i, state in enumerate(states):
+        state.latency_ewma = 0.1 * (i + 1)
+    strategy = latency_strategy(*states)
+    picked = {strategy.select().id for _ in range(500)}
+    assert 5 not in picked and 1 in picked
+
+    # 还没有延迟数据的Key视为延迟为0
+    fresh = make_state(6)
+    strategy.add(fresh)
+    assert sum(strategy.select() is fresh for _ in range(500)) > 100
+
+def test_p2c_single_and_empty():
+    only = make_state(1)
+    strategy = latency_strategy(only)
+    assert strategy.select() is only
+    strategy.remove(only)
+    assert strategy.select() is None
+
+if __name__ == "__main__":
+    test_weighted_quota_follows_remaining_quota()
+    test_weighted_quota_remove_then_add()
+    test_weighted_quota_unlimited_key_weight()
+    test_weighted_quota_excludes_exhausted_keys()
+    test_least_used_picks_lowest_usage_and_follows_changes()
+    test_least_used_breaks_ties_by_remaining_quota()
+    test_least_used_remove_and_stale_entries()
+    test_least_used_heap_stays_bounded()
+    test_p2c_prefers_lower_latency_times_inflight()
+    test_p2c_never_picks_the_worst_key_and_probes_new_keys()
+    test_p2c_single_and_empty()
+    print("✅ 全部通过")
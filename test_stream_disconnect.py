@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+流式响应的回归测试：客户端在响应开始之前断开时，准入名额和Key的并发计数必须归还。
+
+不需要数据库和网络，直接运行或使用pytest:
+    python test_stream_disconnect.py
+    python -m pytest -q test_stream_disconnect.py
+"""
+
+import asyncio
+
+from app.routers.proxy import ChatStreamResponse, SSE_HEADERS
+from app.services.admission import admission_controller
+from app.services.key_manager import key_manager
+from app.services.openrouter_client import openrouter_client
+from app.services.token_accounting import PromptCount
+
+MODEL = "foo/bar:free"
+
+async def disconnect_before_first_byte():
+    key_manager._rebuild([{
+        "id": 1, "key_name": "k1", "api_key": "sk-1", "daily_limit": -1, "daily_usage": 0,
+        "usage_count": 0, "last_reset_time": None, "last_used": None,
+    }])
+    ticket = await admission_controller.admit(MODEL)
+    api_key_info = key_manager.get_next_key(model=MODEL)
+    assert admission_controller.stats()["inflight"] == 1
+    assert key_manager.pool_stats()["inflight"] == 1
+
+    body = {"model": MODEL, "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    response = ChatStreamResponse(
+        openrouter_client.stream_chat_completions(body, api_key_info, MODEL, PromptCount([], 0, True), ticket),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        # 连接已经断开，发送永远不会完成
+        await asyncio.sleep(3600)
+
+    scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "method": "POST", "path": "/v1/chat/completions", "headers": []}
+    await asyncio.wait_for(response(scope, receive, send), timeout=5)
+
+    assert admission_controller.stats()["inflight"] == 0
+    assert key_manager.pool_stats()["inflight"] == 0
+
+def test_disconnect_before_first_byte_releases_ticket_and_key():
+    asyncio.run(disconnect_before_first_byte())
+
+if __name__ == "__main__":
+    test_disconnect_before_first_byte_releases_ticket_and_key()
+    print("✅ 全部通过")
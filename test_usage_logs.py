@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+调用记录游标分页的测试：游标的编码和解析、格式错误的游标、request_time相同的记录翻页不重复不遗漏、
+翻页期间新增的记录，缓存的总数在插入之后过期并在后台刷新，以及从汇总表读取的筛选选项。
+
+使用临时数据库，不需要网络，直接运行或使用pytest:
+    python test_usage_logs.py
+    python -m pytest -q test_usage_logs.py
+"""
+
+import asyncio
+import base64
+import json
+import os
+import tempfile
+
+import app.database as database
+from app import crud
+from app.services.log_count_cache import UsageLogCountCache
+
+def use_temp_db() -> None:
+    database.DATABASE_URL = os.path.join(tempfile.mkdtemp(), "test.db")
+    database.init_db()
+
+def insert(request_times, model: str = "m") -> None:
+    """按顺序插入记录，prompt_tokens为记录的序号，用来在结果中识别记录。"""
+    start = crud.count_usage_logs()
+    crud.write_usage_batch(
+        [(None, model, start + i, 0, 0, 0.0, 200, request_time, None) for i, request_time in enumerate(request_times)],
+        [],
+    )
+
+def read_all(page_size: int, **filters) -> list:
+    """按游标读完所有页，返回记录序号。"""
+    seen, cursor = [], None
+    while True:
+        page = crud.get_usage_logs(1, page_size, cursor, **filters)
+        assert len(page["logs"]) <= page_size
+        seen.extend(log["prompt_tokens"] for log in page["logs"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return seen
+
+def test_cursor_round_trip():
+    for request_time, log_id in (("2026-01-02 03:04:05", 1), ("2026-12-31 23:59:59", 2 ** 40), ("", 0)):
+        token = crud.encode_log_cursor(request_time, log_id)
+        # URL安全，不带填充
+        assert "=" not in token and "+" not in token and "/" not in token
+        assert crud.decode_log_cursor(token) == (request_time, log_id)
+
+def test_malformed_cursors_are_rejected():
+    def encoded(value) -> str:
+        return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip("=")
+
+    for token in ("", "!!!", "游标", "bm90IGpzb24", encoded({"t": 1}), encoded(["t"]), encoded(["t", 1, 2]),
+                  encoded([1, "t"]), encoded(["t", "1"]), encoded(["t", 1.5]), encoded([None, 1])):
+        try:
+            crud.decode_log_cursor(token)
+        except ValueError:
+            continue
+        raise AssertionError(f"应该拒绝游标: {token!r}")
+
+    use_temp_db()
+    try:
+        crud.get_usage_logs(1, 10, "!!!")
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("格式错误的游标应该引发ValueError")
+
+def test_ties_on_request_time_are_paged_by_id():
+    use_temp_db()
+    insert(["2026-01-01 00:00:01"] * 3 + ["2026-01-01 00:00:02"] * 5 + ["2026-01-01 00:00:00"] * 2)
+    # 按 (request_time, id) 倒序：同一秒内后插入的记录在前
+    expected = [7, 6, 5, 4, 3, 2, 1, 0, 9, 8]
+    for page_size in (1, 2, 3, 4, 10, 11):
+        assert read_all(page_size) == expected, page_size
+    # 游标和页码分页的结果一致
+    by_page = []
+    for page in range(1, 5):
+        by_page.extend(log["prompt_tokens"] for log in crud.get_usage_logs(page, 3)["logs"])
+    assert by_page == expected
+
+def test_cursor_is_stable_while_rows_are_inserted():
+    use_temp_db()
+    insert(["2026-01-01 00:00:01"] * 6)
+    first = crud.get_usage_logs(1, 3)
+    assert [log["prompt_tokens"] for log in first["logs"]] == [5, 4, 3]
+    # 翻页期间写入的新记录（同一秒和更晚）不会出现在后面的页中，也不会让记录重复
+    insert(["2026-01-01 00:00:01", "2026-01-01 00:00:09"])
+    second = crud.get_usage_logs(1, 3, first["next_cursor"])
+    assert [log["prompt_tokens"] for log in second["logs"]] == [2, 1, 0]
+    assert second["next_cursor"] is None
+
+def test_cursor_with_filters():
+    use_temp_db()
+    insert(["2026-01-01 00:00:01"] * 4, model="a")
+    insert(["2026-01-01 00:00:01"] * 3, model="b")
+    insert(["2026-01-02 00:00:01"] * 2, model="a")
+    assert read_all(2, model_filter="a") == [8, 7, 3, 2, 1, 0]
+    assert read_all(2, model_filter="a", date_filter="2026-01-01") == [3, 2, 1, 0]
+
+def test_cached_total_goes_stale_and_refreshes():
+    use_temp_db()
+    insert(["2026-01-01 00:00:01"] * 3)
+
+    async def run():
+        counts = UsageLogCountCache()
+        counts._ttl = 30
+        assert (await counts.get(model_filter="m"))["total"] == 3
+        insert(["2026-01-01 00:00:02"] * 2)
+        # 有效期内返回缓存的总数
+        cached = await counts.get(model_filter="m")
+        assert cached["total"] == 3 and cached["age"] < 30
+        # 不同的筛选条件分别计数
+        assert (await counts.get())["total"] == 5
+
+        # 过期后仍然先返回旧的总数，同时在后台重新计算
+        key = counts._cache_key({"model_filter": "m"})
+        total, computed_at = counts._counts[key]
+        counts._counts[key] = (total, computed_at - 31)
+        stale = await counts.get(model_filter="m")
+        assert stale["total"] == 3 and stale["age"] > 30
+        refresh = counts._refreshing[key]
+        # 刷新进行中不会重复创建任务
+        await counts.get(model_filter="m")
+        assert counts._refreshing.get(key) is refresh
+        await refresh
+        fresh = await counts.get(model_filter="m")
+        assert fresh["total"] == 5 and fresh["age"] < 1
+
+        insert(["2026-01-01 00:00:03"])
+        counts.invalidate()
+        assert (await counts.get(model_filter="m"))["total"] == 6
+    asyncio.run(run())
+
+def test_filter_options_from_rollups():
+    use_temp_db()
+    crud.add_api_key("k2", "sk-2", -1)
+    crud.add_api_key("k1", "sk-1", -1)
+    insert(["2026-01-01 00:00:01"] * 2, model="b")
+    insert(["2026-01-02 00:00:01"], model="a")
+    crud.write_usage_batch([(None, None, 0, 0, 0, 0.0, 500, "2026-01-02 00:00:02", None)], [])
+    # 已归档（从usage_logs删除）的记录中的模型仍然可以筛选
+    with database.get_db_connection() as conn:
+        conn.execute("DELETE FROM usage_logs WHERE model = 'b'")
+        conn.commit()
+    options = crud.get_filter_options()
+    assert [key["key_name"] for key in options["keys"]] == ["k1", "k2"]
+    assert options["models"] == ["a", "b"]
+
+if __name__ == "__main__":
+    test_cursor_round_trip()
+    test_malformed_cursors_are_rejected()
+    test_ties_on_request_time_are_paged_by_id()
+    test_cursor_is_stable_while_rows_are_inserted()
+    test_cursor_with_filters()
+    test_cached_total_goes_stale_and_refreshes()
+    test_filter_options_from_rollups()
+    print("✅ 全部通过")
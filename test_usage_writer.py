@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+使用记录后台写入的测试：按批量大小和时间间隔写入、汇总表的更新、写入失败后的重试、队列已满时的溢出列表，以及后台任务未启动时的写入。
+
+使用临时数据库，不需要网络，直接运行或使用pytest:
+    python test_usage_writer.py
+    python -m pytest -q test_usage_writer.py
+"""
+
+import asyncio
+import os
+import tempfile
+
+import app.database as database
+from app import async_crud, crud
+from app.services.usage_writer import UsageWriter
+
+def use_temp_db() -> int:
+    """切换到临时数据库并添加一个Key，返回它的id。"""
+    database.DATABASE_URL = os.path.join(tempfile.mkdtemp(), "test.db")
+    database.init_db()
+    crud.add_api_key("k1", "sk-1", -1)
+    return crud.load_active_api_keys()[0]["id"]
+
+def make_writer(batch_size=200, flush_interval=60.0, overflow_size=100000) -> UsageWriter:
+    writer = UsageWriter()
+    writer._batch_size = batch_size
+    writer._flush_interval = flush_interval
+    writer._overflow_size = overflow_size
+    return writer
+
+async def start(writer: UsageWriter, queue_size: int = 10000) -> None:
+    await writer.start()
+    writer._queue = asyncio.Queue(maxsize=queue_size)
+
+def query(sql: str, params=()):
+    with database.get_db_connection() as conn:
+        return [tuple(row) for row in conn.execute(sql, params).fetchall()]
+
+def count_logs() -> int:
+    return query("SELECT COUNT(*) FROM usage_logs")[0][0]
+
+def log(writer: UsageWriter, key_id, model="m", status=200, tokens=(3, 1)) -> None:
+    writer.log_usage(key_id, model, tokens[0], tokens[1], sum(tokens), 0.0, status)
+
+async def wait_for(condition, timeout: float = 2.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "等待超时"
+        await asyncio.sleep(0.01)
+
+def test_flush_when_batch_size_reached():
+    key_id = use_temp_db()
+
+    async def run():
+        writer = make_writer(batch_size=5)
+        await start(writer)
+        for _ in range(4):
+            log(writer, key_id)
+        await asyncio.sleep(0.05)
+        # 没有达到批量大小，时间间隔也没到
+        assert count_logs() == 0 and writer.stats()["queue_depth"] == 4
+        log(writer, key_id)
+        await wait_for(lambda: writer.stats()["rows_written"] == 5)
+        assert count_logs() == 5 and writer.stats()["flushes"] == 1
+        await writer.stop()
+    asyncio.run(run())
+
+def test_flush_on_interval():
+    key_id = use_temp_db()
+
+    async def run():
+        writer = make_writer(batch_size=1000, flush_interval=0.05)
+        await start(writer)
+        log(writer, key_id)
+        writer.record_key_usage(key_id, 1, 1, crud.utc_now_str(), None)
+        await wait_for(lambda: writer.stats()["rows_written"] == 1)
+        assert count_logs() == 1
+        assert query("SELECT usage_count, daily_usage FROM api_keys WHERE id = ?", (key_id,)) == [(1, 1)]
+        await writer.stop()
+    asyncio.run(run())
+
+def test_rollups_are_updated_with_the_batch():
+    key_id = use_temp_db()
+
+    async def run():
+        writer = make_writer()
+        await start(writer)
+        log(writer, key_id, tokens=(3, 1))
+        log(writer, key_id, tokens=(5, 2))
+        log(writer, key_id, status=429, tokens=(0, 0))
+        log(writer, None, model="other", status=203, tokens=(1, 1))
+        await writer.stop()
+    asyncio.run(run())
+
+    for table in ("usage_rollup_hourly", "usage_rollup_daily"):
+        rows = query(f"SELECT api_key_id, model, status_class, request_count, prompt_tokens, completion_tokens, total_tokens FROM {table} ORDER BY model, status_class")
+        # 没有Key的记录汇总到api_key_id=0
+        assert rows == [(key_id, "m", 2, 2, 8, 3, 11), (key_id, "m", 4, 1, 0, 0, 0), (0, "other", 2, 1, 1, 1, 2)], (table, rows)
+    day = query("SELECT bucket FROM usage_rollup_daily LIMIT 1")[0][0]
+    hour = query("SELECT bucket FROM usage_rollup_hourly LIMIT 1")[0][0]
+    assert len(day) == 10 and hour.startswith(day) and hour.endswith(":00:00")
+
+def test_failed_write_is_retried():
+    key_id = use_temp_db()
+    write_usage_batch = async_crud.write_usage_batch
+    failures = [RuntimeError("database is locked")]
+
+    async def flaky(rows, key_updates):
+        if failures:
+            raise failures.pop()
+        await write_usage_batch(rows, key_updates)
+
+    async def run():
+        writer = make_writer()
+        await start(writer)
+        log(writer, key_id)
+        writer.record_key_usage(key_id, 1, 1, None, None)
+        await writer.flush()
+        assert writer.stats()["errors"] == 1 and count_logs() == 0
+        # 失败之后产生的Key计数和失败的增量合并
+        writer.record_key_usage(key_id, 2, 3, None, None)
+        log(writer, key_id)
+        await writer.flush()
+        assert count_logs() == 2
+        assert query("SELECT usage_count, daily_usage FROM api_keys WHERE id = ?", (key_id,)) == [(3, 3)]
+        await writer.stop()
+
+    async_crud.write_usage_batch = flaky
+    try:
+        asyncio.run(run())
+    finally:
+        async_crud.write_usage_batch = write_usage_batch
+
+def test_full_queue_spills_to_overflow():
+    key_id = use_temp_db()
+
+    async def run():
+        writer = make_writer(batch_size=2, overflow_size=3)
+        await start(writer, queue_size=2)
+        # 后台任务还没有机会运行，队列和溢出列表同时被填满
+        for _ in range(6):
+            log(writer, key_id)
+        stats = writer.stats()
+        assert stats["queue_depth"] == 2 and stats["overflow_depth"] == 3
+        assert stats["spilled"] == 3 and stats["dropped"] == 1
+        await wait_for(lambda: writer.stats()["rows_written"] == 5)
+        assert writer.stats()["overflow_depth"] == 0 and count_logs() == 5
+        await writer.stop()
+    asyncio.run(run())
+
+def test_unstarted_writer_does_not_block_the_event_loop():
+    key_id = use_temp_db()
+    write_usage_batch = crud.write_usage_batch
+
+    def sync_write(rows, key_updates):
+        raise AssertionError("不能在事件循环中同步写入")
+
+    async def run():
+        writer = make_writer()
+        log(writer, key_id)
+        assert len(writer._pending) == 1
+        await writer.stop()
+        assert not writer._pending
+
+    # 事件循环中的写入通过async_crud交给写入线程池
+    crud.write_usage_batch = sync_write
+    async_write = async_crud.write_usage_batch
+
+    async def via_pool(rows, key_updates):
+        await database.run_write(write_usage_batch, rows, key_updates)
+
+    async_crud.write_usage_batch = via_pool
+    try:
+        asyncio.run(run())
+    finally:
+        crud.write_usage_batch = write_usage_batch
+        async_crud.write_usage_batch = async_write
+    assert count_logs() == 1
+
+    # 没有事件循环时直接写入
+    log(make_writer(), key_id)
+    assert count_logs() == 2
+
+if __name__ == "__main__":
+    test_flush_when_batch_size_reached()
+    test_flush_on_interval()
+    test_rollups_are_updated_with_the_batch()
+    test_failed_write_is_retried()
+    test_full_queue_spills_to_overflow()
+    test_unstarted_writer_does_not_block_the_event_loop()
+    print("✅ 全部通过")